@@ -0,0 +1,95 @@
+"""
+Per-request overhead of the access log: no logging, the queued batching
+log and a synchronous log writing every record to the file in the request.
+
+Usage:
+  - python benchmarks/access_log.py [--requests 5000] [--threads 4]
+"""
+
+import os
+import time
+import argparse
+import tempfile
+import threading
+from logging.handlers import RotatingFileHandler
+from gymworkoutapi import create_app, db
+from gymworkoutapi.models import User
+from gymworkoutapi.accesslog import JsonFormatter
+
+def _synchronous(app, path):
+    """
+    Replaces the queue handler with a file handler writing and flushing
+    every record in the request thread
+    """
+
+    access_log = app.extensions["access_log"]
+    access_log.ensure_started()
+    handler = RotatingFileHandler(path, maxBytes=app.config["ACCESS_LOG_MAX_BYTES"],
+        backupCount=app.config["ACCESS_LOG_BACKUPS"], encoding="utf-8")
+    handler.setFormatter(JsonFormatter())
+    for old in list(access_log.logger.handlers):
+        access_log.logger.removeHandler(old)
+    access_log.logger.addHandler(handler)
+
+def _run(label, mode, args, directory):
+    """
+    Sends the requests from the given number of threads, returns the
+    seconds per request
+    """
+
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + os.path.join(directory, f"{mode}.db"),
+        "DB_POOL_SIZE": args.threads,
+        "ACCESS_LOG_ENABLED": mode != "none",
+        "ACCESS_LOG_PATH": os.path.join(directory, f"{mode}-{{pid}}.log")
+    })
+    with app.app_context():
+        db.create_all()
+        db.session.add(User(username="runner", height=180, weight=80, bmi=24.7))
+        db.session.commit()
+    if mode == "sync":
+        _synchronous(app, os.path.join(directory, "sync.log"))
+
+    per_thread = args.requests // args.threads
+    errors = []
+
+    def _client():
+        client = app.test_client()
+        for _ in range(per_thread):
+            resp = client.get("/api/users/runner/", buffered=True)
+            if resp.status_code != 200:
+                errors.append(resp.status_code)
+
+    threads = [threading.Thread(target=_client) for _ in range(args.threads)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+    if mode != "none":
+        app.extensions["access_log"].stop()
+
+    total = per_thread * args.threads
+    print(f"{label:16} {total / elapsed:8.0f} req/s  {elapsed / total * 1e6:7.0f} us/request"
+        + (f"  {len(errors)} errors" if errors else ""))
+    return elapsed / total
+
+def main():
+    """
+    Runs the benchmark
+    """
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--requests", type=int, default=5000)
+    parser.add_argument("--threads", type=int, default=4)
+    args = parser.parse_args()
+
+    with tempfile.TemporaryDirectory() as directory:
+        baseline = _run("no access log", "none", args, directory)
+        for label, mode in (("queued batches", "queued"), ("synchronous", "sync")):
+            seconds = _run(label, mode, args, directory)
+            print(f"{'':16} {(seconds - baseline) * 1e6:+8.1f} us/request overhead")
+
+if __name__ == "__main__":
+    main()
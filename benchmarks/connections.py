@@ -0,0 +1,73 @@
+"""
+Connection and session overhead per request under a threaded server,
+for the pool configurations supported by create_app (DB_POOL_CLASS).
+
+Usage:
+  - python benchmarks/connections.py [--threads 16] [--requests 200]
+"""
+
+import os
+import time
+import argparse
+import tempfile
+import threading
+from sqlalchemy import event
+from gymworkoutapi import create_app, db
+from gymworkoutapi.models import User
+
+def _run(pool_class, threads, requests):
+    """
+    Serves requests from several threads and returns the average
+    latency and the number of DBAPI connections opened
+    """
+
+    db_fd, db_fname = tempfile.mkstemp()
+    app = create_app({
+        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+        "DB_POOL_CLASS": pool_class,
+        "DB_POOL_SIZE": threads
+    })
+    connects = []
+    with app.app_context():
+        db.create_all()
+        db.session.add(User(username="bench", height=180, weight=80, bmi=24.7))
+        db.session.commit()
+        event.listen(db.engine, "connect", lambda *_: connects.append(1))
+
+    latencies = []
+
+    def _worker():
+        client = app.test_client()
+        for _ in range(requests):
+            start = time.perf_counter()
+            client.get("/api/users/bench/")
+            latencies.append(time.perf_counter() - start)
+
+    workers = [threading.Thread(target=_worker) for _ in range(threads)]
+    for worker in workers:
+        worker.start()
+    for worker in workers:
+        worker.join()
+
+    with app.app_context():
+        db.engine.dispose()
+    os.close(db_fd)
+    os.unlink(db_fname)
+    return sum(latencies) / len(latencies), len(connects)
+
+def main():
+    """
+    Runs the benchmark
+    """
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--threads", type=int, default=16)
+    parser.add_argument("--requests", type=int, default=200)
+    args = parser.parse_args()
+
+    for pool_class in ("null", "queue", "singleton"):
+        latency, connects = _run(pool_class, args.threads, args.requests)
+        print(f"{pool_class:10} {latency * 1000:7.3f} ms/request  {connects:6} connections opened")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,89 @@
+"""
+Throughput, payload size and peak memory of exporting the movements:
+the JSON path of the collection endpoints (mapped instances and
+serialize()) versus the streamed export formats.
+
+Usage:
+  - python benchmarks/export.py [--rows 200000] [--chunk 5000]
+"""
+
+import json
+import time
+import argparse
+import tracemalloc
+from sqlalchemy import insert
+from gymworkoutapi import create_app, db
+from gymworkoutapi.models import User, Workout, Movement, Exercise
+from gymworkoutapi.export import available_formats, stream_table
+
+def _populate(rows):
+    """
+    Inserts one user with one workout per 100 movements
+    """
+
+    db.session.execute(insert(User), [{"username": "user", "height": 180.0, "weight": 80.0}])
+    db.session.execute(insert(Workout), [
+        {"user_id": 1, "workout_name": f"workout{i}", "favorite": False}
+        for i in range(rows // 100 + 1)
+    ])
+    db.session.execute(insert(Exercise), [
+        {"name": f"movement{i}", "normalized_name": f"movement{i}"} for i in range(100)
+    ])
+    db.session.execute(insert(Movement), [
+        {"workout_id": i // 100 + 1, "exercise_id": i % 100 + 1, "sets": 3, "reps": 10}
+        for i in range(rows)
+    ])
+    db.session.commit()
+
+def _json_path(_chunk):
+    """
+    Export through the serializers of the JSON endpoints
+    """
+
+    movements = Movement.query.all()
+    return len(json.dumps([movement.serialize() for movement in movements]).encode())
+
+def _stream_path(export_format):
+    """
+    Export in the given format, the output is only counted
+    """
+
+    def _run(chunk):
+        return sum(len(data) for data in stream_table(db.engine, "movements", export_format, chunk))
+    return _run
+
+def _measure(label, func, rows, chunk):
+    """
+    Measures time, size and the peak memory of one path
+    """
+
+    db.session.remove()
+    tracemalloc.start()
+    start = time.perf_counter()
+    size = func(chunk)
+    elapsed = time.perf_counter() - start
+    _current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    print(f"{label:8} {rows / elapsed:10.0f} rows/s  {size / 2**20:7.1f} MiB  "
+        f"{peak / 2**20:7.1f} MiB peak")
+
+def main():
+    """
+    Runs the benchmark
+    """
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=200000)
+    parser.add_argument("--chunk", type=int, default=5000)
+    args = parser.parse_args()
+
+    app = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite://"})
+    with app.app_context():
+        db.create_all()
+        _populate(args.rows)
+        _measure("json", _json_path, args.rows, args.chunk)
+        for export_format in available_formats():
+            _measure(export_format, _stream_path(export_format), args.rows, args.chunk)
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,107 @@
+"""
+Load-test scenario for a running Gym Workout API server.
+
+Start the server to be measured, e.g.
+  - flask run
+  - python -m gymworkoutapi.serve
+
+and run:
+  - python benchmarks/load_test.py --url http://127.0.0.1:5000 --clients 16 --duration 10
+
+Each client creates its own user and workout, then loops over a mix of
+collection reads, item reads and movement writes. Throughput and latency
+percentiles are printed at the end.
+"""
+
+import json
+import time
+import uuid
+import argparse
+import threading
+import urllib.request
+import urllib.error
+
+def _request(url, method="GET", body=None):
+    """
+    Sends one request and returns its status code
+    """
+
+    data = None
+    headers = {}
+    if body is not None:
+        data = json.dumps(body).encode()
+        headers["Content-Type"] = "application/json"
+    req = urllib.request.Request(url, data=data, method=method, headers=headers)
+    try:
+        with urllib.request.urlopen(req) as resp:
+            resp.read()
+            return resp.status
+    except urllib.error.HTTPError as error:
+        return error.code
+
+def _client(base, deadline, latencies, errors):
+    """
+    A single simulated client
+    """
+
+    tag = uuid.uuid4().hex[:8]
+    username = f"load_{tag}"
+    workout = f"load_workout_{tag}"
+    _request(f"{base}/api/users/", "POST", {"username": username, "height": 180, "weight": 80})
+    _request(f"{base}/api/users/{username}/workouts/", "POST",
+        {"workout_name": workout, "favorite": False})
+
+    i = 0
+    while time.perf_counter() < deadline:
+        if i % 4 == 0:
+            url, method, body = f"{base}/api/users/{username}/workouts/{workout}/", "POST", {
+                "movement_name": f"movement{i}", "sets": 3, "reps": 5}
+        elif i % 4 == 1:
+            url, method, body = f"{base}/api/users/{username}/workouts/", "GET", None
+        elif i % 4 == 2:
+            url, method, body = f"{base}/api/users/{username}/", "GET", None
+        else:
+            url, method, body = f"{base}/api/users/", "GET", None
+        start = time.perf_counter()
+        status = _request(url, method, body)
+        latencies.append(time.perf_counter() - start)
+        if status >= 500:
+            errors.append(status)
+        i += 1
+
+def main():
+    """
+    Runs the scenario and prints the results
+    """
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--url", default="http://127.0.0.1:5000")
+    parser.add_argument("--clients", type=int, default=16)
+    parser.add_argument("--duration", type=float, default=10.0)
+    args = parser.parse_args()
+
+    latencies = []
+    errors = []
+    deadline = time.perf_counter() + args.duration
+    threads = [
+        threading.Thread(target=_client, args=(args.url, deadline, latencies, errors))
+        for _ in range(args.clients)
+    ]
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+
+    latencies.sort()
+    count = len(latencies)
+    if not count:
+        print("No requests completed")
+        return
+    print(f"requests:   {count}")
+    print(f"errors:     {len(errors)}")
+    print(f"throughput: {count / args.duration:.1f} req/s")
+    print(f"p50:        {latencies[count // 2] * 1000:.2f} ms")
+    print(f"p99:        {latencies[min(count - 1, int(count * 0.99))] * 1000:.2f} ms")
+
+if __name__ == "__main__":
+    main()
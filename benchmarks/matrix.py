@@ -0,0 +1,95 @@
+"""
+Runs tests/resource_test.py and the write benchmark against SQLite and
+PostgreSQL.
+
+PostgreSQL is taken from TEST_POSTGRES_URI if it is set. Otherwise a
+throwaway cluster is started with initdb and pg_ctl from PATH (the server
+binaries, e.g. the postgresql package) and removed afterwards. A driver
+such as psycopg must be installed.
+
+Usage:
+  - python benchmarks/matrix.py
+"""
+
+import os
+import sys
+import shutil
+import socket
+import tempfile
+import subprocess
+from contextlib import contextmanager
+
+ROOT = os.path.dirname(os.path.dirname(os.path.abspath(__file__)))
+
+def _free_port():
+    """
+    Returns a free TCP port
+    """
+
+    with socket.socket() as sock:
+        sock.bind(("127.0.0.1", 0))
+        return sock.getsockname()[1]
+
+@contextmanager
+def local_postgres():
+    """
+    Yields the URI of a PostgreSQL database, or None if none is available
+    """
+
+    if os.environ.get("TEST_POSTGRES_URI"):
+        yield os.environ["TEST_POSTGRES_URI"]
+        return
+    if shutil.which("initdb") is None or shutil.which("pg_ctl") is None:
+        yield None
+        return
+
+    data_dir = tempfile.mkdtemp()
+    port = _free_port()
+    subprocess.run(["initdb", "-D", data_dir, "-U", "postgres", "--auth=trust"],
+        check=True, stdout=subprocess.DEVNULL)
+    subprocess.run(["pg_ctl", "-D", data_dir, "-w", "-l", os.path.join(data_dir, "log"),
+        "-o", f"-p {port} -k {data_dir} -c listen_addresses=127.0.0.1", "start"], check=True)
+    try:
+        subprocess.run(["createdb", "-h", "127.0.0.1", "-p", str(port), "-U", "postgres",
+            "gym_test"], check=True)
+        yield f"postgresql+psycopg://postgres@127.0.0.1:{port}/gym_test"
+    finally:
+        subprocess.run(["pg_ctl", "-D", data_dir, "-m", "fast", "stop"], check=False)
+        shutil.rmtree(data_dir, ignore_errors=True)
+
+def _run(uri):
+    """
+    Runs the tests and the benchmark against one database
+    """
+
+    env = dict(os.environ, PYTHONPATH=ROOT)
+    if uri:
+        env["TEST_DATABASE_URI"] = uri
+    else:
+        env.pop("TEST_DATABASE_URI", None)
+    tests = subprocess.run([sys.executable, "-m", "pytest", "-q", "tests/resource_test.py"],
+        cwd=ROOT, env=env, capture_output=True, text=True, check=False)
+    summary = tests.stdout.strip().splitlines()[-1] if tests.stdout.strip() else tests.stderr
+    command = [sys.executable, "benchmarks/writes.py"] + (["--uri", uri] if uri else [])
+    bench = subprocess.run(command, cwd=ROOT, env=env, capture_output=True, text=True,
+        check=False)
+    return summary, bench.stdout.strip() or bench.stderr.strip().splitlines()[-1]
+
+def main():
+    """
+    Runs the matrix and prints the results
+    """
+
+    with local_postgres() as postgres_uri:
+        backends = [("sqlite", None)]
+        if postgres_uri:
+            backends.append(("postgresql", postgres_uri))
+        else:
+            print("PostgreSQL not available, set TEST_POSTGRES_URI or put initdb on PATH")
+        for name, uri in backends:
+            tests, bench = _run(uri)
+            print(f"[{name}] tests: {tests}")
+            print(f"[{name}] bench: {bench}")
+
+if __name__ == "__main__":
+    main()
@@ -0,0 +1,77 @@
+"""
+Memory and serialization time of the list endpoints' read path:
+mapped User instances versus the __slots__ read models.
+
+Usage:
+  - python benchmarks/read_models.py [--rows 100000]
+"""
+
+import json
+import time
+import argparse
+import tracemalloc
+from sqlalchemy import insert
+from gymworkoutapi import create_app, db
+from gymworkoutapi.models import User
+from gymworkoutapi.readmodels import UserRow
+
+def _populate(rows):
+    """
+    Inserts the given number of users
+    """
+
+    db.session.execute(insert(User), [
+        {"username": f"user{i}", "height": 180.0, "weight": 80.0, "bmi": 24.7}
+        for i in range(rows)
+    ])
+    db.session.commit()
+
+def _orm_path():
+    """
+    Read path used before the read models
+    """
+
+    users = User.query.all()
+    return users, json.dumps([user.serialize() for user in users])
+
+def _read_model_path():
+    """
+    Read path with the read models
+    """
+
+    users = UserRow.fetch(db.session, UserRow.select().order_by(User.id.desc()))
+    return users, json.dumps([user.serialize() for user in users])
+
+def _measure(label, func, rows):
+    """
+    Measures time and the peak memory of one path
+    """
+
+    db.session.remove()
+    tracemalloc.start()
+    start = time.perf_counter()
+    users, _payload = func()
+    elapsed = time.perf_counter() - start
+    _current, peak = tracemalloc.get_traced_memory()
+    tracemalloc.stop()
+    del users
+    print(f"{label:12} {elapsed * 1000:9.1f} ms  {peak / rows:8.0f} B/row peak")
+
+def main():
+    """
+    Runs the benchmark
+    """
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--rows", type=int, default=100000)
+    args = parser.parse_args()
+
+    app = create_app({"SQLALCHEMY_DATABASE_URI": "sqlite://"})
+    with app.app_context():
+        db.create_all()
+        _populate(args.rows)
+        _measure("mapped", _orm_path, args.rows)
+        _measure("read model", _read_model_path, args.rows)
+
+if __name__ == "__main__":
+    main()
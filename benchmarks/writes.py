@@ -0,0 +1,70 @@
+"""
+Write throughput of the movement logging path (WorkoutItem.post)
+with concurrent writers, for comparing the storage backends.
+
+Usage:
+  - python benchmarks/writes.py [--uri sqlite:////tmp/bench.db] [--threads 8] [--writes 200]
+"""
+
+import os
+import time
+import argparse
+import tempfile
+import threading
+from gymworkoutapi import create_app, db
+from gymworkoutapi.models import User, Workout
+
+def main():
+    """
+    Runs the benchmark
+    """
+
+    parser = argparse.ArgumentParser(description=__doc__)
+    parser.add_argument("--uri", default=None)
+    parser.add_argument("--threads", type=int, default=8)
+    parser.add_argument("--writes", type=int, default=200)
+    args = parser.parse_args()
+
+    db_fd, db_fname = tempfile.mkstemp()
+    uri = args.uri or "sqlite:///" + db_fname
+    app = create_app({"SQLALCHEMY_DATABASE_URI": uri, "DB_POOL_SIZE": args.threads})
+    with app.app_context():
+        db.drop_all()
+        db.create_all()
+        for i in range(args.threads):
+            user = User(username=f"writer{i}", height=180, weight=80, bmi=24.7)
+            db.session.add(user)
+            db.session.flush()
+            db.session.add(Workout(user_id=user.id, workout_name=f"workout{i}", favorite=False))
+        db.session.commit()
+
+    errors = []
+
+    def _writer(number):
+        client = app.test_client()
+        url = f"/api/users/writer{number}/workouts/workout{number}/"
+        for i in range(args.writes):
+            resp = client.post(url, json={"movement_name": f"movement{i}", "sets": 3, "reps": 5})
+            if resp.status_code != 201:
+                errors.append(resp.status_code)
+
+    threads = [threading.Thread(target=_writer, args=(i,)) for i in range(args.threads)]
+    start = time.perf_counter()
+    for thread in threads:
+        thread.start()
+    for thread in threads:
+        thread.join()
+    elapsed = time.perf_counter() - start
+
+    total = args.threads * args.writes
+    dialect = uri.split(":", 1)[0]
+    print(f"{dialect:24} {total / elapsed:8.1f} writes/s  {len(errors)} errors")
+
+    with app.app_context():
+        db.drop_all()
+        db.engine.dispose()
+    os.close(db_fd)
+    os.unlink(db_fname)
+
+if __name__ == "__main__":
+    main()
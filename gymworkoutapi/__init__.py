@@ -4,12 +4,104 @@ https://github.com/enkwolf/pwp-course-sensorhub-api-example/blob/master/sensorhu
 """
 
 import os
+import copy
+import weakref
+from functools import lru_cache
+import yaml
 from flask import Flask
 from flask_sqlalchemy import SQLAlchemy
 from flasgger import Swagger, swag_from
+from sqlalchemy import event, pool
 
 db = SQLAlchemy()
 
+POOL_CLASSES = {
+    "queue": pool.QueuePool,
+    "static": pool.StaticPool,
+    "null": pool.NullPool,
+    "singleton": pool.SingletonThreadPool
+}
+
+def _engine_options(config):
+    """
+    Builds SQLALCHEMY_ENGINE_OPTIONS from the DB_* config values.
+    Options given directly in SQLALCHEMY_ENGINE_OPTIONS take precedence.
+    """
+
+    sqlite = config["SQLALCHEMY_DATABASE_URI"].startswith("sqlite")
+    options = {
+        "pool_pre_ping": config["DB_POOL_PRE_PING"],
+        "query_cache_size": config["DB_STATEMENT_CACHE_SIZE"]
+    }
+    pool_class = POOL_CLASSES[config["DB_POOL_CLASS"]] if config["DB_POOL_CLASS"] else None
+    if pool_class is not None:
+        options["poolclass"] = pool_class
+    if pool_class in (None, pool.QueuePool):
+        options["pool_size"] = config["DB_POOL_SIZE"]
+        options["max_overflow"] = config["DB_MAX_OVERFLOW"]
+    if pool_class is pool.SingletonThreadPool:
+        # one persistent connection per thread, the pool must be able to
+        # hold a connection for every server thread (checked by serve.py)
+        options["pool_size"] = config["DB_POOL_SIZE"] + config["DB_MAX_OVERFLOW"]
+    if not sqlite:
+        # server connections are dropped by the server or by firewalls
+        # when idle, so they are recycled before that happens
+        options["pool_recycle"] = config["DB_POOL_RECYCLE"]
+    if sqlite:
+        options["connect_args"] = {
+            "cached_statements": config["DB_STATEMENT_CACHE_SIZE"]
+        }
+        if pool_class is not pool.SingletonThreadPool:
+            # connections are handed between the threads of a threaded server
+            options["connect_args"]["check_same_thread"] = False
+        uri = config["SQLALCHEMY_DATABASE_URI"]
+        if "mode=memory" in uri and pool_class is None:
+            # a named in-memory database is shared by all connections
+            # like a file, so the connections are pooled the same way
+            options["poolclass"] = pool.QueuePool
+        elif ":memory:" in uri or uri == "sqlite://":
+            # unnamed in-memory databases use StaticPool, which has no overflow
+            options.pop("pool_size", None)
+            options.pop("max_overflow", None)
+    options.update(config.get("SQLALCHEMY_ENGINE_OPTIONS") or {})
+    return options
+
+def _set_sqlite_pragmas(pragmas):
+    """
+    Returns a connect listener applying the given PRAGMA statements
+    """
+
+    def _listener(dbapi_connection, _):
+        cursor = dbapi_connection.cursor()
+        for name, value in pragmas.items():
+            cursor.execute(f"PRAGMA {name}={value}")
+        cursor.close()
+    return _listener
+
+def _dispose_engines(app_ref):
+    """
+    Drops the connection pools inherited from the parent process.
+    Called in the child right after a fork, so that pre-fork servers
+    never share database connections between worker processes.
+    """
+
+    app = app_ref()
+    if app is None:
+        return
+    with app.app_context():
+        for engine in db.engines.values():
+            engine.dispose(close=False)
+
+@lru_cache(maxsize=None)
+def _swagger_template(path):
+    """
+    Parses the API documentation once per process, so that creating
+    more applications (e.g. one per test) does not parse it again
+    """
+
+    with open(path, encoding="utf-8") as handle:
+        return yaml.load(handle, Loader=getattr(yaml, "CSafeLoader", yaml.SafeLoader))
+
 def create_app(test_config=None):
     """
     Function used to create the application
@@ -18,14 +110,67 @@ def create_app(test_config=None):
     app = Flask(__name__, instance_relative_config=True, static_folder="static")
     app.config.from_mapping(
             SQLALCHEMY_DATABASE_URI="sqlite:///" + os.path.join(app.instance_path, "dev.db"),
-            SQLALCHEMY_TRACK_MODIFICATIONS=False
+            SQLALCHEMY_TRACK_MODIFICATIONS=False,
+            DB_POOL_CLASS=None,
+            DB_POOL_SIZE=5,
+            DB_MAX_OVERFLOW=10,
+            DB_POOL_PRE_PING=False,
+            DB_POOL_RECYCLE=1800,
+            DB_STATEMENT_CACHE_SIZE=500,
+            DB_SQLITE_PRAGMAS={
+                # auto_vacuum only applies to new databases, see maintenance.py
+                "auto_vacuum": "INCREMENTAL",
+                "journal_mode": "WAL",
+                "synchronous": "NORMAL",
+                "busy_timeout": 5000
+            },
+            MOVEMENT_WRITE_BEHIND=False,
+            MOVEMENT_FLUSH_INTERVAL_MS=50,
+            MOVEMENT_FLUSH_ROWS=500,
+            MOVEMENT_JOURNAL="flush",
+            RATELIMIT_ENABLED=False,
+            RATELIMIT_DEFAULT=(10, 20),
+            RATELIMIT_ROUTES={},
+            RATELIMIT_BACKEND=None,
+            RATELIMIT_CLIENT_HEADER=None,
+            ADMISSION_MAX_INFLIGHT=None,
+            ADMISSION_RETRY_AFTER=1,
+            COALESCE_ROUTES=(),
+            PROFILING_ENABLED=False,
+            PROFILING_MODE="sampling",
+            PROFILING_SAMPLE_RATE=0.01,
+            PROFILING_ADMIN_TOKEN=None,
+            PROFILING_INTERVAL_MS=5,
+            PROFILING_KEEP=500,
+            PROFILING_DIR=None,
+            IDEMPOTENCY_TTL=86400,
+            IDEMPOTENCY_PURGE_INTERVAL=300,
+            EXPORT_CHUNK_ROWS=5000,
+            HEALTH_PROBE_TIMEOUT_MS=500,
+            HEALTH_MAX_DB_P99_MS=None,
+            HEALTH_P99_WINDOW_SECONDS=60,
+            HEALTH_MAX_WAL_BYTES=None,
+            MAINTENANCE_INTERVAL=None,
+            MAINTENANCE_FREE_RATIO=0.1,
+            MAINTENANCE_VACUUM_PAGES=1000,
+            MAINTENANCE_CHECKPOINT_WAL_BYTES=16 * 1024 * 1024,
+            MAINTENANCE_LOCK_PATH=None,
+            ACCESS_LOG_ENABLED=False,
+            ACCESS_LOG_PATH=None,
+            ACCESS_LOG_MAX_BYTES=50 * 1024 * 1024,
+            ACCESS_LOG_BACKUPS=5,
+            ACCESS_LOG_BATCH_RECORDS=256,
+            ACCESS_LOG_FLUSH_INTERVAL_MS=1000,
+            ACCESS_LOG_QUEUE_SIZE=10000
         )
     app.config["SWAGGER"] = {
         "title": "Gym Workout API",
         "openapi": "3.0.3",
         "uiversion": 3,
     }
-    swagger = Swagger(app, template_file="doc/documentation.yml")
+    # the template is copied, the documentation may be changed per application
+    template = _swagger_template(os.path.join(app.root_path, "doc", "documentation.yml"))
+    swagger = Swagger(app, template=copy.deepcopy(template))
 
     if test_config is None:
         app.config.from_pyfile("config.py", silent=True)
@@ -37,15 +182,62 @@ def create_app(test_config=None):
     except OSError:
         pass
 
+    app.config["SQLALCHEMY_ENGINE_OPTIONS"] = _engine_options(app.config)
     db.init_app(app)
+    with app.app_context():
+        if db.engine.dialect.name == "sqlite" and app.config["DB_SQLITE_PRAGMAS"]:
+            event.listen(db.engine, "connect", _set_sqlite_pragmas(app.config["DB_SQLITE_PRAGMAS"]))
+
+    @app.teardown_appcontext
+    def _remove_session(_exc):
+        # the session is closed and its connection returned to the pool
+        # after every request, also when the request failed
+        db.session.remove()
+
+    if hasattr(os, "register_at_fork"):
+        app_ref = weakref.ref(app)
+        os.register_at_fork(after_in_child=lambda: _dispose_engines(app_ref))
 
     from gymworkoutapi.utils import UserConverter, WorkoutConverter
     from . import models
+    from . import migrations
+    # imported for its after_flush listener recording the changes
+    from . import changes # pylint: disable=unused-import
+    # imported for its after_flush listener updating the summaries
+    from . import summaries # pylint: disable=unused-import
     from . import api
+    from . import metrics
+    from . import writebehind
+    from . import ratelimit
+    from . import coalesce
+    from . import profiling
+    from . import idempotency
+    from . import export
+    from . import exercises
+    from . import health
+    from . import maintenance
+    from . import accesslog
     app.url_map.converters["user"] = UserConverter
     app.url_map.converters["workout"] = WorkoutConverter
     app.cli.add_command(models.init_db_command)
     app.cli.add_command(models.db_test)
+    app.cli.add_command(migrations.upgrade_db_command)
+    app.cli.add_command(migrations.db_version_command)
+    app.cli.add_command(migrations.stamp_db_command)
+    app.cli.add_command(export.export_data_command)
+    app.cli.add_command(maintenance.maintain_db_command)
+    app.cli.add_command(exercises.merge_movements_command)
     app.register_blueprint(api.api_bp)
+    metrics.init_app(app)
+    health.init_app(app)
+    writebehind.init_app(app)
+    # profiling runs inside the admission control, rejected requests are not profiled
+    profiling.init_app(app)
+    idempotency.init_app(app)
+    ratelimit.init_app(app)
+    coalesce.init_app(app)
+    maintenance.init_app(app)
+    # outermost, the requests rejected by the other middlewares are logged too
+    accesslog.init_app(app)
 
     return app
@@ -0,0 +1,293 @@
+"""
+Structured access log.
+
+When ACCESS_LOG_ENABLED is set, every request is logged as one JSON line
+with its method, path, route, user, status, latency and the number of SQL
+statements it ran. The request thread only puts the record on an
+in-memory queue. A listener thread formats the records and writes them in
+batches of ACCESS_LOG_BATCH_RECORDS lines, or after
+ACCESS_LOG_FLUSH_INTERVAL_MS when traffic is low, to a file rotated at
+ACCESS_LOG_MAX_BYTES with ACCESS_LOG_BACKUPS old files kept.
+
+Config:
+  - ACCESS_LOG_PATH: log file, "{pid}" is replaced by the worker's process
+    id (instance/access-{pid}.log by default). Worker processes must not
+    share a file, because they rotate it independently.
+  - ACCESS_LOG_QUEUE_SIZE: records waiting to be written, records arriving
+    when the queue is full are dropped and counted as accesslog.dropped
+    at /api/metrics/ instead of blocking the request
+
+The latency is measured until the response body has been sent, so
+streamed responses are included, and the rate limited and admission
+controlled requests are logged too.
+
+REFERENCE:
+https://docs.python.org/3/library/logging.handlers.html#queuehandler
+https://docs.python.org/3/howto/logging-cookbook.html#dealing-with-handlers-that-block
+"""
+
+import os
+import json
+import time
+import queue
+import atexit
+import logging
+import threading
+import contextvars
+from datetime import datetime, timezone
+from logging.handlers import QueueHandler, QueueListener, RotatingFileHandler
+from flask import request
+from sqlalchemy import event
+from werkzeug.wsgi import ClosingIterator
+from gymworkoutapi import db
+
+ROUTE_KEY = "gymworkoutapi.route"
+USER_KEY = "gymworkoutapi.user"
+
+_statements = contextvars.ContextVar("access_log_statements", default=None)
+
+class JsonFormatter(logging.Formatter):
+    """
+    Formats an access log entry (a dict as the record's msg) as one JSON line
+    """
+
+    def format(self, record):
+        entry = {"time": datetime.fromtimestamp(record.created, timezone.utc)
+            .isoformat(timespec="milliseconds")}
+        entry.update(record.msg)
+        return json.dumps(entry, separators=(",", ":"))
+
+class BatchingRotatingFileHandler(RotatingFileHandler):
+    """
+    Rotating file handler writing the formatted records in batches.
+    The file size is checked once per batch instead of once per record,
+    so a file can exceed maxBytes by at most one batch.
+    """
+
+    def __init__(self, filename, max_bytes, backup_count, batch_records):
+        super().__init__(filename, maxBytes=max_bytes, backupCount=backup_count,
+            encoding="utf-8", delay=True)
+        self.batch_records = batch_records
+        self._batch = []
+
+    def emit(self, record):
+        try:
+            self._batch.append(self.format(record) + self.terminator)
+        except Exception: # pylint: disable=broad-except
+            self.handleError(record)
+            return
+        if len(self._batch) >= self.batch_records:
+            self.flush()
+
+    def flush(self):
+        """
+        Writes the pending records and rotates the file if it is full
+        """
+
+        with self.lock:
+            if not self._batch:
+                return
+            if self.stream is None:
+                self.stream = self._open()
+            self.stream.write("".join(self._batch))
+            self._batch = []
+            self.stream.flush()
+            if self.maxBytes and self.stream.tell() >= self.maxBytes:
+                self.doRollover()
+
+    def close(self):
+        self.flush()
+        super().close()
+
+class BatchingQueueListener(QueueListener):
+    """
+    Queue listener that flushes its handlers whenever the queue has been
+    empty for the flush interval, so a partial batch is not held back
+    """
+
+    def __init__(self, log_queue, *handlers, flush_interval=1.0):
+        super().__init__(log_queue, *handlers)
+        self.flush_interval = flush_interval
+
+    def dequeue(self, block):
+        while True:
+            try:
+                return self.queue.get(block, self.flush_interval)
+            except queue.Empty:
+                for handler in self.handlers:
+                    handler.flush()
+
+class DroppingQueueHandler(QueueHandler):
+    """
+    Queue handler that never blocks: records are dropped when the queue
+    is full. The records are enqueued as they are, they are only ever
+    created by the access log and formatted by the listener.
+    """
+
+    def __init__(self, log_queue, on_drop):
+        super().__init__(log_queue)
+        self.on_drop = on_drop
+
+    def prepare(self, record):
+        return record
+
+    def enqueue(self, record):
+        try:
+            self.queue.put_nowait(record)
+        except queue.Full:
+            self.on_drop()
+
+class AccessLog:
+    """
+    Per-process access log: the queue, its listener thread and the file handler
+    """
+
+    def __init__(self, app):
+        self.app = app
+        self.logger = None
+        self._listener = None
+        self._pid = None
+        self._lock = threading.Lock()
+
+    def _path(self):
+        path = self.app.config["ACCESS_LOG_PATH"] or os.path.join(
+            self.app.instance_path, "access-{pid}.log"
+        )
+        return path.replace("{pid}", str(os.getpid()))
+
+    def ensure_started(self):
+        """
+        Starts the listener in the current process. Threads do not
+        survive a fork, so this is done lazily on the first request.
+        """
+
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            config = self.app.config
+            path = self._path()
+            os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+            file_handler = BatchingRotatingFileHandler(
+                path, config["ACCESS_LOG_MAX_BYTES"], config["ACCESS_LOG_BACKUPS"],
+                config["ACCESS_LOG_BATCH_RECORDS"]
+            )
+            file_handler.setFormatter(JsonFormatter())
+            log_queue = queue.Queue(config["ACCESS_LOG_QUEUE_SIZE"])
+            metrics = self.app.extensions["metrics"]
+            # a logger outside the logging module's registry, one per application
+            logger = logging.Logger("gymworkoutapi.access")
+            logger.addHandler(DroppingQueueHandler(
+                log_queue, lambda: metrics.incr("accesslog.dropped")
+            ))
+            self._listener = BatchingQueueListener(
+                log_queue, file_handler,
+                flush_interval=config["ACCESS_LOG_FLUSH_INTERVAL_MS"] / 1000
+            )
+            self._listener.start()
+            self.logger = logger
+            self._pid = os.getpid()
+            atexit.register(self.stop)
+
+    def log(self, entry):
+        """
+        Queues an entry. The record is built directly, without the
+        caller lookup of Logger.info.
+        """
+
+        self.logger.handle(self.logger.makeRecord(
+            self.logger.name, logging.INFO, "", 0, entry, None, None
+        ))
+
+    def stop(self):
+        """
+        Writes the queued records and stops the listener thread
+        """
+
+        if self._pid != os.getpid() or self._listener is None:
+            return
+        self._listener.stop()
+        for handler in self._listener.handlers:
+            handler.close()
+        self._listener = None
+        self._pid = None
+
+class AccessLogMiddleware:
+    """
+    WSGI middleware timing every request and logging it when its
+    response has been sent
+    """
+
+    def __init__(self, access_log, wsgi_app):
+        self.access_log = access_log
+        self.wsgi_app = wsgi_app
+
+    def __call__(self, environ, start_response):
+        self.access_log.ensure_started()
+        started = time.perf_counter()
+        # counted until the body has been sent, so the context
+        # variable is only cleared when the request is logged
+        statements = [0]
+        _statements.set(statements)
+        response = []
+
+        def _start_response(status, headers, exc_info=None):
+            response[:] = [status]
+            return start_response(status, headers, exc_info)
+
+        def _log():
+            _statements.set(None)
+            status = response[0] if response else "500"
+            self.access_log.log({
+                "method": environ.get("REQUEST_METHOD"),
+                "path": environ.get("PATH_INFO"),
+                "route": environ.get(ROUTE_KEY),
+                "user": environ.get(USER_KEY),
+                "status": int(status.split(" ", 1)[0]),
+                "latency_ms": round((time.perf_counter() - started) * 1000, 3),
+                "sql": statements[0]
+            })
+
+        try:
+            result = self.wsgi_app(environ, _start_response)
+        except Exception:
+            _log()
+            raise
+        return ClosingIterator(result, _log)
+
+def _count_statement(*_):
+    """
+    Counts a cursor execution for the request running in this context
+    """
+
+    statements = _statements.get()
+    if statements is not None:
+        statements[0] += 1
+
+def _record_route():
+    """
+    Stores the matched route and the user of the URL for the access log
+    """
+
+    if request.url_rule is not None:
+        request.environ[ROUTE_KEY] = request.url_rule.rule
+    view_args = request.view_args or {}
+    user = view_args.get("user")
+    request.environ[USER_KEY] = getattr(user, "username", None) or view_args.get("username")
+
+def init_app(app):
+    """
+    Wraps the application with the access log middleware if it is enabled.
+    Called last, so that the requests rejected by the outer middlewares
+    are logged too.
+    """
+
+    if not app.config["ACCESS_LOG_ENABLED"]:
+        return
+    access_log = AccessLog(app)
+    app.extensions["access_log"] = access_log
+    app.before_request(_record_route)
+    with app.app_context():
+        event.listen(db.engine, "before_cursor_execute", _count_statement)
+    app.wsgi_app = AccessLogMiddleware(access_log, app.wsgi_app)
@@ -6,8 +6,12 @@ from flask import Blueprint
 from flask_restful import Api
 
 from gymworkoutapi.resources.user import UserItem, UserCollection
-from gymworkoutapi.resources.workout import WorkoutCollection, WorkoutItem
+from gymworkoutapi.resources.workout import WorkoutCollection, WorkoutItem, WorkoutClone
 from gymworkoutapi.resources.movement import MovementItem
+from gymworkoutapi.resources.metrics import MetricsItem
+from gymworkoutapi.resources.changes import ChangeCollection
+from gymworkoutapi.resources.summary import UserSummaryItem
+from gymworkoutapi.resources.export import ExportItem
 
 api_bp = Blueprint("api", __name__, url_prefix="/api")
 api = Api(api_bp)
@@ -16,4 +20,9 @@ api.add_resource(UserCollection, "/users/")
 api.add_resource(UserItem, "/users/<user:user>/")
 api.add_resource(WorkoutCollection, "/users/<user:user>/workouts/")
 api.add_resource(WorkoutItem, "/users/<user:user>/workouts/<workout:workout>/")
+api.add_resource(WorkoutClone, "/users/<user:user>/workouts/<workout:workout>/clone/")
 api.add_resource(MovementItem, "/users/<user:user>/workouts/<workout:workout>/<movement>/")
+api.add_resource(ChangeCollection, "/users/<user:user>/changes/")
+api.add_resource(UserSummaryItem, "/users/<username>/summary/")
+api.add_resource(ExportItem, "/export/<table>/")
+api.add_resource(MetricsItem, "/metrics/")
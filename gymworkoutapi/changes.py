@@ -0,0 +1,143 @@
+"""
+Change tracking for delta sync.
+
+Every flush that inserts, updates or deletes a User, Workout or Movement
+appends one ChangeLog row per affected entity, in the same transaction.
+The id of the last change log row a client has seen is its sync token.
+
+The token is only safe if the change log ids become visible in id order:
+a client that has seen id 12 must never find an id 11 committed later.
+SQLite has a single writer, so this holds there. On PostgreSQL,
+concurrent transactions take the ids from a sequence in one order and
+may commit in another, so the transactions writing the change log are
+serialized with a transaction-level advisory lock. The lock is taken
+before the ids are drawn and released after the commit is visible.
+This makes the change-producing writes one at a time, as they are on
+SQLite. Other databases are not supported.
+
+REFERENCE:
+https://docs.sqlalchemy.org/en/20/orm/events.html#sqlalchemy.orm.SessionEvents.after_flush
+https://www.postgresql.org/docs/current/explicit-locking.html#ADVISORY-LOCKS
+"""
+
+from sqlalchemy import event, insert, select, text
+from sqlalchemy.orm import Session
+from gymworkoutapi.models import User, Workout, Movement, ChangeLog
+
+ENTITIES = {
+    User: "user",
+    Workout: "workout",
+    Movement: "movement"
+}
+MODELS = {name: model for model, name in ENTITIES.items()}
+
+# key of the PostgreSQL advisory lock serializing the change log writers
+CHANGE_LOG_LOCK = 0x63686C67
+
+def _owner(session, obj, deleted_workouts):
+    """
+    Returns the id of the user that owns the given entity
+    """
+
+    if isinstance(obj, User):
+        return obj.id
+    if isinstance(obj, Workout):
+        return obj.user_id
+    if obj.workout_id in deleted_workouts:
+        return deleted_workouts[obj.workout_id]
+    workout = obj.__dict__.get("workout")
+    if workout is not None:
+        return workout.user_id
+    return session.connection().execute(
+        select(Workout.user_id).where(Workout.id == obj.workout_id)
+    ).scalar()
+
+def changed_entities(session):
+    """
+    Yields (entity, obj, user_id, deleted) for the users, workouts and
+    movements written by the flush in progress
+    """
+
+    deleted_workouts = {
+        obj.id: obj.user_id for obj in session.deleted if isinstance(obj, Workout)
+    }
+    for objects, deleted in ((session.new, False), (session.dirty, False), (session.deleted, True)):
+        for obj in objects:
+            entity = ENTITIES.get(type(obj))
+            if entity is None:
+                continue
+            if objects is session.dirty and not session.is_modified(obj, include_collections=False):
+                continue
+            user_id = _owner(session, obj, deleted_workouts)
+            if user_id is None:
+                continue
+            yield entity, obj, user_id, deleted
+
+@event.listens_for(Session, "after_flush")
+def _record_changes(session, _flush_context):
+    """
+    Appends the change log rows of a flush
+    """
+
+    rows = [
+        {"user_id": user_id, "entity": entity, "entity_id": obj.id, "deleted": deleted}
+        for entity, obj, user_id, deleted in changed_entities(session)
+    ]
+    if rows:
+        append_changes(session.connection(), rows)
+
+def append_changes(connection, rows):
+    """
+    Inserts change log rows. On PostgreSQL the transaction first takes
+    the change log lock, so the ids are committed in id order.
+    """
+
+    if connection.dialect.name == "postgresql":
+        # held until the transaction ends, a second flush of the same
+        # transaction takes it again without waiting
+        connection.execute(
+            text("SELECT pg_advisory_xact_lock(:key)"), {"key": CHANGE_LOG_LOCK}
+        )
+    connection.execute(insert(ChangeLog), rows)
+
+def collect_changes(session, user_id, since=0, limit=1000):
+    """
+    Returns (token, more, changes) for the changes of a user after the
+    given token. Several changes of one entity collapse into the latest one
+    and the current rows are loaded with one query per entity type.
+    """
+
+    log = session.execute(
+        select(ChangeLog.id, ChangeLog.entity, ChangeLog.entity_id, ChangeLog.deleted)
+        .where(ChangeLog.user_id == user_id, ChangeLog.id > since)
+        .order_by(ChangeLog.id)
+        .limit(limit + 1)
+    ).all()
+    more = len(log) > limit
+    log = log[:limit]
+    token = log[-1].id if log else since
+
+    latest = {}
+    for row in log:
+        key = (row.entity, row.entity_id)
+        latest.pop(key, None)
+        latest[key] = row.deleted
+
+    current = {}
+    for entity, model in MODELS.items():
+        ids = [entity_id for (name, entity_id), deleted in latest.items()
+            if name == entity and not deleted]
+        if ids:
+            for obj in session.execute(select(model).where(model.id.in_(ids))).scalars():
+                current[(entity, obj.id)] = obj
+
+    changes = []
+    for (entity, entity_id), deleted in latest.items():
+        obj = current.get((entity, entity_id))
+        if deleted or obj is None:
+            changes.append({"entity": entity, "id": entity_id, "deleted": True})
+            continue
+        data = obj.serialize()
+        data["updated_at"] = obj.updated_at.isoformat()
+        changes.append({"entity": entity, "id": entity_id, "deleted": False, "data": data})
+    return token, more, changes
@@ -0,0 +1,114 @@
+"""
+Request coalescing for read handlers.
+
+Concurrent identical GET requests in one worker share a single execution
+of the handler: the first request runs it and the ones arriving while it
+runs wait for it and reuse its serialized response.
+
+A request joining a running execution may get a response whose queries
+ran before it arrived. A client that POSTs and then GETs can miss its
+own write. Coalescing is therefore off by default, and it is enabled
+per route for the routes where such a slightly stale read is acceptable:
+  - COALESCE_ROUTES: endpoints to coalesce, e.g. {"api.usercollection"}
+
+A route can be enabled if its handler has the decorator:
+
+    class WorkoutCollection(Resource):
+        method_decorators = {"get": [coalesced]}
+
+REFERENCE:
+https://pkg.go.dev/golang.org/x/sync/singleflight
+"""
+
+import json
+import threading
+from functools import wraps
+from flask import request, current_app, Response
+
+class _Call:
+    """
+    An execution in flight
+    """
+
+    def __init__(self):
+        self.done = threading.Event()
+        self.result = None
+        self.error = None
+
+class SingleFlight:
+    """
+    Deduplicates concurrent calls with the same key
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._calls = {}
+
+    def do(self, key, func):
+        """
+        Runs func unless a call with the same key is in flight, in which
+        case its result is awaited. Returns (result, shared) where shared
+        tells whether the result came from another call.
+        """
+
+        with self._lock:
+            call = self._calls.get(key)
+            leader = call is None
+            if leader:
+                call = self._calls[key] = _Call()
+
+        if not leader:
+            call.done.wait()
+            if call.error is not None:
+                raise call.error
+            return call.result, True
+
+        try:
+            call.result = func()
+        except Exception as error:
+            call.error = error
+            raise
+        finally:
+            with self._lock:
+                del self._calls[key]
+            call.done.set()
+        return call.result, False
+
+def _serialize(result):
+    """
+    Turns a handler's return value into (body, status, headers)
+    """
+
+    if isinstance(result, Response):
+        return result.get_data(), result.status_code, list(result.headers.items())
+    return json.dumps(result).encode(), 200, [("Content-Type", "application/json")]
+
+def coalesced(func):
+    """
+    Decorator for GET handlers that enables coalescing of identical requests
+    """
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        flights = current_app.extensions.get("coalesce")
+        if flights is None or request.endpoint not in current_app.config["COALESCE_ROUTES"]:
+            return func(*args, **kwargs)
+        metrics = current_app.extensions["metrics"]
+        key = (request.endpoint, request.full_path)
+        (body, status, headers), shared = flights.do(
+            key, lambda: _serialize(func(*args, **kwargs))
+        )
+        if shared:
+            metrics.incr("coalesce.saved")
+        else:
+            metrics.incr("coalesce.executed")
+        return Response(body, status, headers)
+    return wrapper
+
+def init_app(app):
+    """
+    Enables coalescing if routes are listed in COALESCE_ROUTES
+    """
+
+    if app.config["COALESCE_ROUTES"]:
+        app.extensions["coalesce"] = SingleFlight()
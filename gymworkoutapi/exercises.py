@@ -0,0 +1,141 @@
+"""
+Exercise catalog.
+
+Movement names are interned in the exercise table: every normalized name
+(see models.normalize_name) is stored once, with the spelling it was
+first posted with, and the movements refer to it by its integer id. The
+movements of a workout are looked up by (workout_id, exercise_id) and a
+movement in a URL is given by its name in any spelling or by the
+exercise id, among the exercises of the workout's movements.
+
+Movements logged before the catalog existed may be spellings of the same
+exercise in one workout. They are merged into the latest one with:
+  - flask merge_movements [--chunk-size N]
+"""
+
+import click
+from flask.cli import with_appcontext
+from sqlalchemy import select, delete, func, or_
+from gymworkoutapi import db
+from gymworkoutapi.models import Exercise, Movement, Workout, normalize_name
+from gymworkoutapi.storage import insert_ignore
+from gymworkoutapi.changes import append_changes
+from gymworkoutapi.summaries import refresh_summaries
+
+def intern_exercises(session, names):
+    """
+    Returns the exercise ids of the names by normalized name, adding the
+    names that are not in the catalog yet
+    """
+
+    spellings = {}
+    for name in names:
+        spellings.setdefault(normalize_name(name), name.strip())
+    if not spellings:
+        return {}
+
+    def _lookup(keys):
+        return dict(session.execute(
+            select(Exercise.normalized_name, Exercise.id)
+            .where(Exercise.normalized_name.in_(keys))
+        ).all())
+
+    # the names are usually known, so the catalog is only written to
+    # (and SQLite's write lock taken) for new names
+    with session.no_autoflush:
+        ids = _lookup(list(spellings))
+        missing = [key for key in spellings if key not in ids]
+        if missing:
+            insert_ignore(session, Exercise.__table__, [
+                {"name": spellings[key], "normalized_name": key} for key in missing
+            ], ["normalized_name"])
+            ids.update(_lookup(missing))
+    return ids
+
+def intern_exercise(session, name):
+    """
+    Returns the Exercise of the name, added to the catalog if needed
+    """
+
+    key = normalize_name(name)
+    statement = select(Exercise).where(Exercise.normalized_name == key)
+    with session.no_autoflush:
+        exercise = session.execute(statement).scalar()
+        if exercise is None:
+            insert_ignore(session, Exercise.__table__, [
+                {"name": name.strip(), "normalized_name": key}
+            ], ["normalized_name"])
+            exercise = session.execute(statement).scalar()
+    return exercise
+
+def resolve_exercise(session, workout_id, value):
+    """
+    Returns the id of the exercise a movement URL of the workout refers
+    to, by name in any spelling or by exercise id, or None. Only the
+    exercises of the workout's movements are looked up, so the movements
+    of other workouts never change what a URL refers to. Names take
+    precedence over ids, so a movement named "100" is still found by its
+    name.
+    """
+
+    key = normalize_name(value)
+    matches = [Exercise.normalized_name == key]
+    if value.isdigit():
+        matches.append(Exercise.id == int(value))
+    rows = session.execute(
+        select(Exercise.id, Exercise.normalized_name)
+        .join(Movement, Movement.exercise_id == Exercise.id)
+        .where(Movement.workout_id == workout_id, or_(*matches))
+        .distinct()
+    ).all()
+    for exercise_id, normalized_name in rows:
+        if normalized_name == key:
+            return exercise_id
+    return rows[0][0] if rows else None
+
+def merge_movements(engine, chunk_size=1000):
+    """
+    Merges the movements of a workout that are the same exercise into the
+    latest one. The others are deleted and recorded as deleted in the
+    change log, and the summaries of their users are rebuilt. The
+    workouts are processed in id ranges of chunk_size, every range in a
+    transaction of its own. Returns the number of deleted movements.
+    """
+
+    with engine.connect() as conn:
+        last = conn.execute(select(func.max(Workout.id))).scalar() or 0
+    merged = 0
+    for start in range(1, last + 1, chunk_size):
+        in_range = Movement.workout_id.between(start, start + chunk_size - 1)
+        latest = (
+            select(func.max(Movement.id))
+            .where(in_range)
+            .group_by(Movement.workout_id, Movement.exercise_id)
+        )
+        with engine.begin() as conn:
+            rows = conn.execute(
+                select(Movement.id, Workout.user_id)
+                .join(Workout, Workout.id == Movement.workout_id)
+                .where(in_range, Movement.id.not_in(latest))
+            ).all()
+            if not rows:
+                continue
+            conn.execute(delete(Movement).where(Movement.id.in_([row.id for row in rows])))
+            append_changes(conn, [
+                {"user_id": row.user_id, "entity": "movement", "entity_id": row.id,
+                    "deleted": True}
+                for row in rows
+            ])
+            refresh_summaries(conn, {row.user_id for row in rows})
+        merged += len(rows)
+    return merged
+
+@click.command("merge_movements")
+@click.option("--chunk-size", default=1000, help="Workouts merged per transaction")
+@with_appcontext
+def merge_movements_command(chunk_size): # pragma: no cover
+    """
+    Merges the movements of a workout that are the same exercise
+    """
+
+    print(f"Merged {merge_movements(db.engine, chunk_size)} movements")
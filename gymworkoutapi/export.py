@@ -0,0 +1,271 @@
+"""
+Bulk export of the users, workouts, movements and exercises.
+
+The tables are read in chunks of EXPORT_CHUNK_ROWS rows with a streaming
+cursor (a server-side cursor on PostgreSQL) and every chunk is encoded and
+written before the next one is read, so the memory use does not depend on
+the size of the table. The formats are:
+  - csv: header row and one line per row
+  - msgpack: the column names, then one array per row (requires msgpack)
+  - arrow: Arrow IPC stream with one record batch per chunk (requires pyarrow)
+  - parquet: one row group per chunk (requires pyarrow)
+
+The exports are served from /api/export/<table>/?format= and written to
+files with:
+  - flask export_data --table movements --format csv --output movements.csv
+
+REFERENCE:
+https://docs.sqlalchemy.org/en/20/core/connections.html#engine-stream-results
+https://github.com/msgpack/msgpack/blob/master/spec.md
+https://arrow.apache.org/docs/format/Columnar.html#ipc-streaming-format
+"""
+
+import io
+import csv
+import click
+import sqlalchemy as sa
+from flask import current_app
+from flask.cli import with_appcontext
+from gymworkoutapi import db
+from gymworkoutapi.models import User, Workout, Movement, Exercise
+
+try:
+    import msgpack
+except ImportError: # pragma: no cover
+    msgpack = None
+
+try:
+    import pyarrow
+    import pyarrow.ipc
+    import pyarrow.parquet
+except ImportError: # pragma: no cover
+    pyarrow = None
+
+TABLES = {
+    "users": User.__table__,
+    "workouts": Workout.__table__,
+    "movements": Movement.__table__,
+    "exercises": Exercise.__table__
+}
+
+MEDIA_TYPES = {
+    "csv": "text/csv",
+    "msgpack": "application/x-msgpack",
+    "arrow": "application/vnd.apache.arrow.stream",
+    "parquet": "application/vnd.apache.parquet"
+}
+
+def available_formats():
+    """
+    Returns the formats whose libraries are installed
+    """
+
+    formats = ["csv"]
+    if msgpack is not None:
+        formats.append("msgpack")
+    if pyarrow is not None:
+        formats.extend(["arrow", "parquet"])
+    return formats
+
+def iter_chunks(connection, table, chunk_size):
+    """
+    Yields the rows of the table as lists of tuples of at most chunk_size
+    rows, read with a streaming cursor in primary key order
+    """
+
+    result = connection.execution_options(stream_results=True, max_row_buffer=chunk_size).execute(
+        sa.select(table).order_by(*table.primary_key.columns)
+    )
+    for partition in result.partitions(chunk_size):
+        yield [tuple(row) for row in partition]
+
+def _text(value):
+    """
+    CSV and MessagePack value of a column, dates as ISO 8601
+    """
+
+    return value.isoformat() if hasattr(value, "isoformat") else value
+
+def _encode_csv(table, chunks):
+    """
+    Encodes the chunks as CSV with a header row
+    """
+
+    buffer = io.StringIO()
+    writer = csv.writer(buffer, lineterminator="\n")
+    writer.writerow(table.columns.keys())
+    for chunk in chunks:
+        writer.writerows([[_text(value) for value in row] for row in chunk])
+        yield buffer.getvalue().encode()
+        buffer.seek(0)
+        buffer.truncate()
+    if buffer.tell():
+        yield buffer.getvalue().encode()
+
+def _encode_msgpack(table, chunks):
+    """
+    Encodes the column names and then every row as a MessagePack array
+    """
+
+    packer = msgpack.Packer()
+    yield packer.pack(table.columns.keys())
+    for chunk in chunks:
+        yield b"".join(packer.pack([_text(value) for value in row]) for row in chunk)
+
+def _arrow_schema(table):
+    """
+    Arrow schema of the table's columns
+    """
+
+    types = {
+        sa.Integer: pyarrow.int64(),
+        sa.Float: pyarrow.float64(),
+        sa.Boolean: pyarrow.bool_(),
+        sa.DateTime: pyarrow.timestamp("us"),
+        sa.String: pyarrow.string()
+    }
+    fields = []
+    for column in table.columns:
+        arrow_type = next(value for key, value in types.items() if isinstance(column.type, key))
+        fields.append(pyarrow.field(column.name, arrow_type, nullable=column.nullable))
+    return pyarrow.schema(fields)
+
+def _record_batch(schema, chunk):
+    """
+    Transposes a chunk of rows to an Arrow record batch
+    """
+
+    columns = list(zip(*chunk))
+    return pyarrow.record_batch(
+        [pyarrow.array(values, type=field.type) for values, field in zip(columns, schema)],
+        schema=schema
+    )
+
+class _ChunkSink:
+    """
+    Write-only file object for the Arrow writers, collects the bytes
+    written since they were last taken
+    """
+
+    def __init__(self):
+        self._parts = []
+        self._position = 0
+        self.closed = False
+
+    def write(self, data):
+        """
+        Appends data to the pending bytes
+        """
+
+        self._parts.append(bytes(data))
+        self._position += len(data)
+        return len(data)
+
+    def tell(self):
+        """
+        Number of bytes written in total
+        """
+
+        return self._position
+
+    def flush(self):
+        """
+        Nothing is buffered
+        """
+
+    def close(self):
+        """
+        Marks the sink closed, the pending bytes can still be taken
+        """
+
+        self.closed = True
+
+    def take(self):
+        """
+        Returns and forgets the pending bytes
+        """
+
+        data = b"".join(self._parts)
+        self._parts = []
+        return data
+
+def _encode_arrow(table, chunks, writer_class=None):
+    """
+    Encodes the chunks as an Arrow IPC stream, or with the given
+    Arrow writer class, one record batch per chunk
+    """
+
+    schema = _arrow_schema(table)
+    sink = _ChunkSink()
+    writer = (writer_class or pyarrow.ipc.RecordBatchStreamWriter)(sink, schema)
+    for chunk in chunks:
+        writer.write_batch(_record_batch(schema, chunk))
+        yield sink.take()
+    writer.close()
+    yield sink.take()
+
+def _encode_parquet(table, chunks):
+    """
+    Encodes the chunks as a Parquet file, one row group per chunk
+    """
+
+    yield from _encode_arrow(table, chunks, pyarrow.parquet.ParquetWriter)
+
+ENCODERS = {
+    "csv": _encode_csv,
+    "msgpack": _encode_msgpack,
+    "arrow": _encode_arrow,
+    "parquet": _encode_parquet
+}
+
+def stream_table(engine, name, export_format, chunk_size):
+    """
+    Yields the encoded export of the table in chunks of bytes.
+    The connection is held until the generator is exhausted or closed.
+    """
+
+    table = TABLES[name]
+    with engine.connect() as connection:
+        yield from ENCODERS[export_format](table, iter_chunks(connection, table, chunk_size))
+
+def write_table(engine, name, export_format, path, chunk_size):
+    """
+    Writes the export of the table to a file. Returns the number of rows.
+    """
+
+    table = TABLES[name]
+    rows = 0
+
+    def _counted(chunks):
+        nonlocal rows
+        for chunk in chunks:
+            rows += len(chunk)
+            yield chunk
+
+    with engine.connect() as connection, open(path, "wb") as handle:
+        chunks = _counted(iter_chunks(connection, table, chunk_size))
+        for data in ENCODERS[export_format](table, chunks):
+            handle.write(data)
+    return rows
+
+@click.command("export_data")
+@click.option("--table", "tables", type=click.Choice(list(TABLES)), multiple=True,
+    help="Table to export, all tables if not given")
+@click.option("--format", "export_format", type=click.Choice(list(MEDIA_TYPES)), default="csv")
+@click.option("--output", default=".", help="Output file, or directory when exporting all tables")
+@with_appcontext
+def export_data_command(tables, export_format, output): # pragma: no cover
+    """
+    Exports the users, workouts, movements and exercises
+    """
+
+    if export_format not in available_formats():
+        raise click.UsageError(f"{export_format} requires a library that is not installed")
+    tables = tables or list(TABLES)
+    for name in tables:
+        path = output
+        if len(tables) > 1 or output.endswith(("/", ".")):
+            path = f"{output.rstrip('/')}/{name}.{export_format}"
+        rows = write_table(db.engine, name, export_format, path,
+            current_app.config["EXPORT_CHUNK_ROWS"])
+        print(f"Exported {rows} {name} to {path}")
@@ -0,0 +1,190 @@
+"""
+Liveness and readiness probes for load balancers.
+
+  - GET /healthz: the worker process is up and serving, does not touch
+    the database
+  - GET /readyz: the database answers a probe query within
+    HEALTH_PROBE_TIMEOUT_MS and the database calls of the last
+    HEALTH_P99_WINDOW_SECONDS are fast enough. Returns 503 otherwise, so
+    that the load balancer drains the worker.
+
+The readiness report also has the connection pool status, the size of
+the SQLite WAL file and the p99 of the recent database calls. Every
+cursor execution of the application's engine is timed into the db.call
+timing of /api/metrics/, except on connections with the execution
+option timed=False: the probe query and the maintenance statements.
+The p99 is taken over time rather than over the last calls, because a
+drained worker gets few calls and would keep its slow samples.
+
+Config:
+  - HEALTH_PROBE_TIMEOUT_MS: time the probe query may take
+  - HEALTH_MAX_DB_P99_MS: p99 of the database calls above which the
+    worker is not ready, None disables the check
+  - HEALTH_P99_WINDOW_SECONDS: age of the database calls the p99 is taken of
+  - HEALTH_MAX_WAL_BYTES: WAL file size above which the worker is not
+    ready (checkpoints are falling behind), None disables the check
+
+The probes are outside /api/, so they are not rate limited, admission
+controlled or profiled.
+
+REFERENCE:
+https://docs.sqlalchemy.org/en/20/core/events.html#sqlalchemy.events.ConnectionEvents.before_cursor_execute
+https://www.sqlite.org/wal.html#avoiding_excessively_large_wal_files
+"""
+
+import os
+import time
+import threading
+from flask import Blueprint, current_app
+from sqlalchemy import event, text
+from gymworkoutapi import db
+
+health_bp = Blueprint("health", __name__)
+
+class DatabaseProbe:
+    """
+    Runs the probe query in a background thread, so that a hung database
+    does not hang the readiness check. A probe that has not finished
+    counts as failed until it does, no second one is started meanwhile.
+    """
+
+    def __init__(self):
+        self._lock = threading.Lock()
+        self._thread = None
+
+    @staticmethod
+    def _query(engine, outcome):
+        try:
+            with engine.connect() as connection:
+                connection.execution_options(timed=False)
+                connection.execute(text("SELECT 1"))
+        except Exception as error: # pylint: disable=broad-except
+            outcome["error"] = f"{type(error).__name__}: {error}"
+        else:
+            outcome["ok"] = True
+
+    def run(self, engine, timeout):
+        """
+        Runs the probe query. Returns (ok, seconds, error).
+        """
+
+        with self._lock:
+            if self._thread is not None and self._thread.is_alive():
+                return False, None, "previous probe still running"
+            outcome = {"ok": False, "error": None}
+            self._thread = threading.Thread(
+                target=self._query, args=(engine, outcome), name="health-probe", daemon=True
+            )
+            started = time.perf_counter()
+            self._thread.start()
+        self._thread.join(timeout)
+        elapsed = time.perf_counter() - started
+        if not outcome["ok"] and outcome["error"] is None:
+            return False, elapsed, f"probe query timed out after {timeout * 1000:.0f} ms"
+        return outcome["ok"], elapsed, outcome["error"]
+
+def pool_status(engine):
+    """
+    Returns the pool class and its size, checked out and overflow
+    connections where the pool class keeps them
+    """
+
+    status = {"class": type(engine.pool).__name__}
+    for name, method in (("size", "size"), ("checked_out", "checkedout"),
+            ("overflow", "overflow")):
+        if hasattr(engine.pool, method):
+            status[name] = getattr(engine.pool, method)()
+    return status
+
+def wal_size(engine):
+    """
+    Returns the size of the SQLite WAL file in bytes, 0 when there is no
+    WAL file and None for in-memory and non-SQLite databases
+    """
+
+    if engine.dialect.name != "sqlite":
+        return None
+    path = engine.url.database
+    if not path or path == ":memory:" or "mode=memory" in str(engine.url):
+        return None
+    if path.startswith("file:"):
+        path = path[5:]
+    try:
+        return os.path.getsize(path + "-wal")
+    except OSError:
+        return 0
+
+def _time_calls(engine, metrics):
+    """
+    Records the duration of every cursor execution of the engine,
+    except on the connections with the execution option timed=False
+    """
+
+    @event.listens_for(engine, "before_cursor_execute")
+    def _started(conn, *_):
+        if conn.get_execution_options().get("timed", True):
+            conn.info["health.started"] = time.perf_counter()
+
+    @event.listens_for(engine, "after_cursor_execute")
+    def _finished(conn, *_):
+        started = conn.info.pop("health.started", None)
+        if started is not None:
+            metrics.observe("db.call", time.perf_counter() - started)
+
+@health_bp.route("/healthz")
+def healthz():
+    """
+    Liveness: the process is up
+    """
+
+    return {"status": "ok", "pid": os.getpid()}
+
+@health_bp.route("/readyz")
+def readyz():
+    """
+    Readiness: the database answers in time and is not slow
+    """
+
+    config = current_app.config
+    metrics = current_app.extensions["metrics"]
+    engine = db.engine
+    ok, seconds, error = current_app.extensions["health"].run(
+        engine, config["HEALTH_PROBE_TIMEOUT_MS"] / 1000
+    )
+    p99 = metrics.percentile("db.call", 99, config["HEALTH_P99_WINDOW_SECONDS"])
+    wal_bytes = wal_size(engine)
+
+    reasons = []
+    if not ok:
+        reasons.append(error)
+    max_p99 = config["HEALTH_MAX_DB_P99_MS"]
+    if max_p99 is not None and p99 is not None and p99 * 1000 > max_p99:
+        reasons.append(f"db call p99 {p99 * 1000:.1f} ms is over {max_p99} ms")
+    max_wal = config["HEALTH_MAX_WAL_BYTES"]
+    if max_wal is not None and wal_bytes is not None and wal_bytes > max_wal:
+        reasons.append(f"WAL file {wal_bytes} bytes is over {max_wal} bytes")
+
+    if reasons:
+        metrics.incr("health.not_ready")
+    body = {
+        "status": "not ready" if reasons else "ready",
+        "reasons": reasons,
+        "database": {
+            "ok": ok,
+            "probe_ms": None if seconds is None else round(seconds * 1000, 3),
+            "call_p99_ms": None if p99 is None else round(p99 * 1000, 3)
+        },
+        "pool": pool_status(engine),
+        "wal_bytes": wal_bytes
+    }
+    return body, 503 if reasons else 200
+
+def init_app(app):
+    """
+    Registers the probe endpoints and times the database calls
+    """
+
+    app.extensions["health"] = DatabaseProbe()
+    app.register_blueprint(health_bp)
+    with app.app_context():
+        _time_calls(db.engine, app.extensions["metrics"])
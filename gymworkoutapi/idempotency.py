@@ -0,0 +1,218 @@
+"""
+Idempotency keys for the POST endpoints.
+
+A client retrying a POST sends the same Idempotency-Key header with every
+attempt. The response of the first attempt is stored in the
+idempotency_key table and the retries get the stored response back before
+routing, so a retry touches neither the main tables nor their write
+locks. A key reused for a different request is rejected with 422.
+
+Responses with a 5xx status are not stored, so those requests can be
+retried. The commits of a handler are deferred while it runs, and its
+writes are committed together with the stored response, so a retry never
+applies a write whose response was lost. Attempts running at the same
+time are not serialized, the response stored first is the one replayed.
+
+Config:
+  - IDEMPOTENCY_TTL: seconds a response is replayed
+  - IDEMPOTENCY_PURGE_INTERVAL: seconds between the deletions of the
+    expired responses, per worker
+
+Handlers opt in with the decorator:
+
+    class UserCollection(Resource):
+        method_decorators = {"post": [idempotent]}
+
+REFERENCE:
+https://datatracker.ietf.org/doc/draft-ietf-httpapi-idempotency-key-header/
+"""
+
+import io
+import json
+import time
+import hashlib
+import threading
+from datetime import timedelta
+from functools import wraps
+from contextlib import contextmanager
+from flask import request, current_app, Request, Response
+from sqlalchemy import select, delete
+from werkzeug.exceptions import HTTPException, BadRequest, UnprocessableEntity
+from werkzeug.wsgi import get_input_stream
+from gymworkoutapi import db
+from gymworkoutapi.models import IdempotencyKey, utcnow
+from gymworkoutapi.storage import insert_ignore
+
+MAX_KEY_LENGTH = 255
+
+def request_hash(method, path, body):
+    """
+    Fingerprint of a request, a key may only be replayed for the same request
+    """
+
+    digest = hashlib.sha256()
+    for part in (method.encode(), path.encode(), body):
+        digest.update(part)
+        digest.update(b"\0")
+    return digest.hexdigest()
+
+@contextmanager
+def _deferred_commits(session):
+    """
+    Makes the commits of the session only flush while the block runs
+    """
+
+    session.commit = session.flush
+    try:
+        yield
+    finally:
+        del session.commit
+
+def _serialize(result):
+    """
+    Turns a handler's return value into (body, status)
+    """
+
+    if isinstance(result, Response):
+        return result.get_data(as_text=True), result.status_code
+    if isinstance(result, tuple):
+        return json.dumps(result[0]), result[1]
+    return json.dumps(result), 200
+
+class IdempotencyStore:
+    """
+    Reads and writes the stored responses
+    """
+
+    def __init__(self, ttl, purge_interval):
+        self.ttl = ttl
+        self.purge_interval = purge_interval
+        self._purged = time.monotonic()
+        self._lock = threading.Lock()
+
+    def load(self, key):
+        """
+        Returns the unexpired stored response of the key or None
+        """
+
+        return db.session.execute(
+            select(IdempotencyKey.request_hash, IdempotencyKey.status, IdempotencyKey.body)
+            .where(
+                IdempotencyKey.key == key,
+                IdempotencyKey.created_at >= utcnow() - timedelta(seconds=self.ttl)
+            )
+        ).first()
+
+    def save(self, key, fingerprint, status, body):
+        """
+        Stores a response unless the key already has an unexpired one,
+        and deletes the expired responses if the purge interval has passed.
+        Commits the session's transaction.
+        """
+
+        cutoff = utcnow() - timedelta(seconds=self.ttl)
+        db.session.execute(delete(IdempotencyKey).where(
+            IdempotencyKey.key == key, IdempotencyKey.created_at < cutoff
+        ))
+        insert_ignore(db.session, IdempotencyKey.__table__, [{
+            "key": key,
+            "request_hash": fingerprint,
+            "status": status,
+            "body": body,
+            "created_at": utcnow()
+        }], ["key"])
+        now = time.monotonic()
+        with self._lock:
+            purge = now - self._purged >= self.purge_interval
+            if purge:
+                self._purged = now
+        if purge:
+            db.session.execute(delete(IdempotencyKey).where(IdempotencyKey.created_at < cutoff))
+        db.session.commit()
+
+class IdempotencyMiddleware:
+    """
+    WSGI middleware replaying the stored responses. It runs before
+    routing, because the URL converters already query the main tables.
+    """
+
+    def __init__(self, app, wsgi_app, store, prefix="/api/"):
+        self.app = app
+        self.wsgi_app = wsgi_app
+        self.store = store
+        self.prefix = prefix
+
+    def __call__(self, environ, start_response):
+        key = environ.get("HTTP_IDEMPOTENCY_KEY")
+        if (key is None or len(key) > MAX_KEY_LENGTH or environ.get("REQUEST_METHOD") != "POST"
+                or not environ.get("PATH_INFO", "").startswith(self.prefix)):
+            return self.wsgi_app(environ, start_response)
+
+        # the body is needed for the fingerprint, the application
+        # reads it again from a buffer
+        body = get_input_stream(environ).read()
+        environ["wsgi.input"] = io.BytesIO(body)
+        environ["CONTENT_LENGTH"] = str(len(body))
+        environ.pop("wsgi.input_terminated", None)
+
+        with self.app.app_context():
+            stored = self.store.load(key)
+        if stored is None:
+            return self.wsgi_app(environ, start_response)
+
+        metrics = self.app.extensions["metrics"]
+        # the decoded path, the same that the decorator sees as request.path
+        path = Request(environ, shallow=True).path
+        if stored.request_hash != request_hash("POST", path, body):
+            metrics.incr("idempotency.mismatched")
+            error = UnprocessableEntity("Idempotency-Key was used for a different request")
+            response = Response(json.dumps({"message": error.description}), error.code,
+                mimetype="application/json")
+        else:
+            metrics.incr("idempotency.replayed")
+            response = Response(stored.body, stored.status, mimetype="application/json",
+                headers={"Idempotent-Replayed": "true"})
+        return response(environ, start_response)
+
+def idempotent(func):
+    """
+    Decorator for POST handlers that stores the response of the
+    requests sent with an Idempotency-Key header
+    """
+
+    @wraps(func)
+    def wrapper(*args, **kwargs):
+        key = request.headers.get("Idempotency-Key")
+        if key is None:
+            return func(*args, **kwargs)
+        if not key or len(key) > MAX_KEY_LENGTH:
+            raise BadRequest(description=f"Idempotency-Key must be 1-{MAX_KEY_LENGTH} characters")
+        store = current_app.extensions["idempotency"]
+        fingerprint = request_hash(request.method, request.path, request.get_data())
+        try:
+            with _deferred_commits(db.session()):
+                result = func(*args, **kwargs)
+        except HTTPException as error:
+            db.session.rollback()
+            if error.code < 500:
+                store.save(key, fingerprint, error.code,
+                    json.dumps({"message": error.description}))
+            raise
+        body, status = _serialize(result)
+        if status < 500:
+            store.save(key, fingerprint, status, body)
+        else:
+            db.session.commit()
+        return result
+    return wrapper
+
+def init_app(app):
+    """
+    Wraps the application with the replaying middleware
+    """
+
+    store = IdempotencyStore(
+        app.config["IDEMPOTENCY_TTL"], app.config["IDEMPOTENCY_PURGE_INTERVAL"]
+    )
+    app.extensions["idempotency"] = store
+    app.wsgi_app = IdempotencyMiddleware(app, app.wsgi_app, store)
@@ -0,0 +1,302 @@
+"""
+SQLite database maintenance.
+
+Deleted users, workouts and movements leave free pages in the database
+file, the query planner has no statistics until ANALYZE is run and the
+WAL file grows while readers keep checkpoints from completing. The
+maintenance run:
+  - deletes the expired idempotency keys
+  - frees at most MAINTENANCE_VACUUM_PAGES pages per run with PRAGMA
+    incremental_vacuum, so the write lock is held briefly
+  - runs ANALYZE on a database without statistics and PRAGMA optimize
+    on one with statistics
+  - checkpoints and truncates the WAL file
+
+Vacuuming only starts when the free pages are at least
+MAINTENANCE_FREE_RATIO of the file and the checkpoint when the WAL file
+is at least MAINTENANCE_CHECKPOINT_WAL_BYTES, unless forced. The file
+size, free pages and the query plans of the main read paths are reported
+before and after. Run it with:
+  - flask maintain_db [--force] [--full]
+
+Incremental vacuuming needs auto_vacuum=INCREMENTAL, which new databases
+have. An older database is converted by a full VACUUM, which rewrites
+the file and holds the exclusive lock for the whole rewrite, so it is
+only run by flask maintain_db --full. Until then the vacuum step is
+skipped.
+
+With MAINTENANCE_INTERVAL set, every worker runs the maintenance every
+MAINTENANCE_INTERVAL seconds in a background thread, never with a full
+VACUUM. A lock file (MAINTENANCE_LOCK_PATH, instance/maintenance.lock
+by default) keeps workers from running it at the same time. The
+results are reported at /api/metrics/ (maintenance.*).
+
+PostgreSQL is maintained by its autovacuum daemon, nothing is done there.
+
+REFERENCE:
+https://www.sqlite.org/pragma.html#pragma_incremental_vacuum
+https://www.sqlite.org/pragma.html#pragma_optimize
+https://www.sqlite.org/pragma.html#pragma_wal_checkpoint
+https://www.sqlite.org/lang_vacuum.html
+"""
+
+import os
+import time
+import atexit
+import threading
+from datetime import timedelta
+import click
+from flask import current_app
+from flask.cli import with_appcontext
+from sqlalchemy import delete, inspect
+from gymworkoutapi import db
+from gymworkoutapi.models import IdempotencyKey, utcnow
+from gymworkoutapi.health import wal_size
+
+try:
+    import fcntl
+except ImportError: # pragma: no cover
+    fcntl = None
+
+AUTO_VACUUM_INCREMENTAL = 2
+
+PLAN_QUERIES = {
+    "user by name": 'SELECT * FROM "user" WHERE username = \'name\'',
+    "workouts of user": "SELECT * FROM workout WHERE user_id = 1 ORDER BY workout_name",
+    "favorite workouts": ("SELECT * FROM workout WHERE user_id = 1 AND favorite = 1 "
+        "ORDER BY workout_name"),
+    "exercise by name": "SELECT id FROM exercise WHERE normalized_name = 'name'",
+    "movement of workout": "SELECT * FROM movement WHERE workout_id = 1 AND exercise_id = 1",
+    "changes of user": "SELECT * FROM change_log WHERE user_id = 1 AND id > 0 ORDER BY id"
+}
+
+def database_stats(connection):
+    """
+    Returns the page size, page count, free pages, file size and
+    auto_vacuum mode of the database
+    """
+
+    stats = {
+        name: connection.exec_driver_sql(f"PRAGMA {name}").scalar()
+        for name in ("page_size", "page_count", "freelist_count", "auto_vacuum")
+    }
+    stats["db_bytes"] = stats["page_size"] * stats["page_count"]
+    stats["wal_bytes"] = wal_size(connection.engine)
+    return stats
+
+def query_plans(connection):
+    """
+    Returns the EXPLAIN QUERY PLAN details of the PLAN_QUERIES
+    """
+
+    return {
+        name: [row[-1] for row in connection.exec_driver_sql("EXPLAIN QUERY PLAN " + sql)]
+        for name, sql in PLAN_QUERIES.items()
+    }
+
+def _free_ratio(stats):
+    return stats["freelist_count"] / stats["page_count"] if stats["page_count"] else 0.0
+
+def run_maintenance(engine, free_ratio=0.1, vacuum_pages=1000,
+        checkpoint_wal_bytes=16 * 1024 * 1024, idempotency_ttl=None, force=False, full=False):
+    """
+    Runs the maintenance steps whose thresholds are met, or all of them
+    if force is set. full runs a full VACUUM instead of an incremental
+    one, which also converts a database to auto_vacuum=INCREMENTAL.
+    Without full, the vacuum of a database that is not incremental is
+    skipped. Returns a report with the steps taken and the database
+    stats and changed query plans, or None for databases other than SQLite.
+    """
+
+    if engine.dialect.name != "sqlite":
+        return None
+    started = time.perf_counter()
+    steps = {}
+    # VACUUM can't run in a transaction and incremental_vacuum has to be
+    # stepped to the end, so the statements run in autocommit mode. They
+    # are not timed into the db.call p99 of the readiness probe.
+    with engine.connect().execution_options(isolation_level="AUTOCOMMIT",
+            timed=False) as connection:
+        before = database_stats(connection)
+        plans_before = query_plans(connection)
+
+        if idempotency_ttl is not None:
+            steps["idempotency_purged"] = connection.execute(delete(IdempotencyKey).where(
+                IdempotencyKey.created_at < utcnow() - timedelta(seconds=idempotency_ttl)
+            )).rowcount
+
+        if full or force or _free_ratio(before) >= free_ratio:
+            if full:
+                connection.exec_driver_sql("PRAGMA auto_vacuum=INCREMENTAL")
+                connection.exec_driver_sql("VACUUM")
+                steps["vacuum"] = "full"
+            elif before["auto_vacuum"] != AUTO_VACUUM_INCREMENTAL:
+                # a full VACUUM would lock the database for the whole rewrite
+                steps["vacuum"] = "skipped"
+            elif before["freelist_count"]:
+                driver = connection.connection.driver_connection
+                driver.executescript(f"PRAGMA incremental_vacuum({vacuum_pages or 0})")
+                steps["vacuum"] = "incremental"
+
+        if inspect(connection).has_table("sqlite_stat1") and not force:
+            connection.exec_driver_sql("PRAGMA optimize")
+            steps["analyze"] = "optimize"
+        else:
+            connection.exec_driver_sql("ANALYZE")
+            steps["analyze"] = "analyze"
+
+        wal_bytes = wal_size(engine)
+        if force or "vacuum" in steps or (wal_bytes or 0) >= checkpoint_wal_bytes:
+            busy, log, checkpointed = connection.exec_driver_sql(
+                "PRAGMA wal_checkpoint(TRUNCATE)"
+            ).one()
+            steps["checkpoint"] = {"busy": bool(busy), "frames": log, "checkpointed": checkpointed}
+
+        after = database_stats(connection)
+        plans_after = query_plans(connection)
+
+    return {
+        "steps": steps,
+        "before": before,
+        "after": after,
+        "plan_changes": {
+            name: {"before": plans_before[name], "after": plans_after[name]}
+            for name in PLAN_QUERIES if plans_before[name] != plans_after[name]
+        },
+        "seconds": round(time.perf_counter() - started, 3)
+    }
+
+def _config_options(config):
+    """
+    run_maintenance options from the application config
+    """
+
+    return {
+        "free_ratio": config["MAINTENANCE_FREE_RATIO"],
+        "vacuum_pages": config["MAINTENANCE_VACUUM_PAGES"],
+        "checkpoint_wal_bytes": config["MAINTENANCE_CHECKPOINT_WAL_BYTES"],
+        "idempotency_ttl": config["IDEMPOTENCY_TTL"]
+    }
+
+class MaintenanceScheduler:
+    """
+    Runs the maintenance every interval seconds in a background thread
+    """
+
+    def __init__(self, app, interval):
+        self.app = app
+        self.interval = interval
+        self.last_report = None
+        self._lock = threading.Lock()
+        self._stopping = threading.Event()
+        self._thread = None
+        self._pid = None
+
+    def ensure_started(self):
+        """
+        Starts the scheduler thread in the current process. Threads do not
+        survive a fork, so this is done lazily on the first request.
+        """
+
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._stopping.clear()
+            self._thread = threading.Thread(target=self._run, name="db-maintenance", daemon=True)
+            self._thread.start()
+            atexit.register(self.stop)
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            self.run_once()
+
+    def run_once(self):
+        """
+        Runs the maintenance unless another worker is running it.
+        Returns the report or None.
+        """
+
+        path = self.app.config["MAINTENANCE_LOCK_PATH"] or os.path.join(
+            self.app.instance_path, "maintenance.lock"
+        )
+        os.makedirs(os.path.dirname(path) or ".", exist_ok=True)
+        with open(path, "w", encoding="utf-8") as lock_file:
+            if fcntl is not None:
+                try:
+                    fcntl.flock(lock_file, fcntl.LOCK_EX | fcntl.LOCK_NB)
+                except OSError:
+                    return None
+            with self.app.app_context():
+                metrics = self.app.extensions["metrics"]
+                try:
+                    report = run_maintenance(db.engine, **_config_options(self.app.config))
+                except Exception: # pylint: disable=broad-except
+                    metrics.incr("maintenance.failed")
+                    return None
+        if report is not None:
+            self.last_report = report
+            metrics.incr("maintenance.runs")
+            metrics.observe("maintenance.duration", report["seconds"])
+            metrics.gauge("maintenance.db_bytes", report["after"]["db_bytes"])
+            metrics.gauge("maintenance.free_pages", report["after"]["freelist_count"])
+            metrics.gauge("maintenance.plan_changes", len(report["plan_changes"]))
+        return report
+
+    def stop(self):
+        """
+        Stops the scheduler thread
+        """
+
+        if self._pid != os.getpid() or self._thread is None:
+            return
+        self._stopping.set()
+        self._thread.join()
+        self._thread = None
+        self._pid = None
+
+def _print_stats(title, stats):
+    print(f"{title}: {stats['db_bytes']} bytes, {stats['freelist_count']} free pages"
+        f" of {stats['page_count']}, WAL {stats['wal_bytes']} bytes")
+
+@click.command("maintain_db")
+@click.option("--force", is_flag=True, help="Run every step regardless of the thresholds")
+@click.option("--full", is_flag=True, help="Run a full VACUUM")
+@with_appcontext
+def maintain_db_command(force, full): # pragma: no cover
+    """
+    Vacuums, analyzes and checkpoints the SQLite database
+    """
+
+    report = run_maintenance(db.engine, force=force, full=full,
+        **_config_options(current_app.config))
+    if report is None:
+        print("Nothing to do, only SQLite databases are maintained")
+        return
+    _print_stats("Before", report["before"])
+    _print_stats("After", report["after"])
+    print("Steps: " + ", ".join(f"{name}={value}" for name, value in report["steps"].items()))
+    if report["steps"].get("vacuum") == "skipped":
+        print("The database is not incremental, convert it once with: flask maintain_db --full")
+    for name, plans in report["plan_changes"].items():
+        print(f"Plan of {name} changed:")
+        print("  before: " + "; ".join(plans["before"]))
+        print("  after:  " + "; ".join(plans["after"]))
+    print(f"Done in {report['seconds']} s")
+
+def init_app(app):
+    """
+    Creates the scheduler if MAINTENANCE_INTERVAL is set, it is started
+    by the first request of every worker process
+    """
+
+    if not app.config["MAINTENANCE_INTERVAL"]:
+        return
+    with app.app_context():
+        if db.engine.dialect.name != "sqlite":
+            return
+    scheduler = MaintenanceScheduler(app, app.config["MAINTENANCE_INTERVAL"])
+    app.extensions["maintenance"] = scheduler
+    app.before_request(scheduler.ensure_started)
@@ -0,0 +1,108 @@
+"""
+In-process metrics registry.
+
+Counters, gauges and rolling timing windows shared by the application
+subsystems. A snapshot is served from /api/metrics/.
+"""
+
+import time
+import threading
+from collections import deque
+from flask import current_app
+
+class Metrics:
+    """
+    Thread-safe store for counters, gauges and timings
+    """
+
+    def __init__(self, window=1024):
+        self._lock = threading.Lock()
+        self._window = window
+        self.counters = {}
+        self.gauges = {}
+        self.timings = {}
+
+    def incr(self, name, value=1):
+        """
+        Increments a counter
+        """
+
+        with self._lock:
+            self.counters[name] = self.counters.get(name, 0) + value
+
+    def gauge(self, name, value):
+        """
+        Sets a gauge to the given value
+        """
+
+        with self._lock:
+            self.gauges[name] = value
+
+    def observe(self, name, seconds):
+        """
+        Records a duration into the rolling window of the timing,
+        with the time it was recorded at
+        """
+
+        with self._lock:
+            if name not in self.timings:
+                self.timings[name] = deque(maxlen=self._window)
+            self.timings[name].append((time.monotonic(), seconds))
+
+    def percentile(self, name, percent, max_age=None):
+        """
+        Returns the given percentile of a timing window in seconds, of the
+        durations recorded in the last max_age seconds if given, or None if
+        nothing has been recorded
+        """
+
+        since = None if max_age is None else time.monotonic() - max_age
+        with self._lock:
+            values = sorted(
+                seconds for recorded, seconds in self.timings.get(name, ())
+                if since is None or recorded >= since
+            )
+        if not values:
+            return None
+        index = min(len(values) - 1, int(len(values) * percent / 100))
+        return values[index]
+
+    def snapshot(self):
+        """
+        Returns all metrics as a JSON serializable dictionary
+        """
+
+        with self._lock:
+            timings = {
+                name: sorted(seconds for _, seconds in samples)
+                for name, samples in self.timings.items()
+            }
+            snapshot = {
+                "counters": dict(self.counters),
+                "gauges": dict(self.gauges),
+                "timings": {}
+            }
+        for name, values in timings.items():
+            if not values:
+                continue
+            snapshot["timings"][name] = {
+                "count": len(values),
+                "p50": values[len(values) // 2],
+                "p99": values[min(len(values) - 1, int(len(values) * 0.99))],
+                "max": values[-1]
+            }
+        return snapshot
+
+def init_app(app):
+    """
+    Attaches a metrics registry to the application
+    """
+
+    app.extensions["metrics"] = Metrics()
+
+def get_metrics():
+    """
+    Returns the metrics registry of the current application
+    """
+
+    return current_app.extensions["metrics"]
@@ -0,0 +1,293 @@
+"""
+Schema migrations.
+
+Every migration is a module vNNNN_<name>.py in this package with an
+upgrade(migrator) function. The applied versions are recorded in the
+schema_version table. Migrations are run with:
+  - flask upgrade_db [--to N]
+  - flask db_version
+  - flask stamp_db [--to N]
+
+A migration runs in its own transaction, except for Migrator.backfill
+and Migrator.chunks, which commit after every chunk so that the SQLite
+write lock is not held for the whole run.
+
+REFERENCE:
+https://www.sqlite.org/lang_altertable.html#otheralter
+https://alembic.sqlalchemy.org/en/latest/batch.html
+"""
+
+import pkgutil
+import importlib
+import click
+import sqlalchemy as sa
+from flask.cli import with_appcontext
+from gymworkoutapi import db
+from gymworkoutapi.models import utcnow
+
+version_table = sa.Table(
+    "schema_version", sa.MetaData(),
+    sa.Column("version", sa.Integer, primary_key=True),
+    sa.Column("name", sa.String(128), nullable=False),
+    sa.Column("applied_at", sa.DateTime, nullable=False)
+)
+
+def migrations():
+    """
+    Returns the migration modules as (version, name, module) sorted by version
+    """
+
+    found = []
+    for info in pkgutil.iter_modules(__path__):
+        if info.name.startswith("v") and info.name[1:5].isdigit():
+            module = importlib.import_module(f"{__name__}.{info.name}")
+            found.append((int(info.name[1:5]), info.name[6:], module))
+    return sorted(found, key=lambda item: item[0])
+
+def head():
+    """
+    Returns the latest migration version
+    """
+
+    return migrations()[-1][0]
+
+class Migrator:
+    """
+    Operations available to the migrations
+    """
+
+    def __init__(self, connection):
+        self.conn = connection
+        self.dialect = connection.dialect.name
+
+    def execute(self, statement, *args):
+        """
+        Executes a statement in the migration's transaction
+        """
+
+        if isinstance(statement, str):
+            statement = sa.text(statement)
+        return self.conn.execute(statement, *args)
+
+    def create_table(self, table):
+        """
+        Creates a table with its indexes
+        """
+
+        table.create(self.conn, checkfirst=True)
+
+    def add_column(self, table_name, column):
+        """
+        Adds a column to an existing table. A NOT NULL column needs
+        a server default, which SQLite applies without rewriting the table.
+        """
+
+        column_type = column.type.compile(dialect=self.conn.dialect)
+        ddl = f'ALTER TABLE "{table_name}" ADD COLUMN "{column.name}" {column_type}'
+        if column.server_default is not None:
+            ddl += f" DEFAULT {column.server_default.arg}"
+        if not column.nullable:
+            ddl += " NOT NULL"
+        self.execute(ddl)
+
+    def create_index(self, index):
+        """
+        Creates an index. On PostgreSQL the index is built concurrently,
+        so writes to the table are not blocked while it is built.
+        """
+
+        if self.dialect == "postgresql":
+            # CREATE INDEX CONCURRENTLY can't run in a transaction, so it
+            # runs on a connection of its own in autocommit mode. The
+            # migration's connection stays open in its isolation level.
+            self.conn.commit()
+            index.dialect_options["postgresql"]["concurrently"] = True
+            with self.conn.engine.connect() as conn:
+                conn.execution_options(isolation_level="AUTOCOMMIT")
+                index.create(conn, checkfirst=True)
+        else:
+            index.create(self.conn, checkfirst=True)
+
+    def batch_rebuild(self, table, copy_columns=None):
+        """
+        Rebuilds a table to the given definition for changes SQLite can't
+        make with ALTER TABLE (dropping columns, changing constraints).
+        A new table is created, the rows are copied, the old table is
+        dropped and the new one renamed. On PostgreSQL the sequence of the
+        autoincrement key continues after the copied keys.
+        The tables referenced by the table's foreign keys must be defined
+        in the same MetaData. copy_columns maps the new column
+        names to SQL expressions of the old table, the common columns are
+        copied if it is not given.
+        """
+
+        if self.dialect == "sqlite":
+            # the table is dropped, so SQLite must not enforce the
+            # foreign keys that point to it while it is rebuilt
+            self.conn.commit()
+            foreign_keys = self.execute("PRAGMA foreign_keys").scalar()
+            self.execute("PRAGMA foreign_keys=OFF")
+
+        inspector = sa.inspect(self.conn)
+        old_columns = {column["name"] for column in inspector.get_columns(table.name)}
+        if copy_columns is None:
+            copy_columns = {
+                column.name: f'"{column.name}"'
+                for column in table.columns if column.name in old_columns
+            }
+
+        # the copy lives in the table's metadata, so that its foreign
+        # keys resolve to the tables defined next to it
+        temp_name = f"_{table.name}_new"
+        temp = table.to_metadata(table.metadata, name=temp_name)
+        for index in list(temp.indexes):
+            temp.indexes.discard(index)
+        temp.create(self.conn)
+        table.metadata.remove(temp)
+        targets = ", ".join(f'"{name}"' for name in copy_columns)
+        sources = ", ".join(copy_columns.values())
+        self.execute(f'INSERT INTO "{temp_name}" ({targets}) SELECT {sources} FROM "{table.name}"')
+        self.execute(f'DROP TABLE "{table.name}"')
+        self.execute(f'ALTER TABLE "{temp_name}" RENAME TO "{table.name}"')
+        for index in table.indexes:
+            index.create(self.conn, checkfirst=True)
+
+        key = table.autoincrement_column
+        if self.dialect == "postgresql" and key is not None:
+            # the copy's sequence starts at 1 although the copied rows
+            # kept their keys, so it is moved past them
+            self.execute(
+                f'SELECT setval(pg_get_serial_sequence(:table, :column), '
+                f'COALESCE(MAX("{key.name}"), 0) + 1, false) FROM "{table.name}"',
+                {"table": f'"{table.name}"', "column": key.name}
+            )
+
+        if self.dialect == "sqlite":
+            if self.execute(f'PRAGMA foreign_key_check("{table.name}")').first() is not None:
+                raise RuntimeError(f"Foreign key violation after rebuilding {table.name}")
+            self.conn.commit()
+            if foreign_keys:
+                self.execute("PRAGMA foreign_keys=ON")
+
+    def chunks(self, table_name, chunk_size=1000, key="id"):
+        """
+        Yields (start, stop) ranges of the integer key column that cover
+        the table, chunk_size keys each.
+        The migration's transaction is committed first and the work done
+        for every range is committed after it, so readers and writers can
+        proceed between the chunks.
+        """
+
+        self.conn.commit()
+        bounds = self.execute(f'SELECT MIN("{key}"), MAX("{key}") FROM "{table_name}"').one()
+        if bounds[0] is None:
+            return
+        start = bounds[0]
+        while start <= bounds[1]:
+            yield start, start + chunk_size
+            self.conn.commit()
+            start += chunk_size
+
+    def backfill(self, table_name, assignments, where="1=1", chunk_size=1000, params=None,
+            key="id"):
+        """
+        Runs UPDATE table SET assignments WHERE where in chunks of the
+        integer key column, every chunk committed on its own.
+        The statement must be idempotent, because a failed
+        run is resumed by running the migration again.
+        Returns the number of chunks.
+        """
+
+        chunks = 0
+        for start, stop in self.chunks(table_name, chunk_size, key):
+            self.execute(
+                f'UPDATE "{table_name}" SET {assignments} '
+                f'WHERE "{key}" >= :start AND "{key}" < :stop AND ({where})',
+                dict(params or {}, start=start, stop=stop)
+            )
+            chunks += 1
+        return chunks
+
+def current_version(connection):
+    """
+    Returns the applied version of the database, 0 for an empty database.
+    A database created before migrations existed is at version 1.
+    """
+
+    inspector = sa.inspect(connection)
+    if not inspector.has_table("schema_version"):
+        return 1 if inspector.has_table("user") else 0
+    version = connection.execute(sa.select(sa.func.max(version_table.c.version))).scalar()
+    return version or 0
+
+def stamp(connection, version):
+    """
+    Records the database as being at the given version without running
+    any migrations
+    """
+
+    version_table.create(connection, checkfirst=True)
+    connection.execute(version_table.delete())
+    for number, name, _ in migrations():
+        if number <= version:
+            connection.execute(version_table.insert().values(
+                version=number, name=name, applied_at=utcnow()
+            ))
+
+def upgrade(engine, target=None):
+    """
+    Runs the migrations after the current version up to the target
+    version (the latest by default). Returns the applied versions.
+    """
+
+    target = head() if target is None else target
+    applied = []
+    with engine.connect() as connection:
+        version = current_version(connection)
+        if not sa.inspect(connection).has_table("schema_version"):
+            stamp(connection, version)
+            connection.commit()
+        for number, name, module in migrations():
+            if version < number <= target:
+                module.upgrade(Migrator(connection))
+                connection.execute(version_table.insert().values(
+                    version=number, name=name, applied_at=utcnow()
+                ))
+                connection.commit()
+                applied.append(number)
+    return applied
+
+@click.command("upgrade_db")
+@click.option("--to", "target", type=int, default=None, help="Target version")
+@with_appcontext
+def upgrade_db_command(target): # pragma: no cover
+    """
+    Upgrades the database schema
+    """
+
+    applied = upgrade(db.engine, target)
+    if applied:
+        print("Applied migrations: " + ", ".join(str(number) for number in applied))
+    else:
+        print("Database is up to date")
+
+@click.command("db_version")
+@with_appcontext
+def db_version_command(): # pragma: no cover
+    """
+    Prints the database schema version
+    """
+
+    with db.engine.connect() as connection:
+        print(f"Database version {current_version(connection)}, latest {head()}")
+
+@click.command("stamp_db")
+@click.option("--to", "target", type=int, default=None, help="Version to record")
+@with_appcontext
+def stamp_db_command(target): # pragma: no cover
+    """
+    Records the database schema version without running migrations
+    """
+
+    with db.engine.begin() as connection:
+        stamp(connection, head() if target is None else target)
@@ -0,0 +1,40 @@
+"""
+Initial schema: users, workouts and movements
+"""
+
+import sqlalchemy as sa
+
+def upgrade(migrator):
+    """
+    Creates the user, workout and movement tables
+    """
+
+    metadata = sa.MetaData()
+    user = sa.Table(
+        "user", metadata,
+        sa.Column("id", sa.Integer, primary_key=True, autoincrement=True, unique=True),
+        sa.Column("username", sa.String(64), nullable=False, unique=True),
+        sa.Column("height", sa.Float, nullable=False),
+        sa.Column("weight", sa.Float, nullable=False),
+        sa.Column("bmi", sa.Float, nullable=True),
+        sa.Column("mean_bmi", sa.Float, nullable=True)
+    )
+    workout = sa.Table(
+        "workout", metadata,
+        sa.Column("id", sa.Integer, primary_key=True, autoincrement=True, unique=True),
+        sa.Column("user_id", sa.Integer, sa.ForeignKey("user.id", ondelete="CASCADE"),
+            nullable=False),
+        sa.Column("workout_name", sa.String(64), nullable=False, unique=True),
+        sa.Column("favorite", sa.Boolean, nullable=False)
+    )
+    movement = sa.Table(
+        "movement", metadata,
+        sa.Column("id", sa.Integer, primary_key=True, autoincrement=True, unique=True),
+        sa.Column("workout_id", sa.Integer, sa.ForeignKey("workout.id", ondelete="CASCADE"),
+            nullable=False),
+        sa.Column("movement_name", sa.String(64), nullable=False),
+        sa.Column("sets", sa.Float, nullable=False),
+        sa.Column("reps", sa.Float, nullable=False)
+    )
+    for table in (user, workout, movement):
+        migrator.create_table(table)
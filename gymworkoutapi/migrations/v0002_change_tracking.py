@@ -0,0 +1,52 @@
+"""
+Change tracking for delta sync: updated_at columns and the change log
+"""
+
+import sqlalchemy as sa
+
+TABLES = ("user", "workout", "movement")
+EPOCH = "'1970-01-01 00:00:00.000000'"
+
+# (table, user id expression, FROM clause) of the change log rows
+# recording the existing entities, so that the first sync returns them
+EXISTING = (
+    ("user", "t.id", '"user" t'),
+    ("workout", "t.user_id", "workout t"),
+    ("movement", "w.user_id", "movement t JOIN workout w ON w.id = t.workout_id")
+)
+
+def upgrade(migrator):
+    """
+    Adds updated_at to users, workouts and movements, backfills it in
+    chunks, creates the change log table and records the existing
+    users, workouts and movements in it
+    """
+
+    for table_name in TABLES:
+        migrator.add_column(table_name, sa.Column(
+            "updated_at", sa.DateTime, nullable=False, server_default=sa.text(EPOCH)
+        ))
+
+    metadata = sa.MetaData()
+    change_log = sa.Table(
+        "change_log", metadata,
+        sa.Column("id", sa.Integer, primary_key=True, autoincrement=True),
+        sa.Column("user_id", sa.Integer, nullable=False),
+        sa.Column("entity", sa.String(16), nullable=False),
+        sa.Column("entity_id", sa.Integer, nullable=False),
+        sa.Column("deleted", sa.Boolean, nullable=False),
+        sa.Index("ix_change_log_user_id_id", "user_id", "id")
+    )
+    migrator.create_table(change_log)
+
+    for table_name in TABLES:
+        migrator.backfill(table_name, "updated_at = CURRENT_TIMESTAMP", f"updated_at = {EPOCH}")
+
+    for entity, user_id, source in EXISTING:
+        for start, stop in migrator.chunks(entity):
+            migrator.execute(
+                "INSERT INTO change_log (user_id, entity, entity_id, deleted) "
+                f"SELECT {user_id}, :entity, t.id, :deleted FROM {source} "
+                "WHERE t.id >= :start AND t.id < :stop ORDER BY t.id",
+                {"entity": entity, "deleted": False, "start": start, "stop": stop}
+            )
@@ -0,0 +1,33 @@
+"""
+Indexes for filtering and sorting workouts and looking up movements
+"""
+
+import sqlalchemy as sa
+
+def upgrade(migrator):
+    """
+    Creates the composite workout and movement indexes
+    """
+
+    metadata = sa.MetaData()
+    workout = sa.Table(
+        "workout", metadata,
+        sa.Column("user_id", sa.Integer),
+        sa.Column("favorite", sa.Boolean),
+        sa.Column("workout_name", sa.String(64))
+    )
+    movement = sa.Table(
+        "movement", metadata,
+        sa.Column("workout_id", sa.Integer),
+        sa.Column("movement_name", sa.String(64))
+    )
+    migrator.create_index(sa.Index(
+        "ix_workout_user_id_favorite_workout_name",
+        workout.c.user_id, workout.c.favorite, workout.c.workout_name
+    ))
+    migrator.create_index(sa.Index(
+        "ix_workout_user_id_workout_name", workout.c.user_id, workout.c.workout_name
+    ))
+    migrator.create_index(sa.Index(
+        "ix_movement_workout_id_movement_name", movement.c.workout_id, movement.c.movement_name
+    ))
@@ -0,0 +1,22 @@
+"""
+Precomputed per-user summary documents
+"""
+
+import sqlalchemy as sa
+
+def upgrade(migrator):
+    """
+    Creates the user summary table. The documents of existing users
+    are built on their first read.
+    """
+
+    metadata = sa.MetaData()
+    sa.Table("user", metadata, sa.Column("id", sa.Integer, primary_key=True))
+    user_summary = sa.Table(
+        "user_summary", metadata,
+        sa.Column("user_id", sa.Integer, sa.ForeignKey("user.id", ondelete="CASCADE"),
+            primary_key=True, autoincrement=False),
+        sa.Column("document", sa.JSON, nullable=False),
+        sa.Column("updated_at", sa.DateTime, nullable=False)
+    )
+    migrator.create_table(user_summary)
@@ -0,0 +1,21 @@
+"""
+Stored responses of the POST requests sent with an Idempotency-Key
+"""
+
+import sqlalchemy as sa
+
+def upgrade(migrator):
+    """
+    Creates the idempotency key table
+    """
+
+    idempotency_key = sa.Table(
+        "idempotency_key", sa.MetaData(),
+        sa.Column("key", sa.String(255), primary_key=True),
+        sa.Column("request_hash", sa.String(64), nullable=False),
+        sa.Column("status", sa.Integer, nullable=False),
+        sa.Column("body", sa.Text, nullable=False),
+        sa.Column("created_at", sa.DateTime, nullable=False),
+        sa.Index("ix_idempotency_key_created_at", "created_at")
+    )
+    migrator.create_table(idempotency_key)
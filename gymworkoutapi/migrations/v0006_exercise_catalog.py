@@ -0,0 +1,89 @@
+"""
+Exercise catalog: movement names interned in the exercise table
+"""
+
+import logging
+import sqlalchemy as sa
+from gymworkoutapi.models import normalize_name
+
+CHUNK_SIZE = 1000
+
+def upgrade(migrator):
+    """
+    Creates the exercise table, dedupes the movement names into it in one
+    chunked pass over the movements, setting movement.exercise_id, and
+    rebuilds the movement table without the name column.
+    Movements of a workout whose names are spellings of the same exercise
+    are kept, their number is logged and they can be merged afterwards
+    with flask merge_movements.
+    A failed run is resumed by running the migration again.
+    """
+
+    metadata = sa.MetaData()
+    sa.Table("workout", metadata, sa.Column("id", sa.Integer, primary_key=True))
+    exercise = sa.Table(
+        "exercise", metadata,
+        sa.Column("id", sa.Integer, primary_key=True, autoincrement=True),
+        sa.Column("name", sa.String(64), nullable=False),
+        sa.Column("normalized_name", sa.String(128), nullable=False, unique=True)
+    )
+    movement = sa.Table(
+        "movement", metadata,
+        sa.Column("id", sa.Integer, primary_key=True, autoincrement=True, unique=True),
+        sa.Column("workout_id", sa.Integer, sa.ForeignKey("workout.id", ondelete="CASCADE"),
+            nullable=False),
+        sa.Column("exercise_id", sa.Integer, sa.ForeignKey("exercise.id"), nullable=False),
+        sa.Column("sets", sa.Float, nullable=False),
+        sa.Column("reps", sa.Float, nullable=False),
+        sa.Column("updated_at", sa.DateTime, nullable=False),
+        sa.Index("ix_movement_workout_id_exercise_id", "workout_id", "exercise_id")
+    )
+    # the spellings seen so far and their exercises, kept in the database
+    # so that a resumed run knows them
+    name_map = sa.Table(
+        "_exercise_name_map", sa.MetaData(),
+        sa.Column("movement_name", sa.String(64), primary_key=True),
+        sa.Column("exercise_id", sa.Integer, nullable=False)
+    )
+    migrator.create_table(exercise)
+    migrator.create_table(name_map)
+    columns = {column["name"] for column in sa.inspect(migrator.conn).get_columns("movement")}
+    if "exercise_id" not in columns:
+        migrator.add_column("movement", sa.Column("exercise_id", sa.Integer, nullable=True))
+
+    known = dict(migrator.execute(
+        sa.select(name_map.c.movement_name, name_map.c.exercise_id)
+    ).all())
+    keys = dict(migrator.execute(sa.select(exercise.c.normalized_name, exercise.c.id)).all())
+    for start, stop in migrator.chunks("movement", CHUNK_SIZE):
+        names = migrator.execute(
+            'SELECT DISTINCT movement_name FROM movement WHERE id >= :start AND id < :stop',
+            {"start": start, "stop": stop}
+        ).scalars()
+        for name in sorted(set(names) - known.keys()):
+            key = normalize_name(name)
+            if key not in keys:
+                keys[key] = migrator.execute(exercise.insert().values(
+                    name=name.strip(), normalized_name=key
+                )).inserted_primary_key[0]
+            migrator.execute(name_map.insert().values(movement_name=name, exercise_id=keys[key]))
+            known[name] = keys[key]
+        migrator.execute(
+            'UPDATE movement SET exercise_id = (SELECT m.exercise_id FROM _exercise_name_map m '
+            'WHERE m.movement_name = movement.movement_name) '
+            'WHERE id >= :start AND id < :stop',
+            {"start": start, "stop": stop}
+        )
+
+    duplicates = migrator.execute(
+        "SELECT COALESCE(SUM(n - 1), 0) FROM (SELECT COUNT(*) AS n FROM movement "
+        "GROUP BY workout_id, exercise_id HAVING COUNT(*) > 1) AS counted"
+    ).scalar()
+    if duplicates:
+        logging.getLogger(__name__).warning(
+            "%d movements are the same exercise as another movement of their workout, "
+            "merge them with: flask merge_movements", duplicates
+        )
+
+    migrator.batch_rebuild(movement)
+    name_map.drop(migrator.conn)
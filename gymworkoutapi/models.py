@@ -5,10 +5,18 @@ https://github.com/enkwolf/pwp-course-sensorhub-api-example/blob/master/sensorhu
 https://coverage.readthedocs.io/en/6.4.4/excluding.html
 """
 
+from datetime import datetime, timezone
 import click
 from flask.cli import with_appcontext
 from gymworkoutapi import db
 
+def utcnow():
+    """
+    Current UTC time for the updated_at columns
+    """
+
+    return datetime.now(timezone.utc).replace(tzinfo=None)
+
 class User(db.Model):
     """
     Class for the user model
@@ -20,21 +28,25 @@ class User(db.Model):
     weight = db.Column(db.Float, nullable=False)
     bmi = db.Column(db.Float, nullable=True)
     mean_bmi = db.Column(db.Float, nullable=True)
+    updated_at = db.Column(db.DateTime, nullable=False, default=utcnow, onupdate=utcnow)
 
     workout = db.relationship('Workout', cascade="all,delete", back_populates='user')
 
-    def serialize(self):
+    def serialize(self, fields=None):
         """
-        Serializer for the User class
+        Serializer for the User class, optionally only the given fields
         """
 
-        return {
+        doc = {
             "username": self.username,
             "height": self.height,
             "weight": self.weight,
             "bmi": self.bmi,
             "mean_bmi": self.mean_bmi
         }
+        if fields:
+            return {name: doc[name] for name in fields}
+        return doc
 
     def deserialize(self, doc):
         """
@@ -82,20 +94,30 @@ class Workout(db.Model):
     user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete = "CASCADE"), nullable = False)
     workout_name = db.Column(db.String(64), unique=True, nullable=False)
     favorite = db.Column(db.Boolean, nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False, default=utcnow, onupdate=utcnow)
 
     movement = db.relationship('Movement', cascade="all,delete", back_populates='workout')
     user = db.relationship('User', back_populates='workout')
 
-    def serialize(self):
+    # indexes backing the filters and sort orders of WorkoutCollection
+    __table_args__ = (
+        db.Index("ix_workout_user_id_favorite_workout_name", "user_id", "favorite", "workout_name"),
+        db.Index("ix_workout_user_id_workout_name", "user_id", "workout_name"),
+    )
+
+    def serialize(self, fields=None):
         """
-        Serializer for the Workout class
+        Serializer for the Workout class, optionally only the given fields
         """
 
-        return {
+        doc = {
             "user_id": self.user_id,
             "workout_name": self.workout_name,
             "favorite": self.favorite
         }
+        if fields:
+            return {name: doc[name] for name in fields}
+        return doc
 
     def deserialize(self, doc):
         """
@@ -126,6 +148,26 @@ class Workout(db.Model):
         }
         return schema
 
+def normalize_name(name):
+    """
+    Catalog key of a movement name. Case, spaces and punctuation are
+    ignored, so "Back Squat", "back squat" and "BackSquat" are one exercise.
+    """
+
+    key = "".join(char for char in name.casefold() if char.isalnum())
+    return key or name.strip().casefold()
+
+class Exercise(db.Model):
+    """
+    Class for the exercise model.
+    The catalog of movement names, every distinct normalized name is
+    stored once and the movements refer to it by id.
+    """
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    name = db.Column(db.String(64), nullable=False)
+    normalized_name = db.Column(db.String(128), nullable=False, unique=True)
+
 class Movement(db.Model):
     """
     Class for the movement model
@@ -133,23 +175,46 @@ class Movement(db.Model):
 
     id = db.Column(db.Integer, unique=True, primary_key=True, autoincrement=True)
     workout_id = db.Column(db.Integer, db.ForeignKey('workout.id', ondelete = "CASCADE"), nullable = False)
-    movement_name = db.Column(db.String(64), nullable=False)
+    exercise_id = db.Column(db.Integer, db.ForeignKey('exercise.id'), nullable=False)
     sets = db.Column(db.Float, nullable=False)
     reps = db.Column(db.Float, nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False, default=utcnow, onupdate=utcnow)
 
     workout = db.relationship('Workout', back_populates='movement')
+    exercise = db.relationship('Exercise', lazy="joined", innerjoin=True)
+
+    __table_args__ = (
+        db.Index("ix_movement_workout_id_exercise_id", "workout_id", "exercise_id"),
+    )
+
+    @property
+    def movement_name(self):
+        """
+        Name of the movement, the catalog name of its exercise
+        """
 
-    def serialize(self):
+        return self.exercise.name if self.exercise is not None else None
+
+    @movement_name.setter
+    def movement_name(self, name):
+        from gymworkoutapi.exercises import intern_exercise
+        self.exercise = intern_exercise(db.session, name)
+
+    def serialize(self, fields=None):
         """
-        Serializer for the Movement class
+        Serializer for the Movement class, optionally only the given fields
         """
 
-        return {
+        doc = {
             "workout_id": self.workout_id,
+            "exercise_id": self.exercise_id,
             "movement_name": self.movement_name,
             "sets": self.sets,
             "reps": self.reps
         }
+        if fields:
+            return {name: doc[name] for name in fields}
+        return doc
 
     @staticmethod
     def json_schema():
@@ -176,6 +241,53 @@ class Movement(db.Model):
         }
         return schema
 
+class ChangeLog(db.Model):
+    """
+    Class for the change log model.
+    Every insert, update and delete of a user, workout or movement
+    appends a row here. Rows with deleted set are the tombstones
+    of removed entities.
+    """
+
+    id = db.Column(db.Integer, primary_key=True, autoincrement=True)
+    user_id = db.Column(db.Integer, nullable=False)
+    entity = db.Column(db.String(16), nullable=False)
+    entity_id = db.Column(db.Integer, nullable=False)
+    deleted = db.Column(db.Boolean, nullable=False, default=False)
+
+    __table_args__ = (
+        db.Index("ix_change_log_user_id_id", "user_id", "id"),
+    )
+
+class UserSummary(db.Model):
+    """
+    Class for the user summary model.
+    The precomputed home screen document of a user,
+    rebuilt by gymworkoutapi.summaries whenever the user's data changes.
+    """
+
+    user_id = db.Column(db.Integer, db.ForeignKey('user.id', ondelete = "CASCADE"),
+        primary_key=True, autoincrement=False)
+    document = db.Column(db.JSON, nullable=False)
+    updated_at = db.Column(db.DateTime, nullable=False)
+
+class IdempotencyKey(db.Model):
+    """
+    Class for the idempotency key model.
+    The stored response of a POST request sent with an
+    Idempotency-Key header, see gymworkoutapi.idempotency.
+    """
+
+    key = db.Column(db.String(255), primary_key=True)
+    request_hash = db.Column(db.String(64), nullable=False)
+    status = db.Column(db.Integer, nullable=False)
+    body = db.Column(db.Text, nullable=False)
+    created_at = db.Column(db.DateTime, nullable=False, default=utcnow)
+
+    __table_args__ = (
+        db.Index("ix_idempotency_key_created_at", "created_at"),
+    )
+
 @click.command("init_db")
 @with_appcontext
 def init_db_command(): # pragma: no cover
@@ -192,6 +304,11 @@ def init_db_command(): # pragma: no cover
         print("Previous database file does not exist, new created successfully")
     db.create_all()
 
+    # the new database already has the latest schema
+    from gymworkoutapi import migrations
+    with db.engine.begin() as connection:
+        migrations.stamp(connection, migrations.head())
+
 
 @click.command("test_db")
 @with_appcontext
@@ -265,8 +382,9 @@ def db_test(): # pragma: no cover
     assert User.query.filter_by(username="test_user2").first().id == 2 # id = 2
     assert Workout.query.filter_by(workout_name="test-workout1").first().id == 1 # id = 1
     assert Workout.query.filter_by(workout_name="test-workout2").first().id == 2 # id = 2
-    assert Movement.query.filter_by(movement_name="test-movement1").first().id == 1 # id = 1
-    assert Movement.query.filter_by(movement_name="test-movement2").first().id == 2 # id = 2
+    assert m_1.id == 1 # id = 1
+    assert m_2.id == 2 # id = 2
+    assert m_1.exercise.normalized_name == "testmovement1"
 
     # Check relationships
     db_user = User.query.first()
@@ -291,13 +409,13 @@ def db_test(): # pragma: no cover
     assert Workout.query.filter_by(workout_name="test-workout1").first().id == 1
 
     # Movement should exist before deletion of workout
-    assert Movement.query.filter_by(movement_name="test-movement1").first() is not None
+    assert db.session.get(Movement, 1) is not None
 
     db.session.delete(w_1)
     db.session.commit()
 
     # Movement associated with workout should be None after deletion
-    assert Movement.query.filter_by(movement_name="test-movement1").first() is None
+    assert db.session.get(Movement, 1) is None
 
     # 1 before deleting user's workout
     assert User.query.filter_by(username="test_user1").first().id == 1
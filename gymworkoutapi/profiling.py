@@ -0,0 +1,202 @@
+"""
+Per-request profiling.
+
+When PROFILING_ENABLED is set, a sample of the API requests is profiled
+and the profiles are written to PROFILING_DIR (instance/profiles by
+default). Requests are picked at random with PROFILING_SAMPLE_RATE, and an
+admin can force a profile of a single request by sending the
+PROFILING_ADMIN_TOKEN in the X-Profile header. The name of the written
+file is returned in the X-Profile-Id header of a forced request.
+
+Config:
+  - PROFILING_ENABLED: turns the profiling on
+  - PROFILING_MODE: "cprofile" writes .pstats files (python -m pstats, snakeviz),
+    "sampling" writes .folded stacks (flamegraph.pl, speedscope) with a much
+    lower overhead, suitable for production traffic
+  - PROFILING_SAMPLE_RATE: share of the requests profiled, e.g. 0.01
+  - PROFILING_ADMIN_TOKEN: token of the X-Profile header, None disables forcing
+  - PROFILING_INTERVAL_MS: stack sampling interval of the sampling mode
+  - PROFILING_KEEP: number of newest profiles kept, older ones are removed
+
+Only one request per worker process is profiled at a time, requests
+arriving meanwhile are not profiled. A profile covers its request until
+the response is closed, so the serialization of a streamed response is
+profiled while it is passed through unbuffered.
+
+REFERENCE:
+https://docs.python.org/3/library/profile.html
+https://github.com/brendangregg/FlameGraph#2-fold-stacks
+"""
+
+import os
+import re
+import hmac
+import random
+import cProfile
+import sys
+import threading
+from collections import Counter
+from datetime import datetime
+from werkzeug.wsgi import ClosingIterator
+
+PROFILE_HEADER = "HTTP_X_PROFILE"
+
+class StackSampler:
+    """
+    Samples the call stack of one thread from a background thread.
+    Has the enable, disable and dump_stats methods of cProfile.Profile.
+    """
+
+    def __init__(self, thread_id, interval):
+        self.thread_id = thread_id
+        self.interval = interval
+        self.stacks = Counter()
+        self._stopping = threading.Event()
+        self._thread = threading.Thread(target=self._run, name="profiling-sampler", daemon=True)
+
+    def _run(self):
+        while not self._stopping.wait(self.interval):
+            frame = sys._current_frames().get(self.thread_id) # pylint: disable=protected-access
+            if frame is None:
+                continue
+            stack = []
+            while frame is not None:
+                code = frame.f_code
+                stack.append(f"{code.co_name} ({os.path.basename(code.co_filename)})")
+                frame = frame.f_back
+            self.stacks[";".join(reversed(stack))] += 1
+
+    def enable(self):
+        """
+        Starts sampling
+        """
+
+        self._thread.start()
+
+    def disable(self):
+        """
+        Stops sampling and waits for the sampler thread
+        """
+
+        self._stopping.set()
+        self._thread.join()
+
+    def dump_stats(self, path):
+        """
+        Writes the samples in the folded stack format, one
+        "frame;frame;frame count" line per distinct stack
+        """
+
+        with open(path, "w", encoding="utf-8") as handle:
+            for stack, count in self.stacks.most_common():
+                handle.write(f"{stack} {count}\n")
+
+class ProfilingMiddleware:
+    """
+    WSGI middleware profiling the sampled and the forced requests
+    """
+
+    def __init__(self, app, wsgi_app, prefix="/api/"):
+        self.app = app
+        self.wsgi_app = wsgi_app
+        self.prefix = prefix
+        self.directory = app.config["PROFILING_DIR"] or os.path.join(app.instance_path, "profiles")
+        self._busy = threading.Lock()
+
+    def _forced(self, environ):
+        """
+        Returns True if the request carries the admin token
+        """
+
+        token = self.app.config["PROFILING_ADMIN_TOKEN"]
+        value = environ.get(PROFILE_HEADER)
+        if not token or value is None:
+            return False
+        # compared as bytes, compare_digest rejects str with non-ASCII
+        # characters and WSGI header values are latin-1 decoded
+        return hmac.compare_digest(value.encode("latin-1"), token.encode())
+
+    def _file_name(self, environ, extension):
+        """
+        Name of a profile: time, method, path and worker. It is sent in
+        the X-Profile-Id header before the request ends, so it can't
+        contain the duration.
+        """
+
+        path = re.sub(r"[^A-Za-z0-9]+", "_", environ.get("PATH_INFO", "")).strip("_")
+        stamp = datetime.now().strftime("%Y%m%dT%H%M%S%f")
+        return f"{stamp}-{environ.get('REQUEST_METHOD', '')}-{path}-{os.getpid()}.{extension}"
+
+    def _prune(self):
+        """
+        Removes the oldest profiles beyond PROFILING_KEEP
+        """
+
+        names = sorted(os.listdir(self.directory))
+        for name in names[:max(0, len(names) - self.app.config["PROFILING_KEEP"])]:
+            os.remove(os.path.join(self.directory, name))
+
+    def _profile(self, environ, start_response, forced):
+        """
+        Runs the request under the configured profiler. The response is
+        returned unbuffered and the profile is written when it is closed,
+        which also frees the profiler for the next request.
+        """
+
+        config = self.app.config
+        if config["PROFILING_MODE"] == "sampling":
+            profiler = StackSampler(threading.get_ident(), config["PROFILING_INTERVAL_MS"] / 1000)
+            extension = "folded"
+        else:
+            profiler = cProfile.Profile()
+            extension = "pstats"
+        name = self._file_name(environ, extension)
+
+        def _start_response(status, headers, exc_info=None):
+            if forced:
+                headers = headers + [("X-Profile-Id", name)]
+            return start_response(status, headers, exc_info)
+
+        def _finish():
+            try:
+                profiler.disable()
+                os.makedirs(self.directory, exist_ok=True)
+                profiler.dump_stats(os.path.join(self.directory, name))
+                self._prune()
+                self.app.extensions["metrics"].incr("profiling.profiled")
+            finally:
+                self._busy.release()
+
+        profiler.enable()
+        try:
+            result = self.wsgi_app(environ, _start_response)
+        except BaseException:
+            profiler.disable()
+            raise
+        return ClosingIterator(result, _finish)
+
+    def __call__(self, environ, start_response):
+        config = self.app.config
+        if (not config["PROFILING_ENABLED"]
+                or not environ.get("PATH_INFO", "").startswith(self.prefix)):
+            return self.wsgi_app(environ, start_response)
+        forced = self._forced(environ)
+        if not forced and random.random() >= config["PROFILING_SAMPLE_RATE"]:
+            return self.wsgi_app(environ, start_response)
+        # not a with block, the request is not profiled if the lock is taken
+        if not self._busy.acquire(blocking=False): # pylint: disable=consider-using-with
+            return self.wsgi_app(environ, start_response)
+        try:
+            return self._profile(environ, start_response, forced)
+        except BaseException:
+            self._busy.release()
+            raise
+
+def init_app(app):
+    """
+    Wraps the application with the profiling middleware
+    """
+
+    middleware = ProfilingMiddleware(app, app.wsgi_app)
+    app.extensions["profiling"] = middleware
+    app.wsgi_app = middleware
@@ -0,0 +1,261 @@
+"""
+Rate limiting and admission control for the API blueprint.
+
+Every request to the API takes a token from the bucket of its client and,
+if the route has its own limit, from the bucket of its client and route.
+A request without tokens is rejected with 429 and a Retry-After header.
+When more than ADMISSION_MAX_INFLIGHT requests are being processed by the
+worker, new requests are shed with 503 instead of queueing behind the
+database.
+
+Config:
+  - RATELIMIT_ENABLED: turns the rate limiting on
+  - RATELIMIT_DEFAULT: (tokens per second, burst) per client
+  - RATELIMIT_ROUTES: {endpoint: (tokens per second, burst)} per client and route
+  - RATELIMIT_BACKEND: None for the in-memory backend, a backend instance or
+    "module:attribute" of a backend class, e.g. "gymworkoutapi.ratelimit:RedisBackend"
+  - RATELIMIT_BACKEND_URL: passed to the backend class, e.g. redis://localhost:6379/0
+  - RATELIMIT_CLIENT_HEADER: header identifying the client behind a trusted proxy,
+    the remote address is used if not set
+  - ADMISSION_MAX_INFLIGHT: maximum number of concurrent API requests, None for no limit
+  - ADMISSION_RETRY_AFTER: Retry-After seconds of the 503 response
+
+REFERENCE:
+https://en.wikipedia.org/wiki/Token_bucket
+"""
+
+import json
+import math
+import time
+import threading
+from collections import OrderedDict
+from importlib import import_module
+from werkzeug.exceptions import HTTPException, TooManyRequests, ServiceUnavailable
+from werkzeug.routing import Map, UnicodeConverter
+from werkzeug.wrappers import Response
+from werkzeug.wsgi import ClosingIterator
+
+try:
+    import redis
+except ImportError: # pragma: no cover
+    redis = None
+
+class MemoryBackend:
+    """
+    Token buckets of a single worker process. Beyond MAX_BUCKETS the
+    least recently used bucket is dropped, it is usually full again.
+    """
+
+    MAX_BUCKETS = 10000
+
+    def __init__(self, _url=None):
+        self._lock = threading.Lock()
+        # in the order the buckets were last used, the oldest first
+        self._buckets = OrderedDict()
+
+    def take(self, key, rate, burst):
+        """
+        Takes one token from the bucket. Returns (allowed, retry_after)
+        where retry_after is the number of seconds until a token is available.
+        """
+
+        now = time.monotonic()
+        with self._lock:
+            tokens, updated = self._buckets.pop(key, (burst, now))
+            tokens = min(burst, tokens + (now - updated) * rate)
+            if tokens >= 1:
+                self._buckets[key] = (tokens - 1, now)
+                allowed, retry_after = True, 0
+            else:
+                self._buckets[key] = (tokens, now)
+                allowed, retry_after = False, (1 - tokens) / rate
+            if len(self._buckets) > self.MAX_BUCKETS:
+                self._buckets.popitem(last=False)
+        return allowed, retry_after
+
+class RedisBackend:
+    """
+    Token buckets shared by all workers through Redis
+    """
+
+    SCRIPT = """
+    local rate = tonumber(ARGV[1])
+    local burst = tonumber(ARGV[2])
+    local now = tonumber(ARGV[3])
+    local bucket = redis.call("HMGET", KEYS[1], "tokens", "updated")
+    local tokens = tonumber(bucket[1]) or burst
+    local updated = tonumber(bucket[2]) or now
+    tokens = math.min(burst, tokens + (now - updated) * rate)
+    local allowed = 0
+    if tokens >= 1 then
+        tokens = tokens - 1
+        allowed = 1
+    end
+    redis.call("HSET", KEYS[1], "tokens", tokens, "updated", now)
+    redis.call("EXPIRE", KEYS[1], math.ceil(burst / rate) + 1)
+    return {allowed, tostring(tokens)}
+    """
+
+    def __init__(self, url="redis://localhost:6379/0"):
+        if redis is None: # pragma: no cover
+            raise RuntimeError("The redis package is required for RedisBackend")
+        self._client = redis.Redis.from_url(url)
+        self._script = self._client.register_script(self.SCRIPT)
+
+    def take(self, key, rate, burst): # pragma: no cover
+        """
+        Takes one token from the shared bucket
+        """
+
+        allowed, tokens = self._script(keys=["ratelimit:" + key], args=[rate, burst, time.time()])
+        if allowed:
+            return True, 0
+        return False, (1 - float(tokens)) / rate
+
+def _load_backend(config):
+    """
+    Creates the configured backend
+    """
+
+    backend = config["RATELIMIT_BACKEND"]
+    if backend is None:
+        return MemoryBackend()
+    if isinstance(backend, str):
+        module, _, name = backend.partition(":")
+        backend = getattr(import_module(module), name)
+    if isinstance(backend, type):
+        return backend(config.get("RATELIMIT_BACKEND_URL"))
+    return backend
+
+class AdmissionControl:
+    """
+    Limits the number of API requests processed at the same time
+    """
+
+    def __init__(self, limit):
+        self.limit = limit
+        self.inflight = 0
+        self._lock = threading.Lock()
+
+    def enter(self):
+        """
+        Returns True if the request is admitted
+        """
+
+        with self._lock:
+            if self.limit is not None and self.inflight >= self.limit:
+                return False
+            self.inflight += 1
+            return True
+
+    def leave(self):
+        """
+        Marks an admitted request finished
+        """
+
+        with self._lock:
+            self.inflight -= 1
+
+class AdmissionMiddleware:
+    """
+    WSGI middleware applying the rate limits and the admission control.
+    It runs before routing, because the URL converters already query
+    the database, so rejected requests cost no database work.
+    """
+
+    def __init__(self, app, wsgi_app, prefix="/api/"):
+        self.app = app
+        self.wsgi_app = wsgi_app
+        self.prefix = prefix
+        self.backend = _load_backend(app.config) if app.config["RATELIMIT_ENABLED"] else None
+        self.admission = AdmissionControl(app.config["ADMISSION_MAX_INFLIGHT"])
+        self._routes = None
+
+    def _endpoint(self, environ):
+        """
+        Endpoint of the request, matched without running the converters
+        """
+
+        if self._routes is None:
+            converters = {name: UnicodeConverter for name in self.app.url_map.converters
+                if name not in ("default", "string", "int", "float", "path", "any", "uuid")}
+            self._routes = Map(
+                [rule.empty() for rule in self.app.url_map.iter_rules()],
+                converters=converters
+            )
+        try:
+            endpoint, _ = self._routes.bind_to_environ(environ).match()
+        except HTTPException:
+            return None
+        return endpoint
+
+    def _reject(self, error, retry_after, environ, start_response):
+        """
+        Sends a JSON error response with a Retry-After header
+        """
+
+        response = Response(
+            json.dumps({"message": error.description}),
+            error.code,
+            headers={"Retry-After": str(retry_after)},
+            mimetype="application/json"
+        )
+        return response(environ, start_response)
+
+    def _rate_limited(self, environ):
+        """
+        Returns the Retry-After seconds if the request exceeds a limit
+        """
+
+        config = self.app.config
+        header = config["RATELIMIT_CLIENT_HEADER"]
+        client = None
+        if header:
+            client = environ.get("HTTP_" + header.upper().replace("-", "_"))
+        client = client or environ.get("REMOTE_ADDR") or "-"
+        limits = [(client, config["RATELIMIT_DEFAULT"])]
+        if config["RATELIMIT_ROUTES"]:
+            endpoint = self._endpoint(environ)
+            if endpoint in config["RATELIMIT_ROUTES"]:
+                limits.append((f"{client}:{endpoint}", config["RATELIMIT_ROUTES"][endpoint]))
+        for key, (rate, burst) in limits:
+            allowed, retry_after = self.backend.take(key, rate, burst)
+            if not allowed:
+                return max(1, math.ceil(retry_after))
+        return None
+
+    def __call__(self, environ, start_response):
+        if not environ.get("PATH_INFO", "").startswith(self.prefix):
+            return self.wsgi_app(environ, start_response)
+        metrics = self.app.extensions["metrics"]
+
+        if self.backend is not None:
+            retry_after = self._rate_limited(environ)
+            if retry_after is not None:
+                metrics.incr("ratelimit.rejected")
+                return self._reject(TooManyRequests("Rate limit exceeded"),
+                    retry_after, environ, start_response)
+
+        if not self.admission.enter():
+            metrics.incr("admission.rejected")
+            return self._reject(ServiceUnavailable("Server is overloaded"),
+                self.app.config["ADMISSION_RETRY_AFTER"], environ, start_response)
+        metrics.incr("admission.admitted")
+        metrics.gauge("admission.inflight", self.admission.inflight)
+        try:
+            result = self.wsgi_app(environ, start_response)
+        except Exception:
+            self.admission.leave()
+            raise
+        # a streamed response (e.g. an export) still queries the database
+        # while its body is sent, the request is in flight until it is closed
+        return ClosingIterator(result, self.admission.leave)
+
+def init_app(app):
+    """
+    Wraps the application with the admission middleware
+    """
+
+    middleware = AdmissionMiddleware(app, app.wsgi_app)
+    app.extensions["admission"] = middleware
+    app.wsgi_app = middleware
@@ -0,0 +1,105 @@
+"""
+Read models for the list endpoints.
+
+Read-only paths select plain columns with session.execute(select(...)) and
+wrap each row in a small __slots__ object instead of hydrating mapped
+instances, which skips the identity map and instance state bookkeeping.
+The mapped models in models.py are still used for every write.
+"""
+
+from sqlalchemy import select
+from gymworkoutapi.models import User, Workout, Movement, Exercise
+
+class ReadModel:
+    """
+    Base class for the read models. The slots are the serialized
+    fields and have the same names as the model columns.
+    """
+
+    __slots__ = ()
+    model = None
+
+    def __init__(self, *values, fields=None):
+        for name, value in zip(fields or self.__slots__, values):
+            setattr(self, name, value)
+
+    @classmethod
+    def columns(cls, fields=None):
+        """
+        Columns of the mapped model selected for this read model,
+        optionally only the given fields
+        """
+
+        return [getattr(cls.model, name) for name in fields or cls.__slots__]
+
+    @classmethod
+    def select(cls, fields=None):
+        """
+        Statement selecting the read model columns
+        """
+
+        return select(*cls.columns(fields))
+
+    @classmethod
+    def fetch(cls, session, statement, fields=None):
+        """
+        Executes the statement and returns a list of read models.
+        The fields must be the ones the statement was built with.
+        """
+
+        return [cls(*row, fields=fields) for row in session.execute(statement)]
+
+    def serialize(self):
+        """
+        Serializer for the read models, same document as the model's
+        but only with the selected fields
+        """
+
+        return {name: getattr(self, name) for name in self.__slots__ if hasattr(self, name)}
+
+class UserRow(ReadModel):
+    """
+    Read model for the User class
+    """
+
+    __slots__ = ("username", "height", "weight", "bmi", "mean_bmi")
+    model = User
+
+class WorkoutRow(ReadModel):
+    """
+    Read model for the Workout class
+    """
+
+    __slots__ = ("user_id", "workout_name", "favorite")
+    model = Workout
+
+class MovementRow(ReadModel):
+    """
+    Read model for the Movement class.
+    The movement name is the name of the exercise, so the statement
+    joins the exercise catalog.
+    """
+
+    __slots__ = ("workout_id", "exercise_id", "movement_name", "sets", "reps")
+    model = Movement
+
+    @classmethod
+    def columns(cls, fields=None):
+        """
+        Columns of the movement and the exercise name as movement_name
+        """
+
+        return [
+            Exercise.name.label(name) if name == "movement_name" else getattr(Movement, name)
+            for name in fields or cls.__slots__
+        ]
+
+    @classmethod
+    def select(cls, fields=None):
+        """
+        Statement selecting the read model columns from the movements
+        joined with their exercises
+        """
+
+        return (select(*cls.columns(fields)).select_from(Movement)
+            .join(Exercise, Exercise.id == Movement.exercise_id))
@@ -0,0 +1,41 @@
+"""
+REFERENCE: https://lovelace.oulu.fi/ohjelmoitava-web/ohjelmoitava-web/
+"""
+
+import json
+from flask import request, Response
+from flask_restful import Resource
+from werkzeug.exceptions import BadRequest
+from gymworkoutapi import db
+from gymworkoutapi.changes import collect_changes
+
+class ChangeCollection(Resource):
+    """
+    Class for the ChangeCollection resource.
+    ChangeCollection is the list of changes to the user's data
+    after a sync token and only implements the GET method.
+    """
+
+    def get(self, user):
+        """
+        Get method for ChangeCollection resource.
+        Returns the users, workouts and movements that were created,
+        updated or deleted after the "since" token, and a new token.
+        If the token or the limit is not valid, BadRequest is raised.
+        """
+
+        try:
+            since = int(request.args.get("since", 0))
+            limit = int(request.args.get("limit", 1000))
+        except ValueError as error:
+            raise BadRequest(description="Invalid sync token or limit") from error
+        if since < 0 or not 0 < limit <= 10000:
+            raise BadRequest(description="Invalid sync token or limit")
+
+        token, more, changes = collect_changes(db.session, user.id, since, limit)
+        response_data = {
+            "token": str(token),
+            "more": more,
+            "changes": changes
+        }
+        return Response(json.dumps(response_data), 200, mimetype="application/json")
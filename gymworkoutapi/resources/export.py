@@ -0,0 +1,38 @@
+"""
+REFERENCE: https://lovelace.oulu.fi/ohjelmoitava-web/ohjelmoitava-web/
+"""
+
+from flask import request, current_app, Response
+from flask_restful import Resource
+from werkzeug.exceptions import BadRequest, NotFound
+from gymworkoutapi import db
+from gymworkoutapi.export import TABLES, MEDIA_TYPES, available_formats, stream_table
+
+class ExportItem(Resource):
+    """
+    Class for the ExportItem resource.
+    ExportItem is the bulk export of the users, workouts, movements or exercises
+    and only implements the GET method.
+    """
+
+    def get(self, table):
+        """
+        Get method for ExportItem resource.
+        Streams the whole table in the format given in the "format"
+        query parameter (csv by default). If the table does not exist,
+        NotFound is raised. If the format is not available, BadRequest
+        is raised.
+        """
+
+        if table not in TABLES:
+            raise NotFound(description="Tables: " + ", ".join(TABLES))
+        export_format = request.args.get("format", "csv")
+        if export_format not in available_formats():
+            raise BadRequest(description="format must be one of " + ", ".join(available_formats()))
+
+        chunks = stream_table(
+            db.engine, table, export_format, current_app.config["EXPORT_CHUNK_ROWS"]
+        )
+        return Response(chunks, 200, mimetype=MEDIA_TYPES[export_format], headers={
+            "Content-Disposition": f"attachment; filename={table}.{export_format}"
+        })
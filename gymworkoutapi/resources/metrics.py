@@ -0,0 +1,21 @@
+"""
+REFERENCE: https://lovelace.oulu.fi/ohjelmoitava-web/ohjelmoitava-web/
+"""
+
+from flask_restful import Resource
+from gymworkoutapi.metrics import get_metrics
+
+class MetricsItem(Resource):
+    """
+    Class for the MetricsItem resource.
+    MetricsItem exposes the in-process metrics of the worker
+    and only implements the GET method.
+    """
+
+    def get(self):
+        """
+        Get method for MetricsItem resource.
+        Returns counters, gauges and timing summaries.
+        """
+
+        return get_metrics().snapshot()
@@ -5,6 +5,9 @@ from flask_restful import Resource
 from werkzeug.exceptions import NotFound, BadRequest
 from gymworkoutapi import db
 from gymworkoutapi.models import Movement
+from gymworkoutapi.readmodels import MovementRow
+from gymworkoutapi.exercises import resolve_exercise
+from gymworkoutapi.utils import parse_fields
 
 class MovementItem(Resource):
     """
@@ -17,12 +20,23 @@ class MovementItem(Resource):
         """
         Get method for MovementItem resource
         With this method, the movements can be fetched.
-        If the movement does not exist, NotFound is raised.
+        The movement is given by its name in any spelling or by its
+        exercise id. If the movement does not exist, NotFound is raised.
+        Only the columns listed in the "fields" query parameter
+        are selected, if it is given.
         """
-        movement = Movement.query.filter_by(movement_name=movement, workout_id=workout.id).first()
-        if not movement:
+        fields = parse_fields(MovementRow)
+        movements = MovementRow.fetch(
+            db.session,
+            MovementRow.select(fields).where(
+                Movement.workout_id == workout.id,
+                Movement.exercise_id == resolve_exercise(db.session, workout.id, movement)
+            ).limit(1),
+            fields
+        )
+        if not movements:
             raise NotFound(description="The movement not found")
-        return movement.serialize()
+        return movements[0].serialize()
 
     def delete(self, user, workout, movement):
         """
@@ -30,7 +44,9 @@ class MovementItem(Resource):
         With this method, the movements can be deleted.
         If the movement does not exist, BadRequest is raised.
         """
-        movement = Movement.query.filter_by(movement_name=movement, workout_id=workout.id).first()
+        movement = Movement.query.filter_by(
+            workout_id=workout.id, exercise_id=resolve_exercise(db.session, workout.id, movement)
+        ).first()
 
         try:
             db.session.delete(movement)
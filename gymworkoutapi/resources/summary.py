@@ -0,0 +1,44 @@
+"""
+REFERENCE: https://lovelace.oulu.fi/ohjelmoitava-web/ohjelmoitava-web/
+"""
+
+from flask import Response
+from flask_restful import Resource
+from werkzeug.exceptions import NotFound
+from sqlalchemy import select, cast
+from gymworkoutapi import db
+from gymworkoutapi.models import User, UserSummary
+from gymworkoutapi.summaries import refresh_summaries
+
+class UserSummaryItem(Resource):
+    """
+    Class for the UserSummaryItem resource.
+    UserSummaryItem is the precomputed home screen document of a user
+    and only implements the GET method.
+    """
+
+    def get(self, username):
+        """
+        Get method for UserSummaryItem resource.
+        The stored document is returned as is, read with one query by
+        the username, which is why the route does not use the user
+        converter. A missing document is built on the first read.
+        If the user does not exist, NotFound is raised.
+        """
+
+        statement = (
+            select(cast(UserSummary.document, db.Text))
+            .join(User, User.id == UserSummary.user_id)
+            .where(User.username == username)
+        )
+        document = db.session.execute(statement).scalar()
+        if document is None:
+            user_id = db.session.execute(
+                select(User.id).where(User.username == username)
+            ).scalar()
+            if user_id is None:
+                raise NotFound
+            refresh_summaries(db.session.connection(), [user_id])
+            db.session.commit()
+            document = db.session.execute(statement).scalar()
+        return Response(document, 200, mimetype="application/json")
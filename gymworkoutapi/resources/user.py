@@ -10,6 +10,10 @@ from werkzeug.exceptions import BadRequest, Conflict
 from sqlalchemy.exc import IntegrityError
 from gymworkoutapi import db
 from gymworkoutapi.models import User
+from gymworkoutapi.readmodels import UserRow
+from gymworkoutapi.utils import parse_fields
+from gymworkoutapi.coalesce import coalesced
+from gymworkoutapi.idempotency import idempotent
 
 class UserCollection(Resource):
     """
@@ -18,16 +22,17 @@ class UserCollection(Resource):
     GET and POST methods are implemented.
     """
 
+    method_decorators = {"get": [coalesced], "post": [idempotent]}
+
     def get(self):
         """
         Get method for UserCollection resource.
-        UserCollection is fetched with this.
+        UserCollection is fetched with this. Only the columns listed
+        in the "fields" query parameter are selected, if it is given.
         """
-        users = User.query.all()
-        response_data = []
-        while users:
-            user = users.pop()
-            response_data.append(user.serialize())
+        fields = parse_fields(UserRow)
+        users = UserRow.fetch(db.session, UserRow.select(fields).order_by(User.id.desc()), fields)
+        response_data = [user.serialize() for user in users]
         return Response(json.dumps(response_data), 200)
 
     def post(self):
@@ -68,7 +73,7 @@ class UserItem(Resource):
         User gets fetched with this method.
         """
 
-        return user.serialize()
+        return user.serialize(parse_fields(UserRow))
 
     def put(self, user):
         """
@@ -3,13 +3,86 @@ REFERENCE: https://lovelace.oulu.fi/ohjelmoitava-web/ohjelmoitava-web/
 """
 
 import json
-from flask import request, Response
+from flask import request, Response, current_app
 from flask_restful import Resource
 from jsonschema import validate, ValidationError
-from werkzeug.exceptions import BadRequest, Conflict
+from werkzeug.exceptions import BadRequest, Conflict, NotFound
+from sqlalchemy import select, func, insert, literal
+from sqlalchemy.orm import aliased
 from sqlalchemy.exc import IntegrityError
 from gymworkoutapi import db
-from gymworkoutapi.models import Workout, Movement
+from gymworkoutapi.models import (
+    User, Workout, Movement, Exercise, ChangeLog, utcnow, normalize_name
+)
+from gymworkoutapi.readmodels import WorkoutRow
+from gymworkoutapi.utils import parse_fields
+from gymworkoutapi.coalesce import coalesced
+from gymworkoutapi.storage import supports_returning
+from gymworkoutapi.summaries import refresh_summaries
+from gymworkoutapi.idempotency import idempotent
+
+SORT_ORDERS = {
+    "id": Workout.id.asc(),
+    "-id": Workout.id.desc(),
+    "workout_name": Workout.workout_name.asc(),
+    "-workout_name": Workout.workout_name.desc()
+}
+
+def _non_negative_int(args, name):
+    """
+    Reads an optional non-negative integer query parameter.
+    If the value is not valid, BadRequest is raised.
+    """
+
+    value = args.get(name)
+    if value is None:
+        return None
+    if not value.isdigit():
+        raise BadRequest(description=f"{name} must be a non-negative integer")
+    return int(value)
+
+def build_workout_query(user, args, fields=None):
+    """
+    Builds the statement for the user's workouts with the filters and
+    the sort order given in the query parameters:
+    favorite=true|false, name_prefix=, min_movements=, max_movements=,
+    sort=id|-id|workout_name|-workout_name (default -id).
+    If a parameter is not valid, BadRequest is raised.
+    """
+
+    statement = WorkoutRow.select(fields).where(Workout.user_id == user.id)
+
+    favorite = args.get("favorite")
+    if favorite is not None:
+        if favorite not in ("true", "false"):
+            raise BadRequest(description="favorite must be true or false")
+        statement = statement.where(Workout.favorite == (favorite == "true"))
+
+    # a range instead of LIKE, so that the workout_name index can be used
+    prefix = args.get("name_prefix")
+    if prefix:
+        statement = statement.where(
+            Workout.workout_name >= prefix,
+            Workout.workout_name < prefix + "\U0010ffff"
+        )
+
+    min_movements = _non_negative_int(args, "min_movements")
+    max_movements = _non_negative_int(args, "max_movements")
+    if min_movements is not None or max_movements is not None:
+        movement_count = (
+            select(func.count())
+            .where(Movement.workout_id == Workout.id)
+            .scalar_subquery()
+        )
+        if min_movements is not None:
+            statement = statement.where(movement_count >= min_movements)
+        if max_movements is not None:
+            statement = statement.where(movement_count <= max_movements)
+
+    sort = args.get("sort", "-id")
+    if sort not in SORT_ORDERS:
+        raise BadRequest(description="sort must be one of " + ", ".join(SORT_ORDERS))
+    return statement.order_by(SORT_ORDERS[sort])
 
 class WorkoutCollection(Resource):
     """
@@ -18,17 +91,24 @@ class WorkoutCollection(Resource):
     which has GET and POST methods.
     """
 
+    method_decorators = {"get": [coalesced], "post": [idempotent]}
+
     def get(self, user):
         """
         Get method for WorkoutCollection resource
         With this method, the workout collection can be fetched.
+        Only the columns listed in the "fields" query parameter
+        are selected, if it is given. The workouts can be filtered
+        and sorted, see build_workout_query.
         """
 
-        workouts = Workout.query.filter_by(user_id=user.id).all()
-        response_data = []
-        while workouts:
-            workout = workouts.pop()
-            response_data.append(workout.serialize())
+        fields = parse_fields(WorkoutRow)
+        workouts = WorkoutRow.fetch(
+            db.session,
+            build_workout_query(user, request.args, fields),
+            fields
+        )
+        response_data = [workout.serialize() for workout in workouts]
         return Response(json.dumps(response_data), 200)
 
     def post(self, user):
@@ -64,13 +144,15 @@ class WorkoutItem(Resource):
     GET, PUT, POST and DELETE methods are implemented.
     """
 
+    method_decorators = {"post": [idempotent]}
+
     def get(self, user, workout):
         """
         Get method for WorkoutItem resource.
         Workout is fetched with this.
         """
 
-        return workout.serialize()
+        return workout.serialize(parse_fields(WorkoutRow))
 
     def put(self, user, workout):
         """
@@ -109,19 +191,37 @@ class WorkoutItem(Resource):
         except ValidationError as error:
             raise BadRequest(description=str(error)) from error
 
+        # exercise has to be unique within the workout, in any spelling of its name
+        name = request.json["movement_name"]
+        exists = db.session.execute(
+            select(Movement.id)
+            .join(Exercise, Exercise.id == Movement.exercise_id)
+            .where(Movement.workout_id == workout.id,
+                Exercise.normalized_name == normalize_name(name))
+            .limit(1)
+        ).first()
+        if exists is not None:
+            raise Conflict(description="Movement name already in use")
+
+        # write-behind mode, the movement is written later in a batch
+        write_queue = current_app.extensions.get("movement_queue")
+        if write_queue is not None:
+            accepted = write_queue.try_submit({
+                "workout_id": workout.id,
+                "movement_name": name,
+                "sets": request.json["sets"],
+                "reps": request.json["reps"]
+            })
+            if not accepted:
+                raise Conflict(description="Movement name already in use")
+            return "Accepted", 202
+
         # create a new movement
         movement = Movement()
         movement.workout_id = workout.id
         movement.sets = request.json["sets"]
         movement.reps = request.json["reps"]
-        movement.movement_name = request.json["movement_name"]
-
-        # movement name has to be unique within the workout, else raise error
-        movements_in_workout = Movement.query.filter_by(workout_id=workout.id).all()
-        for item in movements_in_workout:
-            if item.movement_name == request.json["movement_name"]:
-                raise Conflict(description="Movement name already in use")
-
+        movement.movement_name = name
         db.session.add(movement)
         db.session.commit()
         return "Success", 201
@@ -136,3 +236,114 @@ class WorkoutItem(Resource):
         db.session.delete(workout)
         db.session.commit()
         return "Success", 201
+
+class WorkoutClone(Resource):
+    """
+    Class for the WorkoutClone resource.
+    WorkoutClone copies a workout and its movements to one or many users
+    and only implements the POST method.
+    """
+
+    method_decorators = {"post": [idempotent]}
+
+    @staticmethod
+    def json_schema():
+        """
+        Defines a valid clone document
+        """
+
+        schema = {
+            "type": "object",
+            "required": ["targets"]
+        }
+        props = schema["properties"] = {}
+        props["targets"] = {
+            "description": "Usernames of the users that receive the copy",
+            "type": "array",
+            "items": {"type": "string"},
+            "minItems": 1
+        }
+        props["workout_name"] = {
+            "description": "Name of the copy, the username is appended "
+                "when the workout is copied to several users",
+            "type": "string"
+        }
+        return schema
+
+    def post(self, user, workout):
+        """
+        Post method for WorkoutClone resource.
+        The workout and all of its movements are copied with set-based
+        INSERT ... SELECT statements in one transaction, so the number of
+        statements does not depend on the number of movements or users.
+        If the document is not valid, BadRequest is raised. If a target
+        user does not exist, NotFound is raised. If a copy's name is
+        already in use, Conflict is raised.
+        """
+
+        # validation
+        try:
+            validate(request.json, WorkoutClone.json_schema())
+        except ValidationError as error:
+            raise BadRequest(description=str(error)) from error
+
+        targets = sorted(set(request.json["targets"]))
+        found = db.session.execute(
+            select(func.count()).select_from(User).where(User.username.in_(targets))
+        ).scalar()
+        if found != len(targets):
+            raise NotFound(description="Target user not found")
+
+        name = request.json.get("workout_name")
+        if name is not None and len(targets) == 1:
+            copy_name = literal(name)
+        else:
+            copy_name = literal((name or workout.workout_name) + "-") + User.username
+        now = literal(utcnow())
+
+        copy = aliased(Workout)
+        source = aliased(Movement)
+        insert_copies = insert(Workout).from_select(
+            ["user_id", "workout_name", "favorite", "updated_at"],
+            select(User.id, copy_name, literal(workout.favorite), now)
+            .where(User.username.in_(targets))
+        )
+
+        try:
+            # the copies are found by the returned ids where RETURNING is
+            # supported and by their names otherwise
+            if supports_returning(db.session):
+                created = db.session.execute(insert_copies.returning(Workout.id)).scalars().all()
+                copies = select(copy.id, copy.user_id).where(copy.id.in_(created)).subquery()
+            else:
+                db.session.execute(insert_copies)
+                copies = (
+                    select(copy.id, copy.user_id)
+                    .join(User, User.id == copy.user_id)
+                    .where(User.username.in_(targets), copy.workout_name == copy_name)
+                ).subquery()
+            db.session.execute(insert(Movement).from_select(
+                ["workout_id", "exercise_id", "sets", "reps", "updated_at"],
+                select(copies.c.id, source.exercise_id, source.sets, source.reps, now)
+                .join(source, source.workout_id == workout.id)
+                .order_by(copies.c.id, source.id)
+            ))
+        except IntegrityError as error:
+            db.session.rollback()
+            raise Conflict(description="Workout name already in use") from error
+
+        # bulk inserts bypass the ORM events, so the change log is written here
+        db.session.execute(insert(ChangeLog).from_select(
+            ["user_id", "entity", "entity_id", "deleted"],
+            select(copies.c.user_id, literal("workout"), copies.c.id, literal(False))
+        ))
+        db.session.execute(insert(ChangeLog).from_select(
+            ["user_id", "entity", "entity_id", "deleted"],
+            select(copies.c.user_id, literal("movement"), Movement.id, literal(False))
+            .join(Movement, Movement.workout_id == copies.c.id)
+        ))
+        refresh_summaries(db.session.connection(), db.session.execute(
+            select(User.id).where(User.username.in_(targets))
+        ).scalars())
+        db.session.commit()
+        return "Success", 201
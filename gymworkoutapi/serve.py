@@ -0,0 +1,205 @@
+"""
+Production serving entry point.
+
+The application and all of its imports are loaded once in the master
+process, before the workers are forked. The inherited connection pools are
+disposed in every worker right after the fork (see create_app), so worker
+processes never share SQLite handles.
+
+Usage:
+  - gunicorn "gymworkoutapi.serve:app" --preload --worker-class gthread
+  - python -m gymworkoutapi.serve [--host HOST] [--port PORT]
+        [--workers N] [--threads N]
+
+REFERENCE:
+https://docs.gunicorn.org/en/stable/settings.html#preload-app
+https://docs.gunicorn.org/en/stable/design.html#how-many-workers
+"""
+
+import os
+import sys
+import signal
+import socket
+import argparse
+import threading
+from concurrent.futures import ThreadPoolExecutor
+from sqlalchemy import pool
+from werkzeug.serving import BaseWSGIServer
+from gymworkoutapi import create_app, db
+
+try:
+    from gunicorn.app.base import BaseApplication
+except ImportError: # pragma: no cover
+    BaseApplication = None
+
+app = create_app()
+
+def default_workers():
+    """
+    Number of worker processes, one per available core
+    """
+
+    return int(os.environ.get("GYM_WORKERS", os.cpu_count() or 1))
+
+def default_threads():
+    """
+    Number of threads per worker process, one per available core, so
+    that a worker waiting on SQLite or the network keeps the cores busy
+    """
+
+    return int(os.environ.get("GYM_THREADS", os.cpu_count() or 1))
+
+def check_pool_size(threads):
+    """
+    Exits if DB_POOL_CLASS is "singleton" and the pool can't hold a
+    connection for every server thread. SingletonThreadPool closes the
+    connections of other threads, which may be in use, when more threads
+    than its size have connected.
+    """
+
+    with app.app_context():
+        engine_pool = db.engine.pool
+    if isinstance(engine_pool, pool.SingletonThreadPool) and engine_pool.size < threads:
+        raise SystemExit(
+            f"DB_POOL_CLASS \"singleton\" holds {engine_pool.size} connections but the "
+            f"server runs {threads} threads per worker: set DB_POOL_SIZE + DB_MAX_OVERFLOW "
+            f"to at least {threads}"
+        )
+
+class PooledWSGIServer(BaseWSGIServer):
+    """
+    Werkzeug server handling the requests on a fixed pool of threads.
+    A connection is only handed over when a thread is free, so a busy
+    worker stops accepting and leaves the shared socket to the others.
+    """
+
+    def __init__(self, host, port, wsgi_app, threads, fd=None):
+        super().__init__(host, port, wsgi_app, fd=fd)
+        self.executor = ThreadPoolExecutor(threads, thread_name_prefix="gym-request")
+        self.slots = threading.Semaphore(threads)
+
+    def process_request(self, request, client_address):
+        """
+        Waits for a free thread and handles the request on it
+        """
+
+        self.slots.acquire() # pylint: disable=consider-using-with
+        self.executor.submit(self._process, request, client_address)
+
+    def _process(self, request, client_address):
+        """
+        Handles a request and frees its thread
+        """
+
+        try:
+            self.finish_request(request, client_address)
+        except Exception: # pylint: disable=broad-exception-caught
+            self.handle_error(request, client_address)
+        finally:
+            self.shutdown_request(request)
+            self.slots.release()
+
+    def server_close(self):
+        """
+        Closes the socket and waits for the requests in progress
+        """
+
+        super().server_close()
+        self.executor.shutdown()
+
+def _run_gunicorn(host, port, workers, threads): # pragma: no cover
+    """
+    Runs the preloaded app with gunicorn's gthread workers
+    """
+
+    class _Application(BaseApplication):
+        """
+        Gunicorn application serving the already imported app
+        """
+
+        def load_config(self):
+            """
+            Passes the options to gunicorn
+            """
+
+            self.cfg.set("bind", f"{host}:{port}")
+            self.cfg.set("workers", workers)
+            self.cfg.set("threads", threads)
+            self.cfg.set("worker_class", "gthread")
+            self.cfg.set("preload_app", True)
+
+        def load(self):
+            """
+            Returns the WSGI app
+            """
+
+            return app
+
+    _Application().run()
+
+def _run_prefork(host, port, workers, threads): # pragma: no cover
+    """
+    Minimal pre-fork server used when gunicorn is not installed.
+    The listening socket is bound in the master and shared by the
+    forked workers, each of which serves at most threads requests at a
+    time on a pool of threads.
+    """
+
+    sock = socket.socket(socket.AF_INET, socket.SOCK_STREAM)
+    sock.setsockopt(socket.SOL_SOCKET, socket.SO_REUSEADDR, 1)
+    sock.bind((host, port))
+    sock.listen(128)
+    sock.set_inheritable(True)
+
+    children = []
+    for _ in range(workers):
+        pid = os.fork()
+        if pid == 0:
+            signal.signal(signal.SIGTERM, signal.SIG_DFL)
+            signal.signal(signal.SIGINT, signal.SIG_DFL)
+            server = PooledWSGIServer(host, port, app, threads, fd=sock.fileno())
+            server.serve_forever()
+            os._exit(0)
+        children.append(pid)
+
+    def _stop(signum, _frame):
+        for pid in children:
+            os.kill(pid, signal.SIGTERM)
+        sys.exit(128 + signum)
+
+    signal.signal(signal.SIGTERM, _stop)
+    signal.signal(signal.SIGINT, _stop)
+    print(f"Serving on http://{host}:{port} with {workers} workers")
+    for pid in children:
+        os.waitpid(pid, 0)
+
+def run(host="127.0.0.1", port=5000, workers=None, threads=None): # pragma: no cover
+    """
+    Serves the app with several worker processes
+    """
+
+    workers = workers or default_workers()
+    threads = threads or default_threads()
+    check_pool_size(threads)
+    if BaseApplication is not None:
+        _run_gunicorn(host, port, workers, threads)
+    elif hasattr(os, "fork"):
+        _run_prefork(host, port, workers, threads)
+    else:
+        PooledWSGIServer(host, port, app, threads).serve_forever()
+
+def main(argv=None): # pragma: no cover
+    """
+    Command line entry point
+    """
+
+    parser = argparse.ArgumentParser(description="Serve the Gym Workout API")
+    parser.add_argument("--host", default="127.0.0.1")
+    parser.add_argument("--port", type=int, default=5000)
+    parser.add_argument("--workers", type=int, default=None)
+    parser.add_argument("--threads", type=int, default=None)
+    args = parser.parse_args(argv)
+    run(args.host, args.port, args.workers, args.threads)
+
+if __name__ == "__main__": # pragma: no cover
+    main(sys.argv[1:])
@@ -0,0 +1,94 @@
+"""
+Dialect-aware statements for the storage backends.
+
+The application runs on SQLite and PostgreSQL. The statements that have
+no portable form in SQLAlchemy Core (upserts, INSERT ... RETURNING on old
+SQLite versions) are built here for the dialect of the session's engine.
+The functions accept a Session or a Connection.
+"""
+
+from sqlalchemy import insert, select, update
+from sqlalchemy.exc import IntegrityError
+from sqlalchemy.dialects import postgresql, sqlite
+from sqlalchemy.engine import Connection
+
+UPSERT_INSERTS = {
+    "postgresql": postgresql.insert,
+    "sqlite": sqlite.insert
+}
+
+def _dialect(session):
+    """
+    Returns the dialect of a Session or a Connection
+    """
+
+    if isinstance(session, Connection):
+        return session.dialect
+    return session.get_bind().dialect
+
+def dialect_name(session):
+    """
+    Returns the name of the dialect of the session's engine
+    """
+
+    return _dialect(session).name
+
+def supports_returning(session):
+    """
+    Returns True if INSERT ... RETURNING can be used
+    """
+
+    return _dialect(session).insert_returning
+
+def upsert(session, table, values, index_elements, update_columns):
+    """
+    Inserts the rows, or updates update_columns of the rows that already
+    exist with the same index_elements. Uses INSERT ... ON CONFLICT on
+    PostgreSQL and SQLite and a select followed by an insert or update
+    on other databases.
+    """
+
+    if not values:
+        return
+    make_insert = UPSERT_INSERTS.get(dialect_name(session))
+    if make_insert is not None:
+        statement = make_insert(table)
+        statement = statement.on_conflict_do_update(
+            index_elements=index_elements,
+            set_={name: statement.excluded[name] for name in update_columns}
+        )
+        session.execute(statement, values)
+        return
+
+    for row in values:
+        criteria = [table.c[name] == row[name] for name in index_elements]
+        exists = session.execute(select(*[table.c[name] for name in index_elements])
+            .where(*criteria)).first()
+        if exists is None:
+            session.execute(insert(table).values(row))
+        else:
+            session.execute(update(table).where(*criteria)
+                .values({name: row[name] for name in update_columns}))
+
+def insert_ignore(session, table, values, index_elements):
+    """
+    Inserts the rows that do not exist yet with the same index_elements.
+    Uses INSERT ... ON CONFLICT DO NOTHING on PostgreSQL and SQLite and
+    a savepoint per row on other databases.
+    """
+
+    if not values:
+        return
+    make_insert = UPSERT_INSERTS.get(dialect_name(session))
+    if make_insert is not None:
+        session.execute(make_insert(table).on_conflict_do_nothing(
+            index_elements=index_elements
+        ), values)
+        return
+
+    for row in values:
+        try:
+            with session.begin_nested():
+                session.execute(insert(table).values(row))
+        except IntegrityError:
+            pass
@@ -0,0 +1,231 @@
+"""
+Precomputed per-user summary documents.
+
+The home screen shows the user's profile, workout and movement counts,
+favorite workouts and latest movements. They are kept in one JSON document
+per user in the user_summary table, so the screen is served with a single
+lookup. The documents of the affected users are updated at the end of
+every flush that writes a user, workout or movement, in the same
+transaction. Bulk statements bypass the ORM events and call
+refresh_summaries themselves.
+
+A flush is applied to the stored documents incrementally: new and
+updated users and workouts and new movements change the profile,
+counts, favorites and latest movements in place, so the cost of a write
+does not grow with the user's history. The documents are rebuilt from
+the tables when a workout or movement is deleted or a movement updated
+(the latest movements can't be told without the rest), and when a user
+has no document yet.
+
+The documents of several users are built or updated with a fixed number
+of statements, so a flush touching many users costs no more queries than
+one touching a single user.
+"""
+
+from sqlalchemy import event, select, delete, func, inspect
+from sqlalchemy.orm import Session
+from gymworkoutapi.models import User, Workout, Movement, Exercise, UserSummary, utcnow
+from gymworkoutapi.readmodels import UserRow
+from gymworkoutapi.changes import changed_entities
+from gymworkoutapi.storage import upsert
+
+LAST_MOVEMENTS = 5
+
+def build_summaries(connection, user_ids):
+    """
+    Builds the summary documents of the given users.
+    Returns {user_id: document} for the users that exist.
+    """
+
+    user_ids = list(user_ids)
+    documents = {}
+    for row in connection.execute(
+        select(User.id, *UserRow.columns()).where(User.id.in_(user_ids))
+    ):
+        documents[row[0]] = {
+            "profile": UserRow(*row[1:]).serialize(),
+            "workout_count": 0,
+            "movement_count": 0,
+            "favorites": [],
+            "last_movements": []
+        }
+    if not documents:
+        return documents
+
+    counts = connection.execute(
+        select(Workout.user_id, func.count(Workout.id.distinct()), func.count(Movement.id))
+        .outerjoin(Movement, Movement.workout_id == Workout.id)
+        .where(Workout.user_id.in_(user_ids))
+        .group_by(Workout.user_id)
+    )
+    for user_id, workout_count, movement_count in counts:
+        documents[user_id]["workout_count"] = workout_count
+        documents[user_id]["movement_count"] = movement_count
+
+    favorites = connection.execute(
+        select(Workout.user_id, Workout.workout_name)
+        .where(Workout.user_id.in_(user_ids), Workout.favorite.is_(True))
+        .order_by(Workout.user_id, Workout.workout_name)
+    )
+    for user_id, workout_name in favorites:
+        documents[user_id]["favorites"].append(workout_name)
+
+    # the latest movements of every user with one window query
+    ranked = (
+        select(
+            Workout.user_id, Workout.workout_name, Exercise.name.label("movement_name"),
+            Movement.sets, Movement.reps,
+            func.row_number().over(
+                partition_by=Workout.user_id, order_by=Movement.id.desc()
+            ).label("position")
+        )
+        .join(Movement, Movement.workout_id == Workout.id)
+        .join(Exercise, Exercise.id == Movement.exercise_id)
+        .where(Workout.user_id.in_(user_ids))
+    ).subquery()
+    latest = connection.execute(
+        select(ranked.c.user_id, ranked.c.workout_name, ranked.c.movement_name,
+            ranked.c.sets, ranked.c.reps)
+        .where(ranked.c.position <= LAST_MOVEMENTS)
+        .order_by(ranked.c.user_id, ranked.c.position)
+    )
+    for user_id, workout_name, movement_name, sets, reps in latest:
+        documents[user_id]["last_movements"].append({
+            "workout_name": workout_name,
+            "movement_name": movement_name,
+            "sets": sets,
+            "reps": reps
+        })
+    return documents
+
+def refresh_summaries(connection, user_ids):
+    """
+    Rebuilds and stores the summary documents of the given users and
+    removes the documents of the users that no longer exist
+    """
+
+    user_ids = set(user_ids)
+    if not user_ids:
+        return
+    documents = build_summaries(connection, user_ids)
+    now = utcnow()
+    upsert(connection, UserSummary.__table__, [
+        {"user_id": user_id, "document": document, "updated_at": now}
+        for user_id, document in documents.items()
+    ], ["user_id"], ["document", "updated_at"])
+    removed = user_ids - documents.keys()
+    if removed:
+        connection.execute(delete(UserSummary).where(UserSummary.user_id.in_(removed)))
+
+def _previous(obj, name):
+    """
+    Value of an attribute before the flush in progress
+    """
+
+    history = inspect(obj).attrs[name].history
+    return history.deleted[0] if history.deleted else getattr(obj, name)
+
+class _Delta:
+    """
+    Changes of one user's document in a flush
+    """
+
+    def __init__(self):
+        self.profile = None
+        self.workouts = []
+        self.renamed = {}
+        self.movements = []
+
+    def apply(self, document, names):
+        """
+        Applies the changes to a document, names has the workout and
+        movement names of the new movements by movement id
+        """
+
+        if self.profile is not None:
+            document["profile"] = self.profile
+        favorites = set(document["favorites"])
+        for old_name, (workout_name, favorite) in self.renamed.items():
+            favorites.discard(old_name)
+            if favorite:
+                favorites.add(workout_name)
+            for movement in document["last_movements"]:
+                if movement["workout_name"] == old_name:
+                    movement["workout_name"] = workout_name
+        for workout in self.workouts:
+            if workout.favorite:
+                favorites.add(workout.workout_name)
+        document["favorites"] = sorted(favorites)
+        document["workout_count"] += len(self.workouts)
+        document["movement_count"] += len(self.movements)
+        latest = [
+            {
+                "workout_name": names[movement.id][0],
+                "movement_name": names[movement.id][1],
+                "sets": movement.sets,
+                "reps": movement.reps
+            }
+            for movement in sorted(self.movements, key=lambda movement: movement.id, reverse=True)
+        ]
+        document["last_movements"] = (latest + document["last_movements"])[:LAST_MOVEMENTS]
+
+def update_summaries(session):
+    """
+    Updates the summary documents of the users whose data the flush in
+    progress wrote, rebuilding the ones that can't be updated in place
+    """
+
+    deltas = {}
+    rebuild = set()
+    for entity, obj, user_id, deleted in changed_entities(session):
+        new = obj in session.new
+        if deleted or (entity == "movement" and not new):
+            rebuild.add(user_id)
+            continue
+        delta = deltas.setdefault(user_id, _Delta())
+        if entity == "user":
+            delta.profile = obj.serialize()
+        elif entity == "workout" and new:
+            delta.workouts.append(obj)
+        elif entity == "workout":
+            delta.renamed[_previous(obj, "workout_name")] = (obj.workout_name, obj.favorite)
+        else:
+            delta.movements.append(obj)
+
+    connection = session.connection()
+    user_ids = deltas.keys() - rebuild
+    documents = {}
+    if user_ids:
+        documents = dict(connection.execute(
+            select(UserSummary.user_id, UserSummary.document)
+            .where(UserSummary.user_id.in_(user_ids))
+        ).all())
+    rebuild |= user_ids - documents.keys()
+
+    movement_ids = [movement.id for user_id in documents for movement in deltas[user_id].movements]
+    names = {}
+    if movement_ids:
+        # the flushed names, also of the workouts and exercises of this flush
+        names = {row[0]: row[1:] for row in connection.execute(
+            select(Movement.id, Workout.workout_name, Exercise.name)
+            .join(Workout, Workout.id == Movement.workout_id)
+            .join(Exercise, Exercise.id == Movement.exercise_id)
+            .where(Movement.id.in_(movement_ids))
+        )}
+
+    now = utcnow()
+    rows = []
+    for user_id, document in documents.items():
+        deltas[user_id].apply(document, names)
+        rows.append({"user_id": user_id, "document": document, "updated_at": now})
+    if rows:
+        upsert(connection, UserSummary.__table__, rows, ["user_id"], ["document", "updated_at"])
+    refresh_summaries(connection, rebuild)
+
+@event.listens_for(Session, "after_flush")
+def _refresh_on_flush(session, _flush_context):
+    """
+    Updates the summaries of the users whose data the flush changed
+    """
+
+    update_summaries(session)
@@ -3,8 +3,9 @@ REFERENCE:
 https://github.com/enkwolf/pwp-course-sensorhub-api-example/blob/master/sensorhub/utils.py
 """
 
+from flask import request
 from werkzeug.routing import BaseConverter
-from werkzeug.exceptions import NotFound
+from werkzeug.exceptions import NotFound, BadRequest
 from gymworkoutapi.models import User, Workout
 
 class UserConverter(BaseConverter):
@@ -54,3 +55,20 @@ class WorkoutConverter(BaseConverter):
         if isinstance(value, Workout) is not True:
             raise NotFound
         return value.workout_name
+
+def parse_fields(read_model):
+    """
+    Parses the comma separated "fields" query parameter and validates it
+    against the fields of the given read model. Returns None if the
+    parameter is not given. If an unknown field is requested,
+    BadRequest is raised.
+    """
+
+    value = request.args.get("fields")
+    if value is None:
+        return None
+    fields = tuple(dict.fromkeys(name.strip() for name in value.split(",")))
+    unknown = [name for name in fields if name not in read_model.__slots__]
+    if unknown:
+        raise BadRequest(description="Unknown fields: " + ", ".join(unknown))
+    return fields
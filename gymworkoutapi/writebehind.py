@@ -0,0 +1,354 @@
+"""
+Write-behind queue for movement logging.
+
+When MOVEMENT_WRITE_BEHIND is enabled, validated movements posted to
+WorkoutItem are acknowledged with 202 and placed on an in-process queue.
+A background thread flushes the queue in grouped transactions every
+MOVEMENT_FLUSH_INTERVAL_MS milliseconds or MOVEMENT_FLUSH_ROWS rows,
+whichever comes first.
+
+Durability is controlled with MOVEMENT_JOURNAL:
+  - "none": queued movements are lost if the process dies
+  - "flush": every movement is appended to a journal file before it is
+    acknowledged (survives a process crash)
+  - "fsync": as "flush" but the journal is also fsynced (survives a power loss)
+
+Every worker process writes its own journal under MOVEMENT_JOURNAL_DIR
+(instance/ by default) and rewrites it with the movements still queued
+after every flushed batch. The queue is started by the first request of
+a worker process, which replays the journals left behind by dead
+processes. A journal is claimed by renaming it while it is locked, so it
+is replayed by one process only.
+"""
+
+import os
+import glob
+import json
+import time
+import queue
+import atexit
+import threading
+from gymworkoutapi import db
+from gymworkoutapi.models import Workout, Movement, Exercise, normalize_name
+from gymworkoutapi.exercises import intern_exercises
+from gymworkoutapi.metrics import get_metrics
+
+try:
+    import fcntl
+except ImportError: # pragma: no cover
+    fcntl = None
+
+# journals and the journals claimed for a replay
+JOURNAL_PATTERN = "movement-journal-*.jsonl*"
+
+class MovementWriteQueue:
+    """
+    Class for the movement write-behind queue
+    """
+
+    def __init__(self, app, interval_ms=50, max_rows=500, journal="flush", journal_dir=None):
+        self.app = app
+        self.interval = interval_ms / 1000
+        self.max_rows = max_rows
+        self.journal_mode = journal
+        self.journal_dir = journal_dir or app.instance_path
+        self._queue = queue.Queue()
+        # the queued documents by (workout_id, normalized name)
+        self._pending = {}
+        self._lock = threading.RLock()
+        self._journal = None
+        self._thread = None
+        self._pid = None
+        self._stopping = threading.Event()
+
+    def ensure_started(self):
+        """
+        Starts the flusher thread in the current process. Threads do not
+        survive a fork, so this is done lazily on the first request.
+        """
+
+        if self._pid == os.getpid():
+            return
+        with self._lock:
+            if self._pid == os.getpid():
+                return
+            self._pid = os.getpid()
+            self._queue = queue.Queue()
+            self._pending = {}
+            self._stopping.clear()
+            if self.journal_mode != "none":
+                self._open_journal()
+                self._replay_orphans()
+            self._thread = threading.Thread(
+                target=self._run, name="movement-write-behind", daemon=True
+            )
+            self._thread.start()
+            atexit.register(self.stop)
+
+    def _journal_path(self, pid):
+        """
+        Journal file of the given process
+        """
+
+        return os.path.join(self.journal_dir, f"movement-journal-{pid}.jsonl")
+
+    def _open_journal(self):
+        """
+        Opens and locks the journal of this process
+        """
+
+        os.makedirs(self.journal_dir, exist_ok=True)
+        # kept open and locked while the queue runs, closed by stop()
+        self._journal = open( # pylint: disable=consider-using-with
+            self._journal_path(self._pid), "a", encoding="utf-8"
+        )
+        if fcntl is not None:
+            fcntl.flock(self._journal, fcntl.LOCK_EX | fcntl.LOCK_NB)
+
+    def _compact_journal(self):
+        """
+        Rewrites the journal with the queued documents. The new journal
+        is written and locked next to the old one and renamed over it,
+        so a crash leaves one of the two complete. Called with the lock held.
+        """
+
+        if not self._pending:
+            self._journal.truncate(0)
+            self._journal.seek(0)
+            return
+        path = self._journal_path(self._pid)
+        # not matched by JOURNAL_PATTERN, so never taken for an orphan
+        temp_path = os.path.join(self.journal_dir, f".movement-journal-{self._pid}.tmp")
+        journal = open(temp_path, "w", encoding="utf-8") # pylint: disable=consider-using-with
+        if fcntl is not None:
+            fcntl.flock(journal, fcntl.LOCK_EX | fcntl.LOCK_NB)
+        journal.writelines(json.dumps(doc) + "\n" for doc in self._pending.values())
+        journal.flush()
+        if self.journal_mode == "fsync":
+            os.fsync(journal.fileno())
+        os.replace(temp_path, path)
+        self._journal.close()
+        self._journal = journal
+
+    def _claim(self, path):
+        """
+        Returns the open and locked journal of a dead process, renamed so
+        that no other process replays it, or None if its owner is alive
+        or another process claimed it first
+        """
+
+        try:
+            orphan = open(path, "r", encoding="utf-8") # pylint: disable=consider-using-with
+        except FileNotFoundError:
+            return None
+        try:
+            if fcntl is not None:
+                # fails while the owner or another replaying process holds it
+                fcntl.flock(orphan, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            claimed = path[:path.index(".jsonl") + len(".jsonl")] + f".replay-{self._pid}"
+            # a process that locked the file after it was claimed finds it gone
+            os.rename(path, claimed)
+        except OSError:
+            orphan.close()
+            return None
+        return orphan, claimed
+
+    def _replay_orphans(self):
+        """
+        Replays journals whose owning process is gone. A claimed journal
+        stays locked until its movements are queued and it is removed.
+        """
+
+        own = self._journal_path(self._pid)
+        for path in glob.glob(os.path.join(self.journal_dir, JOURNAL_PATTERN)):
+            if path == own:
+                continue
+            claim = self._claim(path)
+            if claim is None:
+                continue
+            orphan, claimed = claim
+            with orphan:
+                docs = [json.loads(line) for line in orphan if line.strip()]
+                with self.app.app_context():
+                    for doc in docs:
+                        if db.session.get(Workout, doc["workout_id"]) is None:
+                            continue
+                        exists = Movement.query.join(Exercise).filter(
+                            Movement.workout_id == doc["workout_id"],
+                            Exercise.normalized_name == normalize_name(doc["movement_name"])
+                        ).first()
+                        if exists is not None:
+                            continue
+                        with self._lock:
+                            if not self.is_pending(doc["workout_id"], doc["movement_name"]):
+                                self._enqueue(doc)
+                os.remove(claimed)
+
+    def _enqueue(self, doc):
+        """
+        Journals and queues a movement document
+        """
+
+        with self._lock:
+            if self._journal is not None:
+                self._journal.write(json.dumps(doc) + "\n")
+                self._journal.flush()
+                if self.journal_mode == "fsync":
+                    os.fsync(self._journal.fileno())
+            self._pending[(doc["workout_id"], normalize_name(doc["movement_name"]))] = doc
+            self._queue.put(doc)
+
+    def is_pending(self, workout_id, movement_name):
+        """
+        Returns True if the movement is queued but not yet written,
+        in any spelling of its name
+        """
+
+        with self._lock:
+            return (workout_id, normalize_name(movement_name)) in self._pending
+
+    def try_submit(self, doc):
+        """
+        Accepts a validated movement document for writing, unless the
+        movement is already queued. Returns False if it is.
+        """
+
+        self.ensure_started()
+        with self._lock:
+            # checked and added under the lock, so that only one of two
+            # concurrent posts of the same movement is accepted
+            if self.is_pending(doc["workout_id"], doc["movement_name"]):
+                return False
+            self._enqueue(doc)
+        get_metrics().gauge("movement_queue.depth", self._queue.qsize())
+        return True
+
+    def _run(self):
+        """
+        Flusher loop
+        """
+
+        while not self._stopping.is_set() or not self._queue.empty():
+            try:
+                batch = [self._queue.get(timeout=self.interval)]
+            except queue.Empty:
+                continue
+            deadline = time.monotonic() + self.interval
+            while len(batch) < self.max_rows:
+                timeout = deadline - time.monotonic()
+                if timeout <= 0:
+                    break
+                try:
+                    batch.append(self._queue.get(timeout=timeout))
+                except queue.Empty:
+                    break
+            self._flush(batch)
+
+    @staticmethod
+    def _write(docs):
+        """
+        Writes movement documents in one transaction
+        """
+
+        # the names of the whole batch are interned with two queries
+        exercise_ids = intern_exercises(db.session, [doc["movement_name"] for doc in docs])
+        db.session.add_all([
+            Movement(
+                workout_id=doc["workout_id"],
+                exercise_id=exercise_ids[normalize_name(doc["movement_name"])],
+                sets=doc["sets"],
+                reps=doc["reps"]
+            )
+            for doc in docs
+        ])
+        db.session.commit()
+
+    def _flush(self, batch):
+        """
+        Writes a batch of movements in one transaction. If the batch fails,
+        its movements are written one by one and only the failing ones
+        are dropped, e.g. a movement whose workout was deleted after it
+        was accepted.
+        """
+
+        start = time.perf_counter()
+        failed = 0
+        with self.app.app_context():
+            metrics = get_metrics()
+            try:
+                try:
+                    self._write(batch)
+                except Exception: # pylint: disable=broad-except
+                    db.session.rollback()
+                    for doc in batch:
+                        try:
+                            self._write([doc])
+                        except Exception: # pylint: disable=broad-except
+                            db.session.rollback()
+                            failed += 1
+            finally:
+                db.session.remove()
+            # recorded before task_done, so join() returns with the metrics updated
+            metrics.observe("movement_queue.flush_latency", time.perf_counter() - start)
+            if failed:
+                metrics.incr("movement_queue.failed", failed)
+            metrics.incr("movement_queue.flushed", len(batch) - failed)
+            metrics.incr("movement_queue.batches")
+            with self._lock:
+                # the failed movements are discarded too, so that they
+                # can be posted again
+                for doc in batch:
+                    self._pending.pop((doc["workout_id"], normalize_name(doc["movement_name"])),
+                        None)
+                if self._journal is not None:
+                    # the journal only holds the movements that are still queued
+                    self._compact_journal()
+                for doc in batch:
+                    self._queue.task_done()
+            metrics.gauge("movement_queue.depth", self._queue.qsize())
+
+    def join(self):
+        """
+        Blocks until every submitted movement has been written
+        """
+
+        if self._pid == os.getpid():
+            self._queue.join()
+
+    def stop(self):
+        """
+        Flushes the remaining movements and stops the flusher thread
+        """
+
+        if self._pid != os.getpid() or self._thread is None:
+            return
+        self._stopping.set()
+        self._thread.join()
+        self._thread = None
+        self._pid = None
+        if self._journal is not None:
+            if not self._pending:
+                self._journal.close()
+                os.remove(self._journal_path(os.getpid()))
+            else:
+                self._journal.close()
+            self._journal = None
+
+def init_app(app):
+    """
+    Creates the write-behind queue if it is enabled in the config
+    """
+
+    if not app.config.get("MOVEMENT_WRITE_BEHIND"):
+        return
+    write_queue = MovementWriteQueue(
+        app,
+        interval_ms=app.config["MOVEMENT_FLUSH_INTERVAL_MS"],
+        max_rows=app.config["MOVEMENT_FLUSH_ROWS"],
+        journal=app.config["MOVEMENT_JOURNAL"],
+        journal_dir=app.config.get("MOVEMENT_JOURNAL_DIR")
+    )
+    app.extensions["movement_queue"] = write_queue
+    # started in the serving processes only, not in a pre-fork master or
+    # a CLI command, which may run before the migrations
+    app.before_request(write_queue.ensure_started)
@@ -0,0 +1,106 @@
+"""
+Shared test setup: SQLite test databases and the suite timing report.
+
+The test databases are named shared-cache in-memory SQLite databases, so
+every connection of a test's engine sees the same data and nothing is
+left on disk. The schema and the test data are built once per session
+into a template database, and every test starts from a copy of it made
+with the SQLite backup API.
+
+Shared-cache databases lock whole tables and fail instead of waiting
+when a lock is taken, so tests that write from several threads use a
+copy in a file instead.
+
+The suite runs in parallel with pytest-xdist installed:
+  - pytest -n auto
+
+REFERENCE:
+https://www.sqlite.org/inmemorydb.html#sharedmemdb
+https://www.sqlite.org/sharedcache.html#table_level_locking
+https://docs.python.org/3/library/sqlite3.html#sqlite3.Connection.backup
+https://pytest-xdist.readthedocs.io/en/stable/
+"""
+
+import os
+import time
+import sqlite3
+import itertools
+
+_names = itertools.count()
+
+class TestDatabase:
+    """
+    A SQLite test database, a named shared-cache in-memory database
+    unless a directory for a database file is given. An in-memory
+    database exists as long as its keeper connection is open.
+    """
+
+    __test__ = False
+
+    def __init__(self, name, directory=None):
+        # the names are unique per xdist worker process and per database,
+        # and absolute, so Flask-SQLAlchemy does not move them to the
+        # instance folder
+        worker = os.environ.get("PYTEST_XDIST_WORKER", "main")
+        name = f"{name}-{worker}-{os.getpid()}-{next(_names)}"
+        if directory is None:
+            self.path = f"file:/{name}?mode=memory&cache=shared"
+            self.uri = f"sqlite:///{self.path}&uri=true"
+        else:
+            self.path = f"file:{os.path.join(directory, name)}.db"
+            self.uri = f"sqlite:///{self.path[5:]}"
+        self.keeper = sqlite3.connect(self.path, uri=True, check_same_thread=False)
+
+    def restore(self, snapshot):
+        """
+        Replaces the contents of this database with a copy of the snapshot database
+        """
+
+        snapshot.keeper.backup(self.keeper)
+
+    def close(self):
+        """
+        Closes the keeper connection, which frees an in-memory database
+        once the application's connections are closed too
+        """
+
+        self.keeper.close()
+
+class SuiteTimer:
+    """
+    Plugin reporting the wall time of the suite and the time spent in the
+    tests, which shows the speed-up of a parallel run
+    """
+
+    def __init__(self, config):
+        self.config = config
+        self.started = time.perf_counter()
+        self.busy = 0.0
+
+    def pytest_runtest_logreport(self, report):
+        """
+        Adds up the setup, call and teardown durations of the tests,
+        also the ones reported by xdist workers
+        """
+
+        self.busy += report.duration
+
+    def pytest_terminal_summary(self, terminalreporter):
+        """
+        Writes the timing report
+        """
+
+        wall = time.perf_counter() - self.started
+        workers = self.config.getoption("numprocesses", None)
+        terminalreporter.write_sep("-", "timing")
+        terminalreporter.write_line(
+            f"suite wall time {wall:.2f} s, time in tests {self.busy:.2f} s"
+            + (f", {workers} workers" if workers else "")
+        )
+
+def pytest_configure(config):
+    """
+    Registers the timing report
+    """
+
+    config.pluginmanager.register(SuiteTimer(config), "suite-timer")
@@ -4,15 +4,49 @@ https://github.com/enkwolf/pwp-course-sensorhub-api-example/blob/master/tests/re
 AND
 https://lovelace.oulu.fi/ohjelmoitava-web/ohjelmoitava-web/testing-flask-applications-part-2/
 """
+import io
 import os
+import glob
+import csv
 import json
 import tempfile
 import random
+import sqlite3
+import time
+import threading
+import pstats
+import queue
+import logging
+from types import SimpleNamespace
 import pytest
 from sqlalchemy.engine import Engine
-from sqlalchemy import event
-from gymworkoutapi.models import User, Workout, Movement
+from sqlalchemy import event, pool, inspect, create_engine, text, MetaData
+from sqlalchemy import Table, Column, Boolean, Index, insert, select
+from gymworkoutapi.models import User, Workout, Movement, Exercise, UserSummary, utcnow
+from gymworkoutapi.summaries import build_summaries, refresh_summaries
 from gymworkoutapi import create_app, db
+from gymworkoutapi.resources.workout import build_workout_query
+from gymworkoutapi.ratelimit import AdmissionMiddleware, MemoryBackend
+from gymworkoutapi.coalesce import SingleFlight
+from gymworkoutapi.changes import append_changes
+from gymworkoutapi import migrations
+from gymworkoutapi.storage import upsert
+from gymworkoutapi.idempotency import IdempotencyStore
+from gymworkoutapi.exercises import merge_movements
+from gymworkoutapi.writebehind import MovementWriteQueue
+from gymworkoutapi.profiling import ProfilingMiddleware
+from gymworkoutapi.export import write_table
+from gymworkoutapi.maintenance import run_maintenance
+from gymworkoutapi.accesslog import BatchingRotatingFileHandler, DroppingQueueHandler, JsonFormatter
+from tests.conftest import TestDatabase
+
+# set to run the tests against another database, e.g.
+# TEST_DATABASE_URI=postgresql+psycopg://localhost/gym_test
+TEST_DATABASE_URI = os.environ.get("TEST_DATABASE_URI")
+sqlite_only = pytest.mark.skipif(
+    TEST_DATABASE_URI is not None and not TEST_DATABASE_URI.startswith("sqlite"),
+    reason="SQLite specific test"
+)
 
 @event.listens_for(Engine, "connect")
 def set_sqlite_pragma(dbapi_connection, _):
@@ -20,33 +54,74 @@ def set_sqlite_pragma(dbapi_connection, _):
     Enable foreign keys for SQLite
     """
 
+    if not isinstance(dbapi_connection, sqlite3.Connection):
+        return
     cursor = dbapi_connection.cursor()
     cursor.execute("PRAGMA foreign_keys=ON")
     cursor.close()
 
+@pytest.fixture(scope="session")
+def template_db():
+    """
+    In-memory database with the schema and the test data,
+    built once and copied for every test
+    """
+
+    if TEST_DATABASE_URI:
+        yield None
+        return
+    template = TestDatabase("template")
+    app = create_app({"SQLALCHEMY_DATABASE_URI": template.uri, "TESTING": True})
+    with app.app_context():
+        db.create_all()
+        _populate_db()
+        db.engine.dispose()
+    yield template
+    template.close()
+
 @pytest.fixture
-def client():
+def make_app(template_db, tmp_path):
     """
-    Testing client
+    Factory of applications on a fresh copy of the test data, in memory
+    or in a file if on_disk is set. The given config is added to the
+    test config. The databases are released after the test.
     """
 
-    db_fd, db_fname = tempfile.mkstemp()
+    created = []
 
-    config = {
-        "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
-        "TESTING": True
-    }
+    def _make_app(on_disk=False, **config):
+        database = None
+        if template_db is not None:
+            database = TestDatabase("test", str(tmp_path) if on_disk else None)
+            database.restore(template_db)
+        app = create_app(dict({
+            "SQLALCHEMY_DATABASE_URI": TEST_DATABASE_URI or database.uri,
+            "TESTING": True
+        }, **config))
+        if template_db is None:
+            with app.app_context():
+                db.create_all()
+                _populate_db()
+        created.append((app, database))
+        return app
 
-    app = create_app(config)
+    yield _make_app
 
-    with app.app_context():
-        db.create_all()
-        _populate_db()
+    for app, database in created:
+        with app.app_context():
+            if database is None:
+                db.drop_all()
+            db.engine.dispose()
+        if database is not None:
+            database.close()
 
-    yield app.test_client()
+@pytest.fixture
+def client(make_app):
+    """
+    Testing client
+    """
 
-    os.close(db_fd)
-    #os.unlink(db_fname)
+    return make_app().test_client()
 
 def _populate_db():
     """
@@ -81,6 +156,55 @@ def _populate_db():
 
     db.session.commit()
 
+class _RecordingConnection:
+    """
+    Stand-in for a connection of the given dialect, recording the SQL
+    of the executed statements
+    """
+
+    def __init__(self, dialect_name):
+        self.dialect = SimpleNamespace(name=dialect_name)
+        self.statements = []
+
+    def execute(self, statement, *_params):
+        """
+        Records the statement
+        """
+
+        self.statements.append(str(statement))
+
+class _PostgresConnection:
+    """
+    A connection that reports the postgresql dialect, for running the
+    PostgreSQL branches of the migrations on SQLite
+    """
+
+    def __init__(self, connection):
+        self._connection = connection
+        self.dialect = SimpleNamespace(name="postgresql")
+        self.engine = connection.engine
+
+    def execute(self, statement, *args):
+        """
+        Executes the statement on the wrapped connection
+        """
+
+        return self._connection.execute(statement, *args)
+
+    def commit(self):
+        """
+        Commits the wrapped connection
+        """
+
+        self._connection.commit()
+
+    def execution_options(self, **options):
+        """
+        Sets execution options of the wrapped connection
+        """
+
+        return self._connection.execution_options(**options)
+
 def _get_user_json(number=1):
     """
     Creates a valid user JSON object to be used for PUT and POST tests.
@@ -370,9 +494,11 @@ class TestWorkoutItem():
         assert body["sets"] == 3
         assert body["reps"] == 5
 
-        # send same data again for 409
+        # send same data again for 409, also with another spelling of the name
         resp = client.post(self.RESOURCE_URL, json=valid)
         assert resp.status_code == 409
+        resp = client.post(self.RESOURCE_URL, json=dict(valid, movement_name="Extra Movement 1"))
+        assert resp.status_code == 409
 
         # remove field for 400
         valid.pop("sets")
@@ -403,6 +529,39 @@ class TestMovementItem():
         resp = client.get(self.INVALID_URL)
         assert resp.status_code == 404
 
+    def test_resolve(self, client):
+        """
+        Tests that a movement is found by any spelling of its name and by
+        its exercise id, that the movements of other workouts don't change
+        what a URL refers to, and that the names are stored once in the
+        catalog
+        """
+
+        body = json.loads(client.get(self.RESOURCE_URL).data)
+        url = "/api/users/test_user1/workouts/test_workout1/"
+        for name in ("Test Movement1", "TEST-MOVEMENT-1", str(body["exercise_id"])):
+            resp = client.get(url + name + "/")
+            assert resp.status_code == 200
+            assert json.loads(resp.data) == body
+
+        resp = client.post("/api/users/test_user3/workouts/test_workout5/",
+            json={"movement_name": str(body["exercise_id"]), "sets": 1, "reps": 1})
+        assert resp.status_code == 201
+        resp = client.get(url + str(body["exercise_id"]) + "/")
+        assert resp.status_code == 200
+        assert json.loads(resp.data) == body
+        resp = client.get("/api/users/test_user1/workouts/test_workout2/"
+            + str(body["exercise_id"]) + "/")
+        assert resp.status_code == 404
+
+        resp = client.post("/api/users/test_user1/workouts/test_workout2/",
+            json={"movement_name": "Test Movement 1", "sets": 1, "reps": 1})
+        assert resp.status_code == 201
+        resp = client.get("/api/users/test_user1/workouts/test_workout2/test_movement1/")
+        assert json.loads(resp.data)["exercise_id"] == body["exercise_id"]
+        with client.application.app_context():
+            assert Exercise.query.count() == 13
+
     def test_delete(self, client):
         """
         Tests the DELETE method. Checks the following:
@@ -416,4 +575,1425 @@ class TestMovementItem():
         assert resp.status_code == 404
         resp = client.delete(self.INVALID_URL)
         assert resp.status_code == 400
-        
\ No newline at end of file
+        
+
+@pytest.fixture
+def write_behind_app(make_app, tmp_path):
+    """
+    Application with the movement write-behind queue enabled
+    """
+
+    # the flusher thread writes while the requests read
+    app = make_app(
+        on_disk=True,
+        MOVEMENT_WRITE_BEHIND=True,
+        MOVEMENT_FLUSH_INTERVAL_MS=10,
+        MOVEMENT_JOURNAL_DIR=str(tmp_path)
+    )
+
+    yield app
+
+    app.extensions["movement_queue"].stop()
+
+class TestMovementWriteBehind():
+    """
+    This class implements tests for the movement write-behind queue.
+    """
+    RESOURCE_URL = "/api/users/test_user1/workouts/test_workout1/"
+
+    def test_post(self, write_behind_app):
+        """
+        Tests that movements are accepted with 202 and written in a batch
+        """
+
+        client = write_behind_app.test_client()
+        for i in range(1, 4):
+            resp = client.post(self.RESOURCE_URL, json=_get_movement_json(i))
+            assert resp.status_code == 202
+
+        # the same movement is still queued
+        resp = client.post(self.RESOURCE_URL, json=_get_movement_json(1))
+        assert resp.status_code == 409
+
+        write_behind_app.extensions["movement_queue"].join()
+        resp = client.get(self.RESOURCE_URL + "extra_movement3/")
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert body["sets"] == 3
+
+        resp = client.get("/api/metrics/")
+        body = json.loads(resp.data)
+        assert body["counters"]["movement_queue.flushed"] == 3
+        assert "movement_queue.flush_latency" in body["timings"]
+
+    def test_failed_row(self, write_behind_app):
+        """
+        Tests that a movement that can't be written is dropped without
+        the rest of its batch and can be posted again
+        """
+
+        write_queue = write_behind_app.extensions["movement_queue"]
+        # the workout of the second movement does not exist (was deleted)
+        with write_behind_app.app_context():
+            assert write_queue.try_submit({"workout_id": 1, "movement_name": "kept",
+                "sets": 1, "reps": 1})
+            assert write_queue.try_submit({"workout_id": 999999, "movement_name": "lost",
+                "sets": 1, "reps": 1})
+        write_queue.join()
+
+        assert not write_queue.is_pending(999999, "lost")
+        with write_behind_app.app_context():
+            assert Movement.query.join(Exercise).filter(Exercise.name == "kept").count() == 1
+            assert Movement.query.filter_by(workout_id=999999).count() == 0
+        body = json.loads(write_behind_app.test_client().get("/api/metrics/").data)
+        assert body["counters"]["movement_queue.failed"] >= 1
+        assert body["counters"]["movement_queue.flushed"] == 1
+
+    def test_compaction(self, write_behind_app, monkeypatch):
+        """
+        Tests that the journal only holds the queued movements after
+        every flushed batch
+        """
+
+        write_queue = write_behind_app.extensions["movement_queue"]
+        entered = threading.Semaphore(0)
+        gate = threading.Semaphore(0)
+        write = MovementWriteQueue._write # pylint: disable=protected-access
+
+        def _gated_write(docs):
+            entered.release()
+            gate.acquire()
+            write(docs)
+
+        monkeypatch.setattr(MovementWriteQueue, "_write", staticmethod(_gated_write))
+        docs = [dict(_get_movement_json(i), workout_id=1) for i in range(1, 4)]
+        with write_behind_app.app_context():
+            write_queue.try_submit(docs[0])
+            assert entered.acquire(timeout=5)
+            write_queue.try_submit(docs[1])
+            write_queue.try_submit(docs[2])
+        path = write_queue._journal_path(os.getpid()) # pylint: disable=protected-access
+        with open(path, encoding="utf-8") as journal:
+            assert len(journal.readlines()) == 3
+
+        gate.release()
+        assert entered.acquire(timeout=5)
+        with open(path, encoding="utf-8") as journal:
+            assert [json.loads(line) for line in journal] == docs[1:]
+        gate.release()
+        write_queue.join()
+        assert os.path.getsize(path) == 0
+
+    def test_replay(self, write_behind_app):
+        """
+        Tests that the journals left behind by dead processes, or claimed
+        by a dead replaying process, are replayed by the first request
+        and that a journal still locked by its owner is not
+        """
+
+        fcntl = pytest.importorskip("fcntl")
+        write_queue = write_behind_app.extensions["movement_queue"]
+        journals = {
+            "movement-journal-999999999.jsonl": "replayed",
+            "movement-journal-999999998.jsonl.replay-999999997": "claimed",
+            "movement-journal-999999996.jsonl": "alive"
+        }
+        for name, movement_name in journals.items():
+            with open(os.path.join(write_queue.journal_dir, name), "w", encoding="utf-8") as journal:
+                journal.write(json.dumps({"workout_id": 1, "movement_name": movement_name,
+                    "sets": 2, "reps": 8}) + "\n")
+        write_queue.stop()
+
+        app = create_app({
+            "SQLALCHEMY_DATABASE_URI": write_behind_app.config["SQLALCHEMY_DATABASE_URI"],
+            "TESTING": True,
+            "MOVEMENT_WRITE_BEHIND": True,
+            "MOVEMENT_FLUSH_INTERVAL_MS": 10,
+            "MOVEMENT_JOURNAL_DIR": write_queue.journal_dir
+        })
+        pattern = os.path.join(write_queue.journal_dir, "movement-journal-*")
+        assert sorted(os.path.basename(path) for path in glob.glob(pattern)) == sorted(journals)
+        alive = os.path.join(write_queue.journal_dir, "movement-journal-999999996.jsonl")
+        with open(alive, encoding="utf-8") as owner:
+            fcntl.flock(owner, fcntl.LOCK_EX | fcntl.LOCK_NB)
+            assert app.test_client().get("/api/users/").status_code == 200
+            app.extensions["movement_queue"].stop()
+        assert glob.glob(pattern) == [alive]
+        with app.app_context():
+            names = {exercise.name for exercise in Exercise.query}
+            assert {"replayed", "claimed"} <= names
+            assert "alive" not in names
+
+class TestChangeCollection():
+    """
+    This class implements tests for the ChangeCollection resource.
+    """
+    RESOURCE_URL = "/api/users/test_user1/changes/"
+
+    def test_get(self, client):
+        """
+        Tests the GET method. Checks the following:
+        the first sync returns the user's data, later syncs only return
+        what changed after the token, deletions are returned as tombstones.
+        """
+
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        entities = {(item["entity"], item["id"]) for item in body["changes"]}
+        assert ("user", 1) in entities
+        assert ("workout", 1) in entities
+        assert ("workout", 3) not in entities
+        token = body["token"]
+
+        resp = client.get(self.RESOURCE_URL + "?since=" + token)
+        body = json.loads(resp.data)
+        assert body["changes"] == []
+        assert body["token"] == token
+
+        client.post("/api/users/test_user1/workouts/", json=_get_workout_json())
+        client.delete("/api/users/test_user1/workouts/test_workout1/test_movement1/")
+        client.post("/api/users/test_user2/workouts/", json=_get_workout_json(2))
+
+        resp = client.get(self.RESOURCE_URL + "?since=" + token)
+        body = json.loads(resp.data)
+        assert len(body["changes"]) == 2
+        created, deleted = body["changes"]
+        assert created["entity"] == "workout"
+        assert created["data"]["workout_name"] == "extra_workout1"
+        assert "updated_at" in created["data"]
+        assert deleted == {"entity": "movement", "id": 1, "deleted": True}
+
+        resp = client.get(self.RESOURCE_URL + "?since=" + token + "&limit=1")
+        body = json.loads(resp.data)
+        assert body["more"] is True
+        assert len(body["changes"]) == 1
+
+        resp = client.get(self.RESOURCE_URL + "?since=abc")
+        assert resp.status_code == 400
+
+    def test_postgresql_lock(self):
+        """
+        Tests that the change log writers take the advisory lock on
+        PostgreSQL only
+        """
+
+        rows = [{"user_id": 1, "entity": "user", "entity_id": 1, "deleted": False}]
+        connection = _RecordingConnection("postgresql")
+        append_changes(connection, rows)
+        assert "pg_advisory_xact_lock" in connection.statements[0]
+        assert connection.statements[1].startswith("INSERT INTO change_log")
+
+        connection = _RecordingConnection("sqlite")
+        append_changes(connection, rows)
+        assert len(connection.statements) == 1
+
+@sqlite_only
+class TestEngineConfig():
+    """
+    This class implements tests for the engine options built by create_app.
+    """
+
+    def test_options(self):
+        """
+        Tests that the pool class and the SQLite pragmas are applied
+        """
+
+        db_fd, db_fname = tempfile.mkstemp()
+        app = create_app({
+            "SQLALCHEMY_DATABASE_URI": "sqlite:///" + db_fname,
+            "TESTING": True,
+            "DB_POOL_CLASS": "singleton",
+            "DB_POOL_PRE_PING": True
+        })
+        with app.app_context():
+            assert isinstance(db.engine.pool, pool.SingletonThreadPool)
+            with db.engine.connect() as conn:
+                assert conn.exec_driver_sql("PRAGMA journal_mode").scalar() == "wal"
+                assert conn.exec_driver_sql("PRAGMA busy_timeout").scalar() == 5000
+            db.engine.dispose()
+        os.close(db_fd)
+        os.unlink(db_fname)
+
+class TestFields():
+    """
+    This class implements tests for the "fields" query parameter.
+    """
+
+    def test_collections(self, client):
+        """
+        Tests that collections only contain the requested fields
+        """
+
+        resp = client.get("/api/users/?fields=username,bmi")
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert len(body) == 3
+        for item in body:
+            assert set(item) == {"username", "bmi"}
+
+        resp = client.get("/api/users/test_user1/workouts/?fields=workout_name")
+        body = json.loads(resp.data)
+        assert body == [{"workout_name": "test_workout2"}, {"workout_name": "test_workout1"}]
+
+    def test_items(self, client):
+        """
+        Tests that items only contain the requested fields
+        """
+
+        resp = client.get("/api/users/test_user1/?fields=username")
+        assert json.loads(resp.data) == {"username": "test_user1"}
+
+        resp = client.get("/api/users/test_user1/workouts/test_workout1/?fields=favorite")
+        assert set(json.loads(resp.data)) == {"favorite"}
+
+        resp = client.get(
+            "/api/users/test_user1/workouts/test_workout1/test_movement1/?fields=sets,reps"
+        )
+        assert set(json.loads(resp.data)) == {"sets", "reps"}
+
+    def test_invalid(self, client):
+        """
+        Tests that unknown fields result in 400
+        """
+
+        resp = client.get("/api/users/?fields=username,password")
+        assert resp.status_code == 400
+        resp = client.get("/api/users/test_user1/?fields=")
+        assert resp.status_code == 400
+
+class TestWorkoutFilters():
+    """
+    This class implements tests for filtering and sorting WorkoutCollection.
+    """
+    RESOURCE_URL = "/api/users/test_user1/workouts/"
+    COMBINATIONS = [
+        {},
+        {"favorite": "true"},
+        {"favorite": "false", "sort": "workout_name"},
+        {"name_prefix": "test"},
+        {"name_prefix": "test", "sort": "-workout_name"},
+        {"favorite": "true", "name_prefix": "test", "sort": "workout_name"},
+        {"min_movements": "1"},
+        {"favorite": "true", "min_movements": "1", "max_movements": "5", "sort": "id"},
+    ]
+
+    def test_get(self, client):
+        """
+        Tests the filters and the sort orders
+        """
+
+        for i in range(1, 4):
+            client.post(self.RESOURCE_URL, json={"workout_name": f"extra_workout{i}",
+                "favorite": i != 2})
+
+        resp = client.get(self.RESOURCE_URL + "?favorite=true&name_prefix=extra&sort=workout_name")
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert [item["workout_name"] for item in body] == ["extra_workout1", "extra_workout3"]
+
+        resp = client.get(self.RESOURCE_URL + "?sort=-workout_name&fields=workout_name")
+        body = json.loads(resp.data)
+        names = [item["workout_name"] for item in body]
+        assert names == sorted(names, reverse=True)
+
+        # the populated movements all belong to test_workout1 and test_workout2
+        resp = client.get(self.RESOURCE_URL + "?min_movements=1&sort=workout_name")
+        body = json.loads(resp.data)
+        assert [item["workout_name"] for item in body] == ["test_workout1", "test_workout2"]
+        resp = client.get(self.RESOURCE_URL + "?max_movements=0")
+        assert len(json.loads(resp.data)) == 3
+
+        for query in ("?favorite=yes", "?sort=height", "?min_movements=-1"):
+            resp = client.get(self.RESOURCE_URL + query)
+            assert resp.status_code == 400
+
+    @sqlite_only
+    def test_query_plans(self, client):
+        """
+        Tests with EXPLAIN QUERY PLAN that every supported combination
+        is answered with index searches instead of table scans
+        """
+
+        app = client.application
+        with app.app_context():
+            user = User.query.filter_by(username="test_user1").first()
+            for args in self.COMBINATIONS:
+                statement = build_workout_query(user, args)
+                sql = str(statement.compile(
+                    dialect=db.engine.dialect, compile_kwargs={"literal_binds": True}
+                ))
+                plan = db.session.connection().exec_driver_sql("EXPLAIN QUERY PLAN " + sql).all()
+                details = [row[-1] for row in plan]
+                assert any("USING" in detail and "INDEX" in detail for detail in details), args
+                assert not any(detail.startswith("SCAN") for detail in details), (args, details)
+
+class TestWorkoutClone():
+    """
+    This class implements tests for the WorkoutClone resource.
+    """
+    RESOURCE_URL = "/api/users/test_user1/workouts/test_workout1/clone/"
+
+    def test_post(self, client):
+        """
+        Tests the POST method. Checks the following:
+        the copies and their movements exist afterwards, error codes
+        """
+
+        resp = client.post(self.RESOURCE_URL, json={"targets": ["test_user2", "test_user3"]})
+        assert resp.status_code == 201
+        for username in ("test_user2", "test_user3"):
+            url = f"/api/users/{username}/workouts/test_workout1-{username}/"
+            resp = client.get(url)
+            assert resp.status_code == 200
+            resp = client.get(url + "test_movement1/")
+            assert resp.status_code == 200
+
+        resp = client.post(self.RESOURCE_URL, json={"targets": ["test_user2"],
+            "workout_name": "copied"})
+        assert resp.status_code == 201
+        resp = client.get("/api/users/test_user2/workouts/copied/")
+        assert json.loads(resp.data)["user_id"] == 2
+
+        # the copy shows up in the delta sync
+        resp = client.get("/api/users/test_user2/changes/")
+        entities = [item["entity"] for item in json.loads(resp.data)["changes"]]
+        assert entities.count("workout") == 4
+        assert entities.count("movement") >= 2
+
+        resp = client.post(self.RESOURCE_URL, json={"targets": ["test_user2"],
+            "workout_name": "copied"})
+        assert resp.status_code == 409
+        resp = client.post(self.RESOURCE_URL, json={"targets": ["non_user"]})
+        assert resp.status_code == 404
+        resp = client.post(self.RESOURCE_URL, json={"targets": []})
+        assert resp.status_code == 400
+
+    def test_statement_count(self, client):
+        """
+        Tests that the number of statements does not grow with
+        the number of movements or target users
+        """
+
+        statements = []
+
+        def _count(*_):
+            statements.append(1)
+
+        with client.application.app_context():
+            engine = db.engine
+        event.listen(engine, "before_cursor_execute", _count)
+        client.post(self.RESOURCE_URL, json={"targets": ["test_user2"]})
+        few = len(statements)
+
+        for i in range(1, 30):
+            client.post("/api/users/test_user1/workouts/test_workout1/",
+                json=_get_movement_json(i))
+        statements.clear()
+        client.post(self.RESOURCE_URL, json={"targets": ["test_user2", "test_user3"],
+            "workout_name": "many"})
+        event.remove(engine, "before_cursor_execute", _count)
+        assert len(statements) == few
+
+class TestRateLimit():
+    """
+    This class implements tests for the rate limiting and admission control.
+    """
+
+    def test_rate_limit(self, client):
+        """
+        Tests that requests over the client and route limits get 429
+        """
+
+        app = client.application
+        app.config["RATELIMIT_ENABLED"] = True
+        app.config["RATELIMIT_DEFAULT"] = (0.001, 3)
+        app.config["RATELIMIT_ROUTES"] = {"api.workoutcollection": (0.001, 1)}
+        app.config["RATELIMIT_CLIENT_HEADER"] = "X-Client-Id"
+        app.wsgi_app = AdmissionMiddleware(app, app.wsgi_app.wsgi_app)
+
+        resp = client.get("/api/users/test_user1/workouts/")
+        assert resp.status_code == 200
+        resp = client.get("/api/users/test_user1/workouts/")
+        assert resp.status_code == 429
+        assert int(resp.headers["Retry-After"]) >= 1
+
+        resp = client.get("/api/users/", headers={"X-Client-Id": "other"})
+        assert resp.status_code == 200
+        resp = client.get("/api/users/")
+        assert resp.status_code == 200
+        resp = client.get("/api/users/")
+        assert resp.status_code == 429
+
+        # outside of the API
+        resp = client.get("/apidocs/")
+        assert resp.status_code != 429
+
+        body = json.loads(client.get("/api/metrics/", environ_base={"REMOTE_ADDR": "1.2.3.4"}).data)
+        assert body["counters"]["ratelimit.rejected"] == 2
+
+    def test_admission(self, client):
+        """
+        Tests that requests over the in-flight limit get 503
+        """
+
+        app = client.application
+        app.config["ADMISSION_MAX_INFLIGHT"] = 1
+        middleware = AdmissionMiddleware(app, app.wsgi_app.wsgi_app)
+        app.wsgi_app = middleware
+
+        resp = client.get("/api/users/")
+        assert resp.status_code == 200
+        middleware.admission.enter()
+        resp = client.get("/api/users/")
+        assert resp.status_code == 503
+        assert resp.headers["Retry-After"] == "1"
+        middleware.admission.leave()
+        resp = client.get("/api/users/")
+        assert resp.status_code == 200
+        resp.close()
+
+        # a streamed response is in flight until it has been sent
+        resp = client.get("/api/export/users/?format=csv")
+        assert middleware.admission.inflight == 1
+        assert client.get("/api/users/", buffered=True).status_code == 503
+        assert resp.get_data(as_text=True).startswith("id,")
+        resp.close()
+        assert middleware.admission.inflight == 0
+
+    def test_prune(self):
+        """
+        Tests that the least recently used in-memory bucket is dropped
+        """
+
+        backend = MemoryBackend()
+        backend.MAX_BUCKETS = 2
+        assert backend.take("a", 0.001, 1)[0]
+        assert backend.take("b", 0.001, 1)[0]
+        assert not backend.take("a", 0.001, 1)[0]
+        # drops b, used before a
+        assert backend.take("c", 0.001, 1)[0]
+        assert not backend.take("a", 0.001, 1)[0]
+        assert backend.take("b", 0.001, 1)[0]
+
+class TestCoalescing():
+    """
+    This class implements tests for the request coalescing.
+    """
+
+    def test_single_flight(self):
+        """
+        Tests that concurrent calls with the same key run once
+        """
+
+        flights = SingleFlight()
+        release = threading.Event()
+        calls = []
+        results = []
+
+        def _slow():
+            calls.append(1)
+            release.wait()
+            return "result"
+
+        threads = [
+            threading.Thread(target=lambda: results.append(flights.do("key", _slow)))
+            for _ in range(5)
+        ]
+        for thread in threads:
+            thread.start()
+        while not calls:
+            time.sleep(0.01)
+        time.sleep(0.1)
+        release.set()
+        for thread in threads:
+            thread.join()
+
+        assert len(calls) == 1
+        assert sorted(shared for _, shared in results) == [False, True, True, True, True]
+        assert {result for result, _ in results} == {"result"}
+
+    def test_get(self, make_app):
+        """
+        Tests that concurrent identical GETs of an enabled route share
+        one database query and the other routes are not coalesced
+        """
+
+        app = make_app(COALESCE_ROUTES={"api.workoutcollection"})
+        client = app.test_client()
+        with app.app_context():
+            engine = db.engine
+
+        def _slow_query(_conn, _cursor, statement, *_):
+            if "FROM workout" in statement:
+                time.sleep(0.3)
+
+        event.listen(engine, "before_cursor_execute", _slow_query)
+        bodies = []
+
+        def _get():
+            bodies.append(app.test_client().get("/api/users/test_user1/workouts/").data)
+
+        threads = [threading.Thread(target=_get) for _ in range(4)]
+        for thread in threads:
+            thread.start()
+        for thread in threads:
+            thread.join()
+        event.remove(engine, "before_cursor_execute", _slow_query)
+
+        assert len(set(bodies)) == 1
+        client.get("/api/users/")
+        counters = json.loads(client.get("/api/metrics/").data)["counters"]
+        assert counters["coalesce.executed"] + counters["coalesce.saved"] == 4
+        assert counters["coalesce.saved"] >= 1
+
+class TestMigrations():
+    """
+    This class implements tests for the schema migrations.
+    """
+
+    @staticmethod
+    def _schema(engine):
+        """
+        Tables, columns and indexes of a database
+        """
+
+        inspector = inspect(engine)
+        return {
+            table: (
+                {column["name"] for column in inspector.get_columns(table)},
+                {index["name"] for index in inspector.get_indexes(table)}
+            )
+            for table in inspector.get_table_names() if table != "schema_version"
+        }
+
+    def test_upgrade(self, client):
+        """
+        Tests that upgrading an empty database gives the same schema as
+        create_all and that an upgraded database is up to date
+        """
+
+        engine = create_engine("sqlite://")
+        assert migrations.upgrade(engine) == list(range(1, migrations.head() + 1))
+        assert migrations.upgrade(engine) == []
+        with client.application.app_context():
+            assert self._schema(engine) == self._schema(db.engine)
+
+    def test_upgrade_baseline(self):
+        """
+        Tests that a database created before migrations is upgraded
+        and that the new columns are backfilled
+        """
+
+        engine = create_engine("sqlite://")
+        migrations.upgrade(engine, target=1)
+        with engine.begin() as conn:
+            conn.execute(text("DROP TABLE schema_version"))
+            for i in range(25):
+                conn.execute(text(
+                    "INSERT INTO user (username, height, weight) VALUES (:name, 180, 80)"
+                ), {"name": f"user{i}"})
+
+        with engine.connect() as conn:
+            assert migrations.current_version(conn) == 1
+        migrations.upgrade(engine)
+        with engine.connect() as conn:
+            assert migrations.current_version(conn) == migrations.head()
+            epoch = conn.execute(text(
+                "SELECT COUNT(*) FROM user WHERE updated_at < '2000-01-01'"
+            )).scalar()
+            assert epoch == 0
+
+    def test_upgrade_change_log(self, tmp_path):
+        """
+        Tests that the existing users, workouts and movements of an
+        upgraded database are returned by the first sync
+        """
+
+        uri = "sqlite:///" + str(tmp_path / "baseline.db")
+        engine = create_engine(uri)
+        migrations.upgrade(engine, target=1)
+        with engine.begin() as conn:
+            conn.execute(text("DROP TABLE schema_version"))
+            conn.execute(text("INSERT INTO user (username, height, weight) "
+                "VALUES ('alice', 170, 60), ('bob', 180, 80)"))
+            conn.execute(text("INSERT INTO workout (user_id, workout_name, favorite) "
+                "VALUES (1, 'legs', 1), (2, 'arms', 0)"))
+            conn.execute(text("INSERT INTO movement (workout_id, movement_name, sets, reps) "
+                "VALUES (1, 'squat', 3, 5), (1, 'lunge', 3, 8), (2, 'curl', 3, 10)"))
+        migrations.upgrade(engine)
+        engine.dispose()
+
+        app = create_app({"SQLALCHEMY_DATABASE_URI": uri, "TESTING": True})
+        body = json.loads(app.test_client().get("/api/users/alice/changes/?since=0").data)
+        assert body["token"] != "0"
+        assert {(item["entity"], item["id"]) for item in body["changes"]} == {
+            ("user", 1), ("workout", 1), ("movement", 1), ("movement", 2)
+        }
+        with app.app_context():
+            db.engine.dispose()
+
+    def test_create_index_postgresql(self):
+        """
+        Tests that an index built concurrently for PostgreSQL does not
+        close the migration's connection or change its isolation level
+        """
+
+        engine = create_engine("sqlite://", poolclass=pool.StaticPool)
+        migrations.upgrade(engine)
+        with engine.connect() as conn:
+            isolation_level = conn.get_isolation_level()
+            migrator = migrations.Migrator(_PostgresConnection(conn))
+            workout = Table("workout", MetaData(), Column("favorite", Boolean))
+            migrator.create_index(Index("ix_test_workout_favorite", workout.c.favorite))
+            assert not conn.closed
+            assert conn.get_isolation_level() == isolation_level
+            assert migrator.execute("SELECT COUNT(*) FROM workout").scalar() == 0
+            names = {index["name"] for index in inspect(conn).get_indexes("workout")}
+            assert "ix_test_workout_favorite" in names
+
+    def test_exercise_catalog(self, caplog):
+        """
+        Tests that the migration to the exercise catalog dedupes the
+        spellings of the movement names across the chunks, keeps and
+        reports the movements of a workout that become the same exercise,
+        and that merge_movements merges them
+        """
+
+        engine = create_engine("sqlite://")
+        migrations.upgrade(engine, target=5)
+        names = ["Back Squat", "back squat", "BackSquat", "Deadlift", "deadlift "]
+        with engine.begin() as conn:
+            conn.execute(text("INSERT INTO user (username, height, weight, updated_at) "
+                "VALUES ('user', 180, 80, '2023-01-01')"))
+            conn.execute(text("INSERT INTO workout (user_id, workout_name, favorite, updated_at) "
+                "VALUES (1, :name, 1, '2023-01-01')"),
+                [{"name": f"workout{i}"} for i in range(2500)])
+            conn.execute(text("INSERT INTO movement (workout_id, movement_name, sets, reps, "
+                "updated_at) VALUES (:workout_id, :name, 3, 5, '2023-01-01')"),
+                [{"workout_id": i + 1, "name": names[i % len(names)]} for i in range(2500)])
+            for name in ("Back Squat", "back squat"):
+                conn.execute(text("INSERT INTO movement (workout_id, movement_name, sets, reps, "
+                    "updated_at) VALUES (1, :name, 3, 5, '2023-01-01')"), {"name": name})
+            conn.execute(text("INSERT INTO user_summary (user_id, document, updated_at) "
+                "VALUES (1, '{}', '2023-01-01')"))
+
+        assert migrations.upgrade(engine) == [6]
+        assert "2 movements are the same exercise" in caplog.text
+        with engine.connect() as conn:
+            assert conn.execute(text(
+                "SELECT name, normalized_name FROM exercise ORDER BY id"
+            )).all() == [("Back Squat", "backsquat"), ("Deadlift", "deadlift")]
+            counts = conn.execute(text(
+                "SELECT exercise_id, COUNT(*) FROM movement GROUP BY exercise_id"
+            )).all()
+            assert counts == [(1, 1502), (2, 1000)]
+            assert conn.execute(text(
+                "SELECT COUNT(*) FROM change_log WHERE deleted"
+            )).scalar() == 0
+            assert not inspect(conn).has_table("_exercise_name_map")
+
+        assert merge_movements(engine, chunk_size=1000) == 2
+        with engine.connect() as conn:
+            assert conn.execute(text(
+                "SELECT id FROM movement WHERE workout_id = 1"
+            )).scalars().all() == [2502]
+            assert conn.execute(text(
+                "SELECT entity_id FROM change_log WHERE deleted"
+            )).scalars().all() == [1, 2501]
+            document = json.loads(conn.execute(text("SELECT document FROM user_summary")).scalar())
+            assert document != {}
+        assert merge_movements(engine) == 0
+
+    def test_rebuild_sequence(self):
+        """
+        Tests that the rows inserted after the movement table is rebuilt
+        get new ids, on PostgreSQL too when TEST_DATABASE_URI is set
+        """
+
+        engine = create_engine(TEST_DATABASE_URI or "sqlite://", poolclass=pool.StaticPool)
+        existing = MetaData()
+        existing.reflect(engine)
+        existing.drop_all(engine)
+        migrations.upgrade(engine, target=5)
+        with engine.begin() as conn:
+            conn.execute(text('INSERT INTO "user" (username, height, weight, updated_at) '
+                "VALUES ('user', 180, 80, '2023-01-01')"))
+            conn.execute(text("INSERT INTO workout (user_id, workout_name, favorite, updated_at) "
+                "VALUES (1, 'workout', TRUE, '2023-01-01')"))
+            conn.execute(text("INSERT INTO movement (workout_id, movement_name, sets, reps, "
+                "updated_at) VALUES (1, :name, 3, 5, '2023-01-01')"),
+                [{"name": name} for name in ("squat", "lunge", "curl")])
+
+        migrations.upgrade(engine)
+        with engine.begin() as conn:
+            conn.execute(text("INSERT INTO exercise (name, normalized_name) "
+                "VALUES ('press', 'press')"))
+            new_id = conn.execute(insert(db.metadata.tables["movement"]).values(
+                workout_id=1, exercise_id=4, sets=3, reps=5, updated_at=utcnow()
+            )).inserted_primary_key[0]
+        assert new_id == 4
+        existing = MetaData()
+        existing.reflect(engine)
+        existing.drop_all(engine)
+        engine.dispose()
+
+    def test_batch_operations(self):
+        """
+        Tests the chunked backfill and the table rebuild
+        """
+
+        engine = create_engine("sqlite://")
+        migrations.upgrade(engine)
+        with engine.begin() as conn:
+            conn.execute(text("INSERT INTO user (username, height, weight, updated_at) "
+                "VALUES ('user', 180, 80, '2023-01-01')"))
+            conn.execute(text("INSERT INTO workout (user_id, workout_name, favorite, updated_at) "
+                "VALUES (1, 'workout', 1, '2023-01-01')"))
+            conn.execute(text("INSERT INTO exercise (name, normalized_name) "
+                "VALUES ('movement', 'movement')"))
+            for _ in range(10):
+                conn.execute(text("INSERT INTO movement (workout_id, exercise_id, sets, reps, "
+                    "updated_at) VALUES (1, 1, 3, 5, '2023-01-01')"))
+
+        with engine.connect() as conn:
+            conn.exec_driver_sql("PRAGMA foreign_keys=ON")
+            migrator = migrations.Migrator(conn)
+            assert migrator.backfill("movement", "reps = reps + 1", chunk_size=3) == 4
+            metadata = MetaData()
+            for table in db.metadata.sorted_tables:
+                table.to_metadata(metadata)
+            migrator.batch_rebuild(metadata.tables["workout"])
+            conn.commit()
+            assert conn.exec_driver_sql("PRAGMA foreign_keys").scalar() == 1
+            assert conn.exec_driver_sql("SELECT SUM(reps) FROM movement").scalar() == 60
+            assert conn.exec_driver_sql("SELECT COUNT(*) FROM workout").scalar() == 1
+
+class TestStorage():
+    """
+    This class implements tests for the dialect-aware statements.
+    """
+
+    def test_upsert(self, client):
+        """
+        Tests that the upsert inserts new rows and updates existing ones
+        """
+
+        with client.application.app_context():
+            upsert(db.session, User.__table__, [
+                {"username": "test_user1", "height": 190.0, "weight": 90.0, "updated_at": utcnow()},
+                {"username": "upserted", "height": 170.0, "weight": 70.0, "updated_at": utcnow()}
+            ], ["username"], ["height", "weight"])
+            db.session.commit()
+            assert User.query.filter_by(username="test_user1").first().height == 190.0
+            assert User.query.filter_by(username="upserted").first().weight == 70.0
+            assert User.query.count() == 4
+
+class TestUserSummary():
+    """
+    This class implements tests for the UserSummaryItem resource.
+    """
+    RESOURCE_URL = "/api/users/test_user1/summary/"
+
+    def test_get(self, client):
+        """
+        Tests the GET method. Checks the following:
+        the document matches the user's data, error codes
+        """
+
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert body["profile"]["username"] == "test_user1"
+        assert body["workout_count"] == 2
+        assert body["movement_count"] == 12
+        assert len(body["last_movements"]) == 5
+        assert body["last_movements"][0]["movement_name"] == "test_movement12"
+
+        resp = client.get("/api/users/non_user/summary/")
+        assert resp.status_code == 404
+
+    def test_refresh(self, client):
+        """
+        Tests that the document follows the changes to the user's data,
+        and that the document is read with one statement
+        """
+
+        client.put("/api/users/test_user1/workouts/test_workout1/",
+            json={"workout_name": "test_workout1", "favorite": True})
+        client.put("/api/users/test_user1/workouts/test_workout2/",
+            json={"workout_name": "test_workout2", "favorite": False})
+        client.post("/api/users/test_user1/workouts/test_workout1/", json=_get_movement_json())
+        client.post("/api/users/test_user1/workouts/test_workout1/clone/",
+            json={"targets": ["test_user2"], "workout_name": "copied"})
+
+        statements = []
+
+        def _count(*_):
+            statements.append(1)
+
+        with client.application.app_context():
+            engine = db.engine
+        event.listen(engine, "before_cursor_execute", _count)
+        body = json.loads(client.get(self.RESOURCE_URL).data)
+        event.remove(engine, "before_cursor_execute", _count)
+        assert len(statements) == 1
+        assert body["favorites"] == ["test_workout1"]
+        assert body["movement_count"] == 13
+        assert body["last_movements"][0]["movement_name"] == "extra_movement1"
+
+        body = json.loads(client.get("/api/users/test_user2/summary/").data)
+        assert body["workout_count"] == 3
+        assert "copied" in body["favorites"]
+
+        client.delete("/api/users/test_user2/")
+        with client.application.app_context():
+            assert db.session.execute(text(
+                "SELECT COUNT(*) FROM user_summary WHERE user_id = 2"
+            )).scalar() == 0
+
+    def test_incremental(self, client):
+        """
+        Tests that a write updates the document in place with the same
+        statements whatever the size of the user's history, and that
+        the updated document matches a full rebuild
+        """
+
+        app = client.application
+        url = "/api/users/test_user1/workouts/test_workout1/"
+        with app.app_context():
+            engine = db.engine
+
+        def _post_statements(number):
+            statements = []
+
+            def _record(_conn, _cursor, statement, *_):
+                statements.append(statement.lower())
+
+            event.listen(engine, "before_cursor_execute", _record)
+            assert client.post(url, json=_get_movement_json(number)).status_code == 201
+            event.remove(engine, "before_cursor_execute", _record)
+            return statements
+
+        client.get(self.RESOURCE_URL)
+        short_history = _post_statements(1)
+        with app.app_context():
+            db.session.execute(insert(Movement), [
+                {"workout_id": 1, "exercise_id": 1, "sets": 3, "reps": 5}
+            ] * 2000)
+            refresh_summaries(db.session.connection(), [1])
+            db.session.commit()
+        long_history = _post_statements(2)
+        assert len(long_history) == len(short_history)
+        assert not any("row_number" in statement or "count(" in statement
+            for statement in long_history)
+
+        client.put(url, json={"workout_name": "renamed", "favorite": True})
+        with app.app_context():
+            stored = db.session.execute(
+                select(UserSummary.document).where(UserSummary.user_id == 1)
+            ).scalar()
+            assert stored == build_summaries(db.session.connection(), [1])[1]
+            assert stored["favorites"][0] == "renamed"
+            assert stored["last_movements"][0]["workout_name"] == "renamed"
+            assert stored["movement_count"] == 2014
+
+class TestProfiling():
+    """
+    This class implements tests for the request profiling.
+    """
+
+    @staticmethod
+    def _client(make_app, directory, **config):
+        """
+        Testing client with profiling enabled and the profiles in directory
+        """
+
+        return make_app(**dict({
+            "PROFILING_ENABLED": True,
+            "PROFILING_SAMPLE_RATE": 0,
+            "PROFILING_ADMIN_TOKEN": "secret",
+            "PROFILING_DIR": directory
+        }, **config)).test_client()
+
+    def test_forced(self, make_app):
+        """
+        Tests that only the requests with the admin token are profiled
+        when nothing is sampled and that the profile can be loaded
+        """
+
+        with tempfile.TemporaryDirectory() as directory:
+            client = self._client(make_app, directory, PROFILING_MODE="cprofile")
+            resp = client.get("/api/users/")
+            assert "X-Profile-Id" not in resp.headers
+            resp = client.get("/api/users/", headers={"X-Profile": "wrong"})
+            assert "X-Profile-Id" not in resp.headers
+            resp = client.get("/api/users/", headers={"X-Profile": "s\u00e9cret"})
+            assert resp.status_code == 200
+            assert "X-Profile-Id" not in resp.headers
+            assert os.listdir(directory) == []
+
+            resp = client.get("/api/users/", headers={"X-Profile": "secret"}, buffered=True)
+            assert resp.status_code == 200
+            assert len(json.loads(resp.data)) == 3
+            name = resp.headers["X-Profile-Id"]
+            assert name.endswith(".pstats")
+            stats = pstats.Stats(os.path.join(directory, name))
+            assert stats.total_calls > 0
+
+    def test_sampled(self, make_app):
+        """
+        Tests the sampling rate, the folded stack output and the retention
+        """
+
+        with tempfile.TemporaryDirectory() as directory:
+            client = self._client(make_app, directory, PROFILING_SAMPLE_RATE=1, PROFILING_KEEP=2,
+                PROFILING_INTERVAL_MS=1)
+            for _ in range(3):
+                assert client.get("/api/users/", buffered=True).status_code == 200
+            names = os.listdir(directory)
+            assert len(names) == 2
+            assert all(name.endswith(".folded") for name in names)
+            for name in names:
+                with open(os.path.join(directory, name), encoding="utf-8") as handle:
+                    for line in handle:
+                        assert line.rsplit(" ", 1)[1].strip().isdigit()
+            counters = json.loads(client.get("/api/metrics/").data)["counters"]
+            assert counters["profiling.profiled"] == 3
+
+    def test_streamed(self, make_app):
+        """
+        Tests that a profiled streamed response is passed through
+        unbuffered and that the profile is written when it is closed
+        """
+
+        produced = []
+
+        def _stream(_environ, start_response):
+            start_response("200 OK", [("Content-Type", "text/csv")])
+            for i in range(3):
+                produced.append(i)
+                yield b"row\n"
+
+        with tempfile.TemporaryDirectory() as directory:
+            app = self._client(make_app, directory).application
+            middleware = ProfilingMiddleware(app, _stream)
+            headers = []
+            result = middleware({"PATH_INFO": "/api/export/users/", "REQUEST_METHOD": "GET",
+                "HTTP_X_PROFILE": "secret"}, lambda status, response_headers, *_:
+                headers.extend(response_headers))
+            assert produced == []
+            assert next(iter(result)) == b"row\n"
+            assert produced == [0]
+            assert os.listdir(directory) == []
+            assert list(result) == [b"row\n", b"row\n"]
+            result.close()
+            assert os.listdir(directory) == [dict(headers)["X-Profile-Id"]]
+            assert middleware._busy.acquire(blocking=False) # pylint: disable=protected-access
+
+class TestIdempotency():
+    """
+    This class implements tests for the Idempotency-Key support.
+    """
+
+    def test_replay(self, client):
+        """
+        Tests that a retried POST gets the stored response without
+        running the handler again, and that a reused key is rejected
+        """
+
+        headers = {"Idempotency-Key": "key-1"}
+        resp = client.post("/api/users/", json=_get_user_json(), headers=headers)
+        assert resp.status_code == 201
+
+        statements = []
+
+        def _count(_conn, _cursor, statement, *_):
+            statements.append(statement)
+
+        with client.application.app_context():
+            engine = db.engine
+        event.listen(engine, "before_cursor_execute", _count)
+        resp = client.post("/api/users/", json=_get_user_json(), headers=headers)
+        event.remove(engine, "before_cursor_execute", _count)
+        assert resp.status_code == 201
+        assert resp.headers["Idempotent-Replayed"] == "true"
+        assert len(statements) == 1
+        assert "idempotency_key" in statements[0]
+
+        resp = client.post("/api/users/", json=_get_user_json(2), headers=headers)
+        assert resp.status_code == 422
+        resp = client.post("/api/users/", json=_get_user_json(), headers={"Idempotency-Key": "key-2"})
+        assert resp.status_code == 409
+        resp = client.post("/api/users/", json=_get_user_json(), headers={"Idempotency-Key": "key-2"})
+        assert resp.status_code == 409
+        assert json.loads(resp.data)["message"] == "Username already in use"
+
+        url = "/api/users/test_user1/workouts/test_workout1/"
+        headers = {"Idempotency-Key": "key-3"}
+        assert client.post(url, json=_get_movement_json(), headers=headers).status_code == 201
+        assert client.post(url, json=_get_movement_json(), headers=headers).status_code == 201
+        counters = json.loads(client.get("/api/metrics/").data)["counters"]
+        assert counters["idempotency.replayed"] == 3
+        assert counters["idempotency.mismatched"] == 1
+
+    def test_non_ascii_path(self, client):
+        """
+        Tests that a retry to a path with non-ASCII characters is replayed
+        """
+
+        user = dict(_get_user_json(), username="jöe")
+        assert client.post("/api/users/", json=user).status_code == 201
+        headers = {"Idempotency-Key": "key-1"}
+        resp = client.post("/api/users/jöe/workouts/", json=_get_workout_json(), headers=headers)
+        assert resp.status_code == 201
+        resp = client.post("/api/users/jöe/workouts/", json=_get_workout_json(), headers=headers)
+        assert resp.status_code == 201
+        assert resp.headers["Idempotent-Replayed"] == "true"
+
+    def test_same_transaction(self, client, monkeypatch):
+        """
+        Tests that the writes of a handler are not committed if its
+        response can't be stored
+        """
+
+        def _crash(*_):
+            raise RuntimeError("crashed before storing the response")
+
+        monkeypatch.setattr(IdempotencyStore, "save", _crash)
+        with pytest.raises(RuntimeError):
+            client.post("/api/users/", json=_get_user_json(), headers={"Idempotency-Key": "key-1"})
+        monkeypatch.undo()
+        with client.application.app_context():
+            assert User.query.filter_by(username="extra_user1").first() is None
+        resp = client.post("/api/users/", json=_get_user_json(), headers={"Idempotency-Key": "key-1"})
+        assert resp.status_code == 201
+        assert "Idempotent-Replayed" not in resp.headers
+
+    def test_expiry(self, client):
+        """
+        Tests that expired responses are not replayed and are purged
+        """
+
+        store = client.application.extensions["idempotency"]
+        store.ttl = 0
+        headers = {"Idempotency-Key": "key-1"}
+        client.post("/api/users/", json=_get_user_json(), headers=headers)
+        resp = client.post("/api/users/", json=_get_user_json(), headers=headers)
+        assert resp.status_code == 409
+        assert "Idempotent-Replayed" not in resp.headers
+        client.post("/api/users/", json=_get_user_json(2), headers={"Idempotency-Key": "key-2"})
+        with client.application.app_context():
+            assert db.session.execute(text("SELECT COUNT(*) FROM idempotency_key")).scalar() == 2
+
+        store.purge_interval = 0
+        client.post("/api/users/", json=_get_user_json(3))
+        client.post("/api/users/", json=_get_user_json(4), headers={"Idempotency-Key": "key-3"})
+        with client.application.app_context():
+            assert db.session.execute(text("SELECT key FROM idempotency_key")).scalars().all() == [
+                "key-3"
+            ]
+
+class TestExport():
+    """
+    This class implements tests for the bulk export.
+    """
+    RESOURCE_URL = "/api/export/movements/"
+
+    def test_csv(self, client):
+        """
+        Tests the CSV export. Checks the following:
+        the header and all rows are returned, error codes
+        """
+
+        resp = client.get(self.RESOURCE_URL)
+        assert resp.status_code == 200
+        assert resp.mimetype == "text/csv"
+        rows = list(csv.reader(io.StringIO(resp.data.decode())))
+        assert rows[0] == ["id", "workout_id", "exercise_id", "sets", "reps", "updated_at"]
+        assert len(rows) == 13
+        assert [row[0] for row in rows[1:]] == [str(i) for i in range(1, 13)]
+
+        resp = client.get("/api/export/exercises/")
+        rows = list(csv.reader(io.StringIO(resp.data.decode())))
+        assert rows[0] == ["id", "name", "normalized_name"]
+        assert rows[1] == ["1", "test_movement1", "testmovement1"]
+
+        resp = client.get("/api/export/non_table/")
+        assert resp.status_code == 404
+        resp = client.get(self.RESOURCE_URL + "?format=xml")
+        assert resp.status_code == 400
+
+    def test_chunks(self, client):
+        """
+        Tests that the rows are read and written in chunks
+        """
+
+        client.application.config["EXPORT_CHUNK_ROWS"] = 5
+        resp = client.get(self.RESOURCE_URL, buffered=False)
+        chunks = [chunk for chunk in resp.response if chunk]
+        resp.close()
+        assert len(chunks) == 3
+        assert b"".join(chunks).count(b"\n") == 13
+
+        with client.application.app_context(), tempfile.TemporaryDirectory() as directory:
+            path = os.path.join(directory, "users.csv")
+            assert write_table(db.engine, "users", "csv", path, 2) == 3
+            with open(path, encoding="utf-8") as handle:
+                assert len(handle.readlines()) == 4
+
+    def test_msgpack(self, client):
+        """
+        Tests the MessagePack export
+        """
+
+        msgpack = pytest.importorskip("msgpack")
+        resp = client.get(self.RESOURCE_URL + "?format=msgpack")
+        unpacker = msgpack.Unpacker()
+        unpacker.feed(resp.data)
+        rows = list(unpacker)
+        assert rows[0][:3] == ["id", "workout_id", "exercise_id"]
+        assert len(rows) == 13
+
+    def test_arrow(self, client):
+        """
+        Tests the Arrow stream export
+        """
+
+        pyarrow = pytest.importorskip("pyarrow")
+        resp = client.get(self.RESOURCE_URL + "?format=arrow")
+        table = pyarrow.ipc.open_stream(resp.data).read_all()
+        assert table.num_rows == 12
+        assert table.column("exercise_id")[0].as_py() == 1
+
+class TestHealth():
+    """
+    This class implements tests for the liveness and readiness probes.
+    """
+
+    def test_ready(self, make_app):
+        """
+        Tests the probes of a healthy worker and the database call timing
+        """
+
+        client = make_app(on_disk=True).test_client()
+        resp = client.get("/healthz")
+        assert resp.status_code == 200
+        assert json.loads(resp.data)["status"] == "ok"
+
+        assert client.post("/api/users/", json=_get_user_json(2)).status_code == 201
+        resp = client.get("/readyz")
+        assert resp.status_code == 200
+        body = json.loads(resp.data)
+        assert body["status"] == "ready"
+        assert body["reasons"] == []
+        assert body["database"]["ok"]
+        assert body["database"]["call_p99_ms"] > 0
+        assert body["pool"]["class"] == "QueuePool"
+        assert body["pool"]["checked_out"] == 0
+        assert body["wal_bytes"] > 0
+        timings = json.loads(client.get("/api/metrics/").data)["timings"]
+        assert timings["db.call"]["count"] >= 2
+
+        # the maintenance statements are not timed either
+        metrics = client.application.extensions["metrics"]
+        calls = len(metrics.timings["db.call"])
+        with client.application.app_context():
+            assert run_maintenance(db.engine, force=True) is not None
+        assert len(metrics.timings["db.call"]) == calls
+
+    def test_not_ready(self, make_app):
+        """
+        Tests that a hung probe query and slow database calls return 503
+        """
+
+        app = make_app(HEALTH_PROBE_TIMEOUT_MS=50)
+        client = app.test_client()
+        with app.app_context():
+            engine = db.engine
+
+        def _hang(_conn, _cursor, statement, *_):
+            if statement == "SELECT 1":
+                time.sleep(0.3)
+
+        event.listen(engine, "before_cursor_execute", _hang)
+        resp = client.get("/readyz")
+        assert resp.status_code == 503
+        assert "timed out" in json.loads(resp.data)["reasons"][0]
+        resp = client.get("/readyz")
+        assert json.loads(resp.data)["reasons"] == ["previous probe still running"]
+        event.remove(engine, "before_cursor_execute", _hang)
+        time.sleep(0.3)
+
+        assert client.get("/readyz").status_code == 200
+        app.config["HEALTH_MAX_DB_P99_MS"] = 0
+        # the probe queries are not timed, only the calls of the requests
+        assert client.get("/readyz").status_code == 200
+        client.get("/api/users/")
+        resp = client.get("/readyz")
+        assert resp.status_code == 503
+        assert "p99" in json.loads(resp.data)["reasons"][0]
+        counters = json.loads(client.get("/api/metrics/").data)["counters"]
+        assert counters["health.not_ready"] == 3
+
+        # the slow calls age out of the window, also without new traffic
+        app.config["HEALTH_P99_WINDOW_SECONDS"] = 0.1
+        time.sleep(0.2)
+        resp = client.get("/readyz")
+        assert resp.status_code == 200
+        assert json.loads(resp.data)["database"]["call_p99_ms"] is None
+
+class TestMaintenance():
+    """
+    This class implements tests for the database maintenance.
+    """
+
+    @sqlite_only
+    def test_run(self, make_app):
+        """
+        Tests that the free pages are vacuumed, statistics gathered, the WAL
+        truncated and the expired idempotency keys deleted
+        """
+
+        app = make_app(on_disk=True)
+        client = app.test_client()
+        with app.app_context():
+            db.session.execute(text(
+                "INSERT INTO idempotency_key (key, request_hash, status, body, created_at) "
+                "VALUES ('old', '', 201, '', '2000-01-01 00:00:00')"
+            ))
+            # enough rows to fill whole pages, which become free when deleted
+            db.session.execute(Movement.__table__.insert(), [
+                {"workout_id": 1, "exercise_id": 1, "sets": 1, "reps": 1, "updated_at": utcnow()}
+                for _ in range(5000)
+            ])
+            db.session.commit()
+            engine = db.engine
+        assert client.delete("/api/users/test_user1/").status_code == 201
+
+        report = run_maintenance(engine, vacuum_pages=None, idempotency_ttl=60, force=True)
+        assert report["before"]["auto_vacuum"] == 2
+        assert report["before"]["freelist_count"] > 0
+        assert report["after"]["freelist_count"] == 0
+        assert report["after"]["db_bytes"] < report["before"]["db_bytes"]
+        assert report["after"]["wal_bytes"] == 0
+        assert report["steps"]["idempotency_purged"] == 1
+        assert report["steps"]["vacuum"] == "incremental"
+        assert report["steps"]["analyze"] == "analyze"
+        assert not report["steps"]["checkpoint"]["busy"]
+        for plans in report["plan_changes"].values():
+            assert plans["before"] != plans["after"]
+
+        # below the thresholds only the statistics are refreshed
+        report = run_maintenance(engine)
+        assert report["steps"] == {"analyze": "optimize"}
+
+    @sqlite_only
+    def test_full_vacuum(self, tmp_path):
+        """
+        Tests that a database that is not incremental is only converted
+        with a full VACUUM when it is asked for
+        """
+
+        engine = create_engine("sqlite:///" + str(tmp_path / "old.db"))
+        with engine.begin() as conn:
+            conn.exec_driver_sql("CREATE TABLE filler (data TEXT)")
+            for _ in range(200):
+                conn.exec_driver_sql("INSERT INTO filler VALUES (hex(randomblob(500)))")
+            conn.exec_driver_sql("DELETE FROM filler")
+            for table in db.metadata.sorted_tables:
+                table.create(conn)
+
+        report = run_maintenance(engine, force=True)
+        assert report["steps"]["vacuum"] == "skipped"
+        assert report["after"]["auto_vacuum"] == 0
+        report = run_maintenance(engine, full=True)
+        assert report["steps"]["vacuum"] == "full"
+        assert report["after"]["auto_vacuum"] == 2
+        assert report["after"]["freelist_count"] == 0
+        engine.dispose()
+
+    @sqlite_only
+    def test_scheduler(self, make_app, tmp_path):
+        """
+        Tests that the scheduler started by the first request runs the maintenance
+        """
+
+        lock_path = tmp_path / "locks" / "maintenance.lock"
+        app = make_app(on_disk=True, MAINTENANCE_INTERVAL=0.05,
+            MAINTENANCE_LOCK_PATH=str(lock_path))
+        client = app.test_client()
+        assert client.get("/healthz").status_code == 200
+        scheduler = app.extensions["maintenance"]
+        try:
+            for _ in range(100):
+                if scheduler.last_report is not None:
+                    break
+                time.sleep(0.02)
+        finally:
+            scheduler.stop()
+        assert scheduler.last_report is not None
+        body = json.loads(client.get("/api/metrics/").data)
+        assert body["counters"]["maintenance.runs"] >= 1
+        assert body["gauges"]["maintenance.db_bytes"] > 0
+        assert lock_path.exists()
+
+class TestAccessLog():
+    """
+    This class implements tests for the structured access log.
+    """
+
+    def test_log(self, make_app, tmp_path):
+        """
+        Tests that every request is logged as one JSON line with its route,
+        user, status, latency and SQL statement count
+        """
+
+        path = str(tmp_path / "access-{pid}.log")
+        app = make_app(ACCESS_LOG_ENABLED=True, ACCESS_LOG_PATH=path)
+        client = app.test_client()
+        # the request is logged when the server closes the response
+        for url, status in (("/api/users/test_user1/", 200), ("/api/users/non_user/", 404),
+                ("/healthz", 200)):
+            assert client.get(url, buffered=True).status_code == status
+        app.extensions["access_log"].stop()
+
+        with open(path.replace("{pid}", str(os.getpid())), encoding="utf-8") as handle:
+            entries = [json.loads(line) for line in handle]
+        assert [entry["status"] for entry in entries] == [200, 404, 200]
+        found, missing, health = entries
+        assert found["route"] == "/api/users/<user:user>/"
+        assert found["user"] == "test_user1"
+        assert found["method"] == "GET"
+        assert found["sql"] >= 1
+        assert found["latency_ms"] > 0
+        assert missing["path"] == "/api/users/non_user/"
+        assert missing["route"] is None
+        assert health["sql"] == 0
+        assert "time" in found
+
+    def test_batching(self, tmp_path):
+        """
+        Tests that the records are written per batch, that the file is
+        rotated and that a full queue drops records instead of blocking
+        """
+
+        path = str(tmp_path / "access.log")
+        handler = BatchingRotatingFileHandler(path, 2000, 2, 10)
+        handler.setFormatter(JsonFormatter())
+        for i in range(9):
+            handler.handle(logging.makeLogRecord({"msg": {"request": i}}))
+        assert not os.path.exists(path)
+        for i in range(9, 100):
+            handler.handle(logging.makeLogRecord({"msg": {"request": i}}))
+        handler.close()
+        names = sorted(os.listdir(tmp_path))
+        assert names == ["access.log", "access.log.1", "access.log.2"]
+        with open(path, encoding="utf-8") as handle:
+            assert json.loads(handle.readlines()[-1])["request"] == 99
+
+        dropped = []
+        queue_handler = DroppingQueueHandler(queue.Queue(1), lambda: dropped.append(1))
+        for i in range(3):
+            queue_handler.handle(logging.makeLogRecord({"msg": {"request": i}}))
+        assert len(dropped) == 2